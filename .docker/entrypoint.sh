@@ -1,10 +1,27 @@
 #!/bin/sh
-
-sudo mkdir /app/data/logs/ -p
-sudo rm -f /usr/local/apache2/logs/httpd.pid
-
+sudo /usr/bin/mkdir -p /app/data/logs/
+# Dockerfile builds on the httpd image, .docker/Dockerfile.apache on Debian's apache2
+if [ -x /usr/local/apache2/bin/httpd ]; then
+    sudo /usr/bin/rm -f /usr/local/apache2/logs/httpd.pid
+else
+    sudo /usr/bin/rm -f /var/run/apache2/apache2.pid
+fi
+# Privileged helper: the only process that runs wg/wg-quick as root. -I keeps
+# the environment and the working directory out of its imports
+sudo /usr/local/bin/python3 -I /app/wgctl.py --socket /run/wg-manager/wg.sock --group wgvpn &
+helper=$!
+tries=0
+while [ ! -S /run/wg-manager/wg.sock ]; do
+    if [ ! -d "/proc/$helper" ] || [ "$tries" -ge 100 ]; then
+        echo "WireGuard helper did not start" >&2
+        exit 1
+    fi
+    tries=$((tries + 1))
+    sleep 0.1
+done
+# One-time bootstrap, the web workers only load the peer state lazily
 python3 ./app.py -w
-
-. /usr/local/apache2/bin/envvars
-sudo -E /usr/local/apache2/bin/httpd -D FOREGROUND "$@"
-# exec apache2 -D FOREGROUND
+if [ -x /usr/local/apache2/bin/httpd ]; then
+    exec sudo /usr/local/apache2/bin/httpd -D FOREGROUND
+fi
+exec sudo /usr/sbin/apache2ctl -D FOREGROUND
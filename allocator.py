@@ -0,0 +1,155 @@
+import ipaddress
+import random
+
+class PoolExhaustedError(RuntimeError):
+    pass
+
+class AddressPool:
+    """
+    Address allocator for a WireGuard subnet
+
+    Used addresses are tracked in a bitmap (one bit per host address) and
+    released addresses go to a free-list, so handing out an address never
+    probes blindly. Works the same for IPv4 and IPv6 networks; pools larger
+    than MAX_SIZE only manage their first MAX_SIZE host addresses.
+
+    The network address and the server address (network + 1) are never
+    handed out, nor is the IPv4 broadcast address.
+    """
+    MAX_SIZE = 1 << 24
+    RANDOM_PROBES = 8
+
+    network: ipaddress.IPv4Network | ipaddress.IPv6Network
+    first: int
+    size: int
+    randomize: bool
+
+    def __init__(self, cidr: str, reserved: list[str] = None, randomize: bool = False):
+        self.network = ipaddress.ip_network(cidr)
+        self.first = int(self.network.network_address) + 2
+        last = int(self.network.broadcast_address) - (1 if self.network.version == 4 else 0)
+        self.size = max(0, min(last - self.first + 1, self.MAX_SIZE))
+        self.randomize = randomize
+
+        self._bitmap = bytearray((self.size + 7) // 8)
+        self._free = self.size
+        self._cursor = 0
+        self._released: list[int] = []
+        # Offsets on the free-list, each is listed once
+        self._listed: set[int] = set()
+        self._reserved: list[tuple[int, int]] = []
+        self.misses = 0
+
+        for spec in reserved or []:
+            self.reserve(spec)
+
+    def __len__(self) -> int:
+        return self.size - self._free
+
+    def __contains__(self, id: int) -> bool:
+        offset = id - self.first
+        return 0 <= offset < self.size and self._test(offset)
+
+    @property
+    def free(self) -> int:
+        return self._free
+
+    def _test(self, offset: int) -> bool:
+        return bool(self._bitmap[offset >> 3] & (1 << (offset & 7)))
+
+    def _set(self, offset: int):
+        self._bitmap[offset >> 3] |= 1 << (offset & 7)
+        self._free -= 1
+
+    def _clear(self, offset: int):
+        self._bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+        self._free += 1
+
+    def _parse_range(self, spec: str) -> tuple[int, int]:
+        """
+        Parse "address", "cidr" or "start-end" into pool offsets (inclusive)
+        """
+        if "-" in spec:
+            start, end = spec.split("-", 1)
+            start, end = int(ipaddress.ip_address(start.strip())), int(ipaddress.ip_address(end.strip()))
+        elif "/" in spec:
+            network = ipaddress.ip_network(spec.strip(), strict=False)
+            start, end = int(network.network_address), int(network.broadcast_address)
+        else:
+            start = end = int(ipaddress.ip_address(spec.strip()))
+        return max(start - self.first, 0), min(end - self.first, self.size - 1)
+
+    def reserve(self, spec: str):
+        """
+        Exclude an address, cidr or "start-end" range from allocation
+        """
+        lo, hi = self._parse_range(spec)
+        if lo > hi:
+            return
+        self._reserved.append((lo, hi))
+        for offset in range(lo, hi + 1):
+            if not self._test(offset):
+                self._set(offset)
+
+    def is_reserved(self, id: int) -> bool:
+        offset = id - self.first
+        return any(lo <= offset <= hi for lo, hi in self._reserved)
+
+    def claim(self, id: int) -> bool:
+        """
+        Mark an address as used. Returns False when it is outside the pool or already taken.
+        """
+        offset = id - self.first
+        if not 0 <= offset < self.size or self._test(offset):
+            return False
+        self._set(offset)
+        return True
+
+    def release(self, id: int) -> bool:
+        offset = id - self.first
+        if not 0 <= offset < self.size or not self._test(offset) or self.is_reserved(id):
+            return False
+        self._clear(offset)
+        if offset < self._cursor and offset not in self._listed:
+            self._released.append(offset)
+            self._listed.add(offset)
+        return True
+
+    def allocate(self) -> int:
+        """
+        Take a free address
+
+        Raises:
+            PoolExhaustedError: No free address left in the pool
+        """
+        if self._free <= 0:
+            raise PoolExhaustedError(f"Address pool {self.network} exhausted")
+
+        if self.randomize:
+            for _ in range(self.RANDOM_PROBES):
+                offset = random.randrange(self.size)
+                if not self._test(offset):
+                    self._set(offset)
+                    return self.first + offset
+                self.misses += 1
+
+        # Every free offset below the cursor is on the free-list, so one of
+        # the two loops below always finds an address.
+        while self._released:
+            offset = self._released.pop()
+            self._listed.discard(offset)
+            if not self._test(offset):
+                self._set(offset)
+                return self.first + offset
+
+        while self._cursor < self.size:
+            offset = self._cursor
+            if offset & 7 == 0 and self._bitmap[offset >> 3] == 0xff:
+                self._cursor += 8
+                continue
+            self._cursor += 1
+            if not self._test(offset):
+                self._set(offset)
+                return self.first + offset
+
+        raise PoolExhaustedError(f"Address pool {self.network} exhausted")
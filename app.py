@@ -1,47 +1,169 @@
+import time
+_import_start = time.perf_counter()
+
 import settings
+import sessions
+import metrics
 import wg
 
-from flask import Flask, request, redirect, session, jsonify, send_file
+from flask import Flask, Response, request, redirect, session, jsonify, send_file, g
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from pathlib import Path
-from google_auth_oauthlib.flow import Flow
-from google.oauth2 import id_token
-import google.auth.transport.requests
 from io import BytesIO
+import threading
 import argparse
-import time
+import zipfile
 import json
+import os
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
 app.secret_key = settings.SECRET_KEY
 
+def _configure_app():
+    """
+    Apply the settings Flask reads, once settings.load_config() ran
+    """
+    app.secret_key = settings.SECRET_KEY
+    app.session_interface = sessions.open_session_interface(settings.SESSION_STORE, settings.LOGIN_TIME, settings.SESSION_ACTIVITY_INTERVAL, settings.SESSION_DB_PATH, settings.SESSION_MAX_ENTRIES)
+
+# Settings captured by the session interface, _configure_app() runs again when one of them changes
+_APP_SETTINGS = {"SECRET_KEY", "LOGIN_TIME", "SESSION_STORE", "SESSION_DB_PATH", "SESSION_MAX_ENTRIES", "SESSION_ACTIVITY_INTERVAL"}
+
+def _apply_app_settings(changed: set[str]):
+    # A new "memory" store starts empty and a new SECRET_KEY voids the cookies, both log everybody out
+    if changed & _APP_SETTINGS:
+        print(f"Reconfiguring sessions for {', '.join(sorted(changed & _APP_SETTINGS))}")
+        _configure_app()
+
+wg.settings_listeners.append(_apply_app_settings)
+
+def _start_login():
+    """
+    Give the session a new ID before it is logged in, so an ID planted before the login stays anonymous
+    """
+    if isinstance(app.session_interface, sessions.ServerSessionInterface):
+        app.session_interface.regenerate(session)
+
 def _logged_in() -> bool:
     return 'email' in session
 
+def _not_modified(etag: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def _is_admin() -> bool:
+    return session.get('email') in settings.ADMIN_EMAILS
+
+class _ZipStream:
+    """
+    Write-only file object that hands back what zipfile wrote so far
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _stream_configs_zip(peers: list[wg.WireguardPair]):
+    """
+    Render the client configs of `peers` into a ZIP, yielded file by file
+
+    Rendered from the given peer objects, a peer removed while the ZIP is
+    streamed is still included rather than cutting the response short.
+    """
+    stream = _ZipStream()
+    names = set()
+    with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as zf:
+        for peer in peers:
+            name = f"{peer.user}/{wg.client_name(peer)[:32]}"
+            if name in names:
+                name = f"{name}_{peer.id}"
+            names.add(name)
+            zf.writestr(f"{name}.conf", wg.render_client_config(peer))
+            yield stream.drain()
+    yield stream.drain()
+
 def _add_status(data: dict, status: int, message: str) -> dict:
     data['status'] = status
     data['message'] = message
     return data
 
-def get_flow():
-    return Flow.from_client_config(
-        settings.GOOGLE_CLIENT_SECRET,
-        scopes=["https://www.googleapis.com/auth/userinfo.email", "https://www.googleapis.com/auth/userinfo.profile", "openid"],
-        redirect_uri=f"{settings.BASE_URL}/auth/callback",
-    )
+def _accepted(job: str) -> tuple[Response, int]:
+    response = jsonify(_add_status({"data": {"job": job}}, 202, "Accepted"))
+    response.headers['Location'] = f"{settings.BASE_URL}/wg/jobs/{job}"
+    return response, 202
+
+def _respond_async() -> bool:
+    return settings.WG_ASYNC_MUTATIONS or 'respond-async' in request.headers.get('Prefer', '')
+
+def _mutation_response():
+    """
+    202 with the job ID of the calling thread's last mutation right away in
+    async mode, otherwise wait for the change to be live
+    """
+    job = wg.last_job(session['email'])
+    if _respond_async():
+        return _accepted(job)
+
+    status = wg.job_status(job, session['email'], settings.WG_APPLY_TIMEOUT)
+    if status['state'] == "pending":
+        return _accepted(job)
+    elif status['state'] == "failed":
+        return jsonify({"status": 502, "message": f"Saved, but applying to the interface failed: {status['error']}"}), 502
+    return jsonify({"status": 200, "message": "OK"})
+
+_request_seconds = metrics.histogram("http_request_seconds", "Request latency per Flask endpoint")
+# Seconds spent per startup phase of this process: "import" and "load"
+startup: dict[str, float] = {}
+metrics.gauge("app_startup_seconds", "Time this process spent importing the app and loading the peer state", lambda: {(("phase", phase),): seconds for phase, seconds in startup.items()})
+
+def _load_worker():
+    """
+    Load the peer state on the first request of a web worker
+    """
+    start = time.perf_counter()
+    if not wg.ensure_loaded():
+        return
+    startup['load'] = time.perf_counter() - start
+    wg.telemetry.start()
+    wg.start_watcher()
+    print(f"Worker {os.getpid()} ready: imported in {startup.get('import', 0) * 1000:.0f} ms, loaded {len(wg.clients)} peers in {startup['load'] * 1000:.0f} ms")
 
 @app.before_request
 def before_request():
+    if metrics.enabled:
+        g.request_start = time.perf_counter()
+
+    if not wg.loaded:
+        _load_worker()
+    wg.refresh()
+
     if 'email' in session:
-        if 'act_time' in session and session['act_time'] < time.time() - settings.LOGIN_TIME:
-            session.pop('email')
-            session.pop('idinfo')
-            session.pop('login_time')
-            session.pop('act_time')
-        else:
-            session['act_time'] = time.time()
+        now = time.time()
+        if 'act_time' in session and session['act_time'] < now - settings.LOGIN_TIME:
+            session.clear()
+        elif session.get('act_time', 0) < now - settings.SESSION_ACTIVITY_INTERVAL:
+            # Throttled, every write re-signs the session cookie or hits the session store
+            session['act_time'] = now
+
+@app.after_request
+def after_request(response):
+    if metrics.enabled and 'request_start' in g:
+        _request_seconds.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint, method=request.method, status=response.status_code)
+    return response
 
 @app.get("/")
 def root():
@@ -49,7 +171,9 @@ def root():
 
 @app.route('/auth/google', methods=['GET'])
 def google_auth():
-    flow = get_flow()
+    # Deferred, the Google client libraries take longer to import than everything else
+    import oauth
+    flow = oauth.get_flow()
     authorization_url, state = flow.authorization_url()
     session['state'] = state
     session['login_start_time'] = time.time()
@@ -73,15 +197,17 @@ def google_auth_callback():
     if state != request.args.get('state'):
         return jsonify({"status": 400, "message": "State mismatch"}), 400
     
+    import oauth
     try:
-        flow = get_flow()
+        flow = oauth.get_flow()
         flow.fetch_token(authorization_response=request.url)
-        idinfo = id_token.verify_oauth2_token(flow.credentials.id_token, google.auth.transport.requests.Request(), flow.client_config['client_id'])
+        idinfo = oauth.verify_id_token(flow.credentials.id_token, flow.client_config['client_id'])
         email = idinfo.get('email')
     except Exception as e:
         return jsonify({"status": 400, "message": str(e)}), 400
 
     if email in settings.ALLOWED_EMAILS or email.split('@')[-1] in settings.ALLOWED_DOMAINS:
+        _start_login()
         session['email'] = email
         session['picture'] = idinfo.get('picture')
         session['login_time'] = time.time()
@@ -92,18 +218,15 @@ def google_auth_callback():
 
 @app.route('/auth/logout', methods=['GET'])
 def logout():
-    if 'email' in session:
-        session.pop('email')
-        # session.pop('idinfo')
-        session.pop('picture')
-        session.pop('login_time')
-        session.pop('act_time')
+    # Drops the whole session, and its server-side entry
+    session.clear()
     return redirect("/")
 
 @app.route('/auth/debug/login', methods=['GET'])
 def debug():
     if settings.DEBUG:
         if 'email' not in session:
+            _start_login()
             session['email'] = request.args.get('email', 'test@example.com')
             session['idinfo'] = {}
             session['login_time'] = time.time()
@@ -140,16 +263,252 @@ def wg_list():
     Requires: Logged in
 
     Returns:
-        dict: List of WireGuard peers
+        dict: List of WireGuard peers, without private keys (see /wg/download)
+    
+    """
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    user = session['email']
+    # Taken first, changes made while the list is built are sent again rather than missed
+    version = wg.changes.cursor()
+    data, etag = wg.get_wireguard_list(user), wg.get_wireguard_list_etag(user)
+    if etag in request.if_none_match:
+        return _not_modified(etag)
+
+    response = jsonify(_add_status({"data": data, "version": version}, 200, "OK"))
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+    
+@app.route('/wg/changes', methods=['GET'])
+def wg_changes():
+    """
+    Get the changes to your WireGuard peers since a version of the list
+
+    Requires: Logged in
+
+    Args:
+        since (str): "version" of /wg/list or of the previous call
+
+    Returns:
+        dict: Changes in order (version, type and data) and the version to continue from,
+            "reset" if the list has to be fetched again
+    
+    """
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    try:
+        changes, version = wg.changes.since(request.args.get('since', ''), session['email'])
+    except ValueError as e:
+        return jsonify({"status": 400, "message": str(e)}), 400
+
+    response = jsonify(_add_status({"data": changes or [], "reset": changes is None, "version": version}, 200, "OK"))
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+# Seconds between keepalives of idle event streams
+_EVENTS_KEEPALIVE = 15
+# Seconds EventSource waits before reconnecting
+_EVENTS_RETRY = 3
+# Open /wg/events streams, each of them holds a web server thread
+_event_streams = 0
+_event_streams_lock = threading.Lock()
+
+def _sse(data: dict, event: str = None, id: str = None) -> str:
+    frame = f"id: {id}\n" if id else ""
+    if event:
+        frame += f"event: {event}\n"
+    return f"{frame}data: {json.dumps(data)}\n\n"
+
+def _change_events(user: str, cursor: str, timeout: float):
+    """
+    Server-sent events of the changes to `user`'s peers after `cursor`, for `timeout` seconds
+
+    Ends after a "reset", the client fetches the list again and reconnects
+    from its version.
+    """
+    deadline = time.monotonic() + timeout
+    yield f"retry: {_EVENTS_RETRY * 1000}\n\n"
+    while True:
+        changes, next_cursor = wg.changes.since(cursor, user)
+        if changes is None:
+            yield _sse({"version": next_cursor}, "reset", next_cursor)
+            return
+        for change in changes:
+            yield _sse(change["data"], change["type"], change["version"])
+        cursor = next_cursor
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if not wg.changes.wait(cursor, min(remaining, _EVENTS_KEEPALIVE)):
+            # Also moves the resume point past other users' changes
+            yield f": keepalive\nid: {cursor}\n\n"
+
+def _close_event_stream():
+    global _event_streams
+
+    with _event_streams_lock:
+        _event_streams -= 1
+
+@app.route('/wg/events', methods=['GET'])
+def wg_events():
+    """
+    Stream the changes to your WireGuard peers as server-sent events
+
+    Events are "added" (the peer), "removed" (id), "renamed" (id and name),
+    "applied" (version up to which your changes are live on the interface)
+    and "reset" (fetch /wg/list again). The stream ends after
+    WG_EVENTS_TIMEOUT seconds, EventSource reconnects and resumes from the
+    Last-Event-ID header.
+
+    Requires: Logged in
+
+    Args:
+        since (str): "version" of /wg/list, used if there is no Last-Event-ID header
+
+    Returns:
+        text/event-stream, 503 when WG_EVENTS_MAX_STREAMS are open (poll /wg/changes instead)
+    
+    """
+    global _event_streams
+
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    user = session['email']
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('since', '')
+    try:
+        wg.changes.since(cursor, user)
+    except ValueError as e:
+        return jsonify({"status": 400, "message": str(e)}), 400
+
+    with _event_streams_lock:
+        if _event_streams >= settings.WG_EVENTS_MAX_STREAMS:
+            return jsonify({"status": 503, "message": "Too many event streams, poll /wg/changes"}), 503
+        _event_streams += 1
+
+    response = Response(_change_events(user, cursor, settings.WG_EVENTS_TIMEOUT), mimetype='text/event-stream')
+    response.call_on_close(_close_event_stream)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/wg/peers', methods=['GET'])
+def wg_peers():
+    """
+    Search WireGuard peers, one page at a time
+
+    Requires: Logged in (admin to search other users' peers)
+
+    Args:
+        user (str): Peer owner, defaults to yourself ("*" for every user, admin only)
+        name (str): Name prefix
+        cidr (str): Address range
+        public_key (str): Public key
+        sort (str): "id" or "name", prefixed with "-" for descending order
+        limit (int): Page size, at most 1000
+        cursor (str): "next" of the previous page
+        fields (str): Comma separated fields to return, private keys only for your own peers
+
+    Returns:
+        dict: Matching peers, the cursor of the next page and the version of
+            the change log to follow your peers from (see /wg/changes)
+    
+    """
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    user = request.args.get('user', session['email'])
+    fields = request.args.get('fields', 'id,name,user,ip,public_key').split(',')
+    sort = request.args.get('sort', 'id')
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+
+    if user != session['email'] and not _is_admin():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+    elif any(field not in wg.PEER_FIELDS for field in fields):
+        return jsonify({"status": 400, "message": f"Fields must be some of {', '.join(wg.PEER_FIELDS)}"}), 400
+    elif user != session['email'] and any(field in wg.SECRET_FIELDS for field in fields):
+        return jsonify({"status": 403, "message": "Private keys are only listed for your own peers"}), 403
+
+    # Taken first, changes made while the page is built are sent again rather than missed
+    version = wg.changes.cursor()
+    try:
+        peers, cursor = wg.query_peers(
+            user=None if user == '*' else user,
+            name=request.args.get('name'),
+            network=request.args.get('cidr'),
+            public_key=request.args.get('public_key'),
+            sort=sort.removeprefix('-'),
+            descending=sort.startswith('-'),
+            limit=limit,
+            cursor=request.args.get('cursor'),
+        )
+    except ValueError as e:
+        return jsonify({"status": 400, "message": str(e)}), 400
+
+    data = [{field: getattr(peer, field) for field in fields} for peer in peers]
+    return jsonify(_add_status({"data": data, "next": cursor, "version": version}, 200, "OK"))
+
+@app.route('/wg/users', methods=['GET'])
+def wg_users():
+    """
+    List every user with their peer count
+
+    Requires: Admin
+
+    Returns:
+        dict: users sorted by email
+    
+    """
+    if not _is_admin():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    data = [{"user": user, "peers": wg.user_config_count(user)} for user in sorted(wg.list_users())]
+    return jsonify(_add_status({"data": data}, 200, "OK"))
+
+@app.route('/wg/stats', methods=['GET'])
+def wg_stats():
+    """
+    Get traffic statistics of your WireGuard peers
+
+    Requires: Logged in
+
+    Args:
+        window (int): number of samples the rates are averaged over
+
+    Returns:
+        dict: Endpoint, latest handshake, rx/tx bytes and rates per peer
     
     """
     if not _logged_in():
         return jsonify({"status": 403, "message": "Forbidden"}), 403
 
     user = session['email']
+    window = request.args.get('window', 1, type=int)
 
-    return jsonify(_add_status({"data": wg.get_wireguard_list(user)}, 200, "OK"))
+    return jsonify(_add_status({"data": wg.get_wireguard_stats(user, window)}, 200, "OK"))
+
+@app.route('/wg/stats/global', methods=['GET'])
+def wg_stats_global():
+    """
+    Get traffic statistics of the whole interface
+
+    Requires: Admin or localhost
+
+    Returns:
+        dict: Peer counts and rx/tx totals and rates
     
+    """
+    if not _is_admin() and request.remote_addr != "127.0.0.1":
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    window = request.args.get('window', 1, type=int)
+
+    return jsonify(_add_status({"data": wg.get_global_stats(window)}, 200, "OK"))
+
 @app.route('/wg/download', methods=['GET'])
 def wg_config():
     """
@@ -170,14 +529,17 @@ def wg_config():
     user = session['email']
     ipid = int(request.args.get('id', 0))
 
-    wgconfig = wg.generate_wireguard_config(user, ipid)
+    wgconfig, etag = wg.generate_wireguard_config(user, ipid), wg.get_wireguard_config_etag(user, ipid)
 
     if not wgconfig:
         return jsonify({"status": 404, "message": "Associated ID Not Found"}), 404
+    if etag in request.if_none_match:
+        return _not_modified(etag)
 
     config_file = BytesIO(wgconfig.encode('utf-8'))
-    config_file.seek(0)
-    return send_file(config_file, as_attachment=True, download_name=f"{wg.get_wireguard_name(user, ipid)[:32]}.conf", mimetype='text/plain')
+    response = send_file(config_file, as_attachment=True, download_name=f"{wg.get_wireguard_name(user, ipid)[:32]}.conf", mimetype='text/plain', etag=etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/wg/add', methods=['POST'])
 def wg_add():
@@ -187,7 +549,7 @@ def wg_add():
     Requires: Logged in
 
     Returns:
-        None (client need to reload the page)
+        dict: 200 once the peer is live, or 202 with a job ID (see /wg/jobs)
     
     """
     if not _logged_in():
@@ -197,11 +559,74 @@ def wg_add():
     name = request.json.get('name', '')
     name = wg.fix_name(name)
 
-    wgpair = wg.generate_wireguard_pair(user, name)
-    if wg.add_client(wgpair):
-        return jsonify({"status": 200, "message": "OK"})
+    try:
+        wg.create_client(user, name, wait=False)
+    except wg.PoolExhaustedError:
+        return jsonify({"status": 503, "message": "No free address left in the WireGuard address pool"}), 503
+
+    return _mutation_response()
+
+@app.route('/wg/bulk', methods=['POST'])
+def wg_bulk():
+    """
+    Add many WireGuard peers at once
+
+    Requires: Logged in (admin to create peers for other users)
+
+    Args:
+        peers (list[dict]): {"user": email, "name": peer name} for each peer
+        count (int): alternatively, number of peers to create for yourself
+        name (str): name prefix used with count
+
+    Returns:
+        application/zip: client configuration of every created peer
+    
+    """
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    user = session['email']
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({"status": 400, "message": "Expected a JSON object"}), 400
+
+    if 'peers' in body:
+        requested = body['peers']
+        if not isinstance(requested, list) or not all(isinstance(peer, dict) for peer in requested):
+            return jsonify({"status": 400, "message": "peers must be a list of objects"}), 400
+        elif not all(isinstance(peer.get('user', user), str) and isinstance(peer.get('name') or '', str) for peer in requested):
+            return jsonify({"status": 400, "message": "user and name of each peer must be strings"}), 400
+        count = len(requested)
+    else:
+        count = body.get('count', 0)
+        if type(count) is not int:
+            return jsonify({"status": 400, "message": "count must be an integer"}), 400
+        elif not isinstance(body.get('name') or '', str):
+            return jsonify({"status": 400, "message": "name must be a string"}), 400
+
+    # Checked before the peer list is built, count may be anything
+    if count <= 0:
+        return jsonify({"status": 400, "message": "No peers requested"}), 400
+    elif count > settings.WG_BULK_LIMIT:
+        return jsonify({"status": 400, "message": f"At most {settings.WG_BULK_LIMIT} peers per request"}), 400
+
+    if 'peers' in body:
+        peers = [(peer.get('user', user), wg.fix_name(peer.get('name') or '')) for peer in requested]
     else:
-        return jsonify({"status": 500, "message": "Internal Server Error. Server might have conflicted ip with generated ip"}), 500
+        name = wg.fix_name(body.get('name') or '')
+        peers = [(user, f"{name}_{n}" if name else '') for n in range(1, count + 1)]
+
+    if not _is_admin() and any(peer_user != user for peer_user, _ in peers):
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    try:
+        created = wg.create_clients(peers, wait=False)
+    except wg.PoolExhaustedError as e:
+        return jsonify({"status": 503, "message": str(e)}), 503
+
+    # The configs don't depend on the interface, so don't wait for it
+    headers = {"Content-Disposition": "attachment; filename=wireguard.zip", "X-Job-Id": wg.last_job(user)}
+    return Response(_stream_configs_zip(created), mimetype='application/zip', headers=headers)
 
 @app.route('/wg/remove', methods=['POST'])
 def wg_remove():
@@ -214,7 +639,7 @@ def wg_remove():
         address (str): Peer address
 
     Returns:
-        None (client need to reload the page)
+        dict: 200 once the peer is removed from the interface, or 202 with a job ID (see /wg/jobs)
     
     """
     if not _logged_in():
@@ -225,8 +650,10 @@ def wg_remove():
 
     if not ipid:
         return jsonify({"status": 400, "message": "ID is required"}), 400
-    elif wg.remove_client(user, ipid):
-        return jsonify({"status": 200, "message": "OK"})
+    elif type(ipid) is not int:
+        return jsonify({"status": 400, "message": "ID must be an integer"}), 400
+    elif wg.remove_client(user, ipid, wait=False):
+        return _mutation_response()
     else:
         return jsonify({"status": 404, "message": "Associated Addess Not Found"}), 404
 
@@ -242,7 +669,7 @@ def wg_edit():
         name (str): Peer name
 
     Returns:
-        None (client need to reload the page)
+        dict: 200 once the change is saved, or 202 with a job ID (see /wg/jobs)
     
     """
     if not _logged_in():
@@ -255,34 +682,99 @@ def wg_edit():
 
     if not ipid:
         return jsonify({"status": 400, "message": "ID is required"}), 400
-    elif wg.fix_wireguard_pair(user, ipid, name):
-        return jsonify({"status": 200, "message": "OK"})
+    elif type(ipid) is not int:
+        return jsonify({"status": 400, "message": "ID must be an integer"}), 400
+    elif wg.fix_wireguard_pair(user, ipid, name, wait=False):
+        return _mutation_response()
     else:
         return jsonify({"status": 404, "message": "Associated Addess Not Found"}), 404
 
+@app.route('/wg/jobs/<job>', methods=['GET'])
+def wg_job(job: str):
+    """
+    Get the state of an asynchronous change
+
+    Requires: Logged in, as the user who made the change
+
+    Jobs are only known to the web process that accepted the change. With
+    several processes (WG_SHARED_STATE) the others answer 404, so poll
+    through a connection to the same process or wait for the change with
+    /wg/events or /wg/changes instead.
+
+    Args:
+        wait (float): seconds to wait for the change to be applied (long-poll, at most WG_APPLY_TIMEOUT)
+
+    Returns:
+        dict: id, state ("pending", "done", "failed" or "unknown" if it is too old to tell) and error
+    
+    """
+    if not _logged_in():
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+
+    wait = min(max(request.args.get('wait', 0, type=float), 0), settings.WG_APPLY_TIMEOUT)
+    try:
+        status = wg.job_status(job, session['email'], wait)
+    except KeyError:
+        return jsonify({"status": 404, "message": "Job Not Found"}), 404
+
+    return jsonify(_add_status({"data": status}, 200, "OK"))
+
 @app.route('/reload', methods=['GET'])
 def test():
     if request.remote_addr != "127.0.0.1":
         return jsonify({"status": 403, "message": "Forbidden"}), 403
+    _apply_app_settings(settings.load_config())
     wg.load_config()
     wg.reload()
     return jsonify({"status": 200, "message": "OK"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if request.remote_addr != "127.0.0.1":
+        return jsonify({"status": 403, "message": "Forbidden"}), 403
+    if not metrics.enabled:
+        return jsonify({"status": 404, "message": "Metrics are disabled"}), 404
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="WireGuard Manager")
-    parser.add_argument('-w', '--wgsave', action='store_true', help="Save WireGuard Manager config")
+    parser.add_argument('-w', '--wgsave', action='store_true', help="Bring the interfaces up and save their config, once before starting the web workers")
     parser.add_argument('-s', '--server', action='store_true', help="Start the WireGuard Manager server")
     parser.add_argument('-c', '--config', action='store_true', help="Open Config Manager")
+    parser.add_argument('-b', '--bulk', metavar='FILE', help="Create the peers listed in FILE (one \"user,name\" per line)")
+    parser.add_argument('-o', '--output', metavar='ZIP', default='wireguard.zip', help="Where --bulk writes the client configs")
+    parser.add_argument('-r', '--rebalance', action='store_true', help="Move peers between interfaces to match WG_PLACEMENT")
 
     args = parser.parse_args()
     settings.load_config()
+    _configure_app()
     wg.load_config()
     wg.start()
 
     if args.wgsave:
         print("Saving WireGuard Manager config")
         wg.reload()
+    elif args.rebalance:
+        moved = wg.rebalance()
+        for old, new in moved:
+            print(f"{old.user} {old.name}: {old.ip} -> {new.ip}")
+        print(f"Moved {len(moved)} peers, their owners need to download their configs again")
+    elif args.bulk:
+        peers = []
+        for line in Path(args.bulk).read_text().splitlines():
+            if not line.strip():
+                continue
+            peer_user, _, name = line.partition(',')
+            peers.append((peer_user.strip(), wg.fix_name(name.strip())))
+
+        created = wg.create_clients(peers)
+        with open(args.output, 'wb') as f:
+            for chunk in _stream_configs_zip(created):
+                f.write(chunk)
+        print(f"Created {len(created)} peers, configs written to {args.output}")
     elif args.server:
+        wg.telemetry.start()
+        wg.start_watcher()
         app.run(host="0.0.0.0", port=5000, debug=settings.DEBUG, threaded=True)
     elif args.config:
         user = None
@@ -342,11 +834,11 @@ if __name__ == "__main__":
                         print(json.dumps(wg.get_wireguard_list(user), indent=4))
                     case "4":
                         name = input("Enter peer name: ")
-                        wgpair = wg.generate_wireguard_pair(user, name)
-                        if wg.add_client(wgpair):
+                        try:
+                            wg.create_client(user, name)
                             print("Peer added successfully")
-                        else:
-                            print("Failed to add peer")
+                        except (wg.PoolExhaustedError, wg.ApplyError) as e:
+                            print(f"Failed to add peer: {e}")
                     case "5":
                             ipid = input("Enter peer ID: ")
                             if wg.remove_client(user, ipid):
@@ -368,6 +860,8 @@ if __name__ == "__main__":
             else:
                 print("Invalid choice")
 else:
+    # Web worker (app.wsgi): the bootstrap step (app.py -w) already brought the
+    # interfaces up, the peer state is loaded on the first request
     settings.load_config()
-    wg.load_config()
-    wg.start()
+    _configure_app()
+    startup['import'] = time.perf_counter() - _import_start
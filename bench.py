@@ -0,0 +1,169 @@
+"""
+Microbenchmarks for wg.py
+
+Generates a synthetic wg.json per peer count, points wg.py at a temporary
+data directory and interface config, and uses the in-memory mock backend
+from wgctl.py, so it runs on any Linux box without WireGuard or root. Results are printed (or written) as JSON so runs can be
+compared across commits.
+
+    python bench.py --peers 1000 10000 100000 --output bench.json
+"""
+from contextlib import redirect_stdout
+from pathlib import Path
+import statistics
+import ipaddress
+import threading
+import tempfile
+import argparse
+import tracemalloc
+import base64
+import random
+import time
+import json
+import sys
+import os
+
+import settings
+import wg
+
+def _key() -> str:
+    return base64.b64encode(os.urandom(32)).decode()
+
+def _setup(root: Path, peers: int, storage: str):
+    """
+    Point wg.py at `root` and write a wg.json with `peers` synthetic peers
+    """
+    dataPath = root / "data"
+    dataPath.mkdir()
+    settings.WG_ADDRESSES = "10.0.0.0/12"
+    settings.WG_STORAGE = storage
+    settings.WG_DRIFT_CHECK_INTERVAL = 0
+    settings.WG_APPLY_DELAY = 0
+    settings.METRICS_ENABLED = False
+    settings.WG_BACKEND = "mock"
+
+    wg.rootDataPath = dataPath
+    wg.configPath = dataPath / "wg.json"
+    wg.wgconfDir = root
+
+    base = int(ipaddress.ip_network(settings.WG_ADDRESSES).network_address) + 2
+    ids = random.sample(range(base, base + peers * 4), peers)
+    data = {
+        "server": {"private_key": _key(), "public_key": _key()},
+        "clients": [
+            {
+                "id": id,
+                "name": f"peer{n}",
+                "user": f"user{n % max(peers // 5, 1)}@example.com",
+                "private_key": _key(),
+                "public_key": _key(),
+                "preshared_key": _key(),
+                "ip": wg.convert_id_to_ip(id),
+            }
+            for n, id in enumerate(ids)
+        ],
+    }
+    wg.configPath.write_text(json.dumps(data, indent=4))
+
+def _timeit(func, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "mean": statistics.fmean(times), "runs": repeat}
+
+def _add_remove():
+    wgClient = wg.create_client("bench@example.com", "bench")
+    wg.remove_client(wgClient.user, wgClient.id)
+
+def _pool_used() -> int:
+    return sum(len(iface.pool) for iface in wg.interfaces)
+
+def _stress(threads: int, operations: int) -> dict:
+    """
+    Hammer add/remove/list from several threads and check the registry stays consistent
+    """
+    errors = []
+    # Let the scheduler coalesce, as it would under real load
+    wg.scheduler.delay = 0.05
+
+    def worker(n: int):
+        user = f"stress{n}@example.com"
+        try:
+            for _ in range(operations):
+                wgClient = wg.create_client(user, "stress", wait=False)
+                for peer in wg.get_wireguard_list(user):
+                    assert peer["user"] == user
+                assert wg.remove_client(user, wgClient.id, wait=False)
+        except Exception as e:
+            errors.append(repr(e))
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    wg.scheduler.flush()
+    elapsed = time.perf_counter() - start
+    wg.scheduler.delay = settings.WG_APPLY_DELAY
+
+    ids = [client.id for client in wg.clients]
+    consistent = len(ids) == len(set(ids)) == _pool_used() and not errors
+    return {"seconds": elapsed, "operations": threads * operations, "consistent": consistent, "errors": errors[:5]}
+
+def run(peers: int, repeat: int, storage: str, stress: tuple[int, int]) -> dict:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _setup(Path(tmpdir), peers, storage)
+
+        tracemalloc.start()
+        wg.load_config()
+        memory, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        sample = random.choice(list(wg.clients))
+        results = {
+            "peers": peers,
+            "storage": storage,
+            "memory_per_peer": memory / peers if peers else 0,
+            "load_peak_memory_per_peer": peak / peers if peers else 0,
+            "load_config": _timeit(wg.load_config, repeat),
+            "save_config": _timeit(wg.save_config, repeat),
+            "_save_wg_config": _timeit(lambda: wg._save_wg_config(wg.interfaces[0]), repeat),
+            "get_wireguard_list": _timeit(lambda: wg.get_wireguard_list(sample.user), repeat * 100),
+            "generate_wireguard_config": _timeit(lambda: wg.generate_wireguard_config(sample.user, sample.id), repeat * 100),
+            "generate_keys": _timeit(wg._generate_keys, repeat * 10),
+            "add_remove": _timeit(_add_remove, repeat * 10),
+            "stress": _stress(*stress),
+        }
+        return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WireGuard Manager microbenchmarks")
+    parser.add_argument('-p', '--peers', type=int, nargs='+', default=[1000, 10000, 100000], help="Peer counts to benchmark")
+    parser.add_argument('-r', '--repeat', type=int, default=5, help="Runs per measurement")
+    parser.add_argument('-s', '--storage', default="json", help="WG_STORAGE backend to benchmark")
+    parser.add_argument('--stress', type=int, nargs=2, default=[8, 10], metavar=('THREADS', 'OPS'), help="Concurrent add/remove/list threads and operations per thread")
+    parser.add_argument('-o', '--output', help="Write results to this file instead of stdout")
+
+    args = parser.parse_args()
+    results = {
+        "python": sys.version.split()[0],
+        "timestamp": time.time(),
+        "results": [],
+    }
+    # wg.py reports what it does on stdout, keep that out of the JSON
+    with redirect_stdout(sys.stderr):
+        for peers in args.peers:
+            results["results"].append(run(peers, args.repeat, args.storage, args.stress))
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    # The stress run doubles as a smoke test (tests/test_concurrency.py is the thorough one)
+    if not all(result["stress"]["consistent"] for result in results["results"]):
+        sys.exit("Stress run left the peer state inconsistent")
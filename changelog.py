@@ -0,0 +1,128 @@
+"""
+Versioned log of peer changes, for clients that sync incrementally
+
+Every change gets the next version number. Clients keep the cursor of the
+last change they saw and ask for what came after it, only their own
+peers' changes are returned. The log is bounded and lives in the process:
+a cursor from before a restart, one older than the oldest change kept or
+one that crosses a reset (the whole state was reloaded) means the client
+has to fetch the full list again.
+
+Cursors are "<epoch>.<version>", the epoch is random per log so cursors
+from a previous process are recognized.
+"""
+from collections import deque
+import threading
+import secrets
+
+class ChangeLog:
+    """
+    Bounded log of (version, user, type, data), `user` None for changes that concern everybody
+
+    Args:
+        size (int): changes kept, older ones are dropped
+    """
+    size: int
+    epoch: str
+    version: int
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self._entries: deque[tuple[int, str, str, dict]] = deque()
+        # Version up to which "applied" events were sent
+        self._applied = 0
+        self._cond = threading.Condition()
+
+    def cursor(self, version: int = None) -> str:
+        return f"{self.epoch}.{self.version if version is None else version}"
+
+    def _parse(self, cursor: str) -> int:
+        """
+        Returns:
+            int: version of the cursor, or None if it is from another epoch
+
+        Raises:
+            ValueError: Not a cursor
+        """
+        epoch, _, version = cursor.partition(".")
+        if not version.isdigit():
+            raise ValueError(f"Invalid cursor: {cursor}")
+        return int(version) if epoch == self.epoch else None
+
+    def append(self, user: str, type: str, data: dict) -> int:
+        with self._cond:
+            self.version += 1
+            self._entries.append((self.version, user, type, data))
+            while len(self._entries) > self.size:
+                self._entries.popleft()
+            self._cond.notify_all()
+            return self.version
+
+    def reset(self):
+        """
+        Record that the whole state was replaced, every client has to fetch it again
+        """
+        self.append(None, "reset", {})
+
+    def since(self, cursor: str, user: str) -> tuple[list[dict], str]:
+        """
+        Changes to `user`'s peers after `cursor`
+
+        Returns:
+            tuple[list[dict], str]: the changes (version, type and data), None if
+                the client has to fetch the full list, and the cursor to continue from
+
+        Raises:
+            ValueError: Not a cursor
+        """
+        version = self._parse(cursor) if cursor else None
+        with self._cond:
+            current = self.version
+            if version is None or version > current:
+                return None, self.cursor(current)
+            if version < current and (not self._entries or self._entries[0][0] > version + 1):
+                return None, self.cursor(current)
+
+            changes = []
+            # Clients are usually close to the head, walk back from there
+            for entry_version, entry_user, type, data in reversed(self._entries):
+                if entry_version <= version:
+                    break
+                if entry_user is None and type == "reset":
+                    return None, self.cursor(current)
+                if entry_user == user:
+                    changes.append({"version": self.cursor(entry_version), "type": type, "data": data})
+        changes.reverse()
+        return changes, self.cursor(current)
+
+    def wait(self, cursor: str, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for a change after `cursor`
+
+        Returns:
+            bool: True if there is one (for any user)
+        """
+        version = self._parse(cursor) if cursor else None
+        with self._cond:
+            if version is None:
+                return True
+            return self._cond.wait_for(lambda: self.version > version, timeout)
+
+    def mark_applied(self, version: int):
+        """
+        Tell the owners of every change up to `version` that it is live on the interfaces
+        """
+        with self._cond:
+            if version <= self._applied:
+                return
+            users = set()
+            for entry_version, entry_user, type, data in reversed(self._entries):
+                if entry_version <= self._applied:
+                    break
+                if entry_version <= version and entry_user is not None and type != "applied":
+                    users.add(entry_user)
+            self._applied = version
+            for user in sorted(users):
+                self.append(user, "applied", {"version": self.cursor(version)})
@@ -1,19 +1,120 @@
+// Private keys are never listed, they only come with the config download
 export interface Configuration {
   id: number;
   user: string;
   name: string;
-  private_key: string;
   public_key: string;
-  preshared_key: string;
   ip: string;
 }
 
-export const fetchConfigurations = async () => {
-  const res = await fetch("/api/wg/list");
+export type Change =
+  | { type: "added"; data: Configuration }
+  | { type: "removed"; data: { id: number } }
+  | { type: "renamed"; data: { id: number; name: string } }
+  | { type: "applied"; data: { version: string } };
+
+const CHANGE_TYPES = ["added", "removed", "renamed", "applied"] as const;
+const POLL_INTERVAL = 5000;
+
+// Every page of /api/wg/peers, with the version of the first one to follow the changes from.
+// `fresh` skips the HTTP cache
+export const fetchConfigurations = async (fresh = false) => {
+  const data: Configuration[] = [];
+  let version: string | undefined;
+  let cursor: string | null = null;
+  do {
+    const params = new URLSearchParams({ limit: "1000" });
+    if (cursor) params.set("cursor", cursor);
+    const res = await fetch(`/api/wg/peers?${params}`, fresh ? { cache: "no-store" } : undefined);
+    if (!res.ok) return null;
+
+    const page: { data: Configuration[]; next: string | null; version: string } = await res.json();
+    data.push(...page.data);
+    version ??= page.version;
+    cursor = page.next;
+  } while (cursor);
+  return { data, version: version as string };
+};
+
+export const fetchChanges = async (since: string) => {
+  const res = await fetch(`/api/wg/changes?since=${encodeURIComponent(since)}`);
   if (!res.ok) return null;
 
-  const { data }: { data: Configuration[] } = await res.json();
-  return data;
+  const { data, reset, version }: { data: Change[]; reset: boolean; version: string } =
+    await res.json();
+  return { changes: data, reset, version };
+};
+
+// Changes can arrive twice (stream and sync), applying one again changes nothing
+export const applyChange = (configurations: Configuration[], change: Change) => {
+  switch (change.type) {
+    case "added":
+      return [...configurations.filter(({ id }) => id !== change.data.id), change.data];
+    case "removed":
+      return configurations.filter(({ id }) => id !== change.data.id);
+    case "renamed":
+      return configurations.map((configuration) =>
+        configuration.id === change.data.id
+          ? { ...configuration, name: change.data.name }
+          : configuration
+      );
+    default:
+      return configurations;
+  }
+};
+
+// Follow the changes after `since` (the version of the list) through /api/wg/events, polling
+// /api/wg/changes when the stream is refused. `onReset` means the list has to be fetched again.
+export const subscribeChanges = (
+  since: string,
+  onChange: (change: Change) => void,
+  onReset: () => void
+) => {
+  let version = since;
+  let closed = false;
+  let timer: ReturnType<typeof setTimeout> | undefined;
+
+  const source = new EventSource(`/api/wg/events?since=${encodeURIComponent(since)}`);
+
+  const close = () => {
+    closed = true;
+    source.close();
+    clearTimeout(timer);
+  };
+
+  const sync = async () => {
+    const res = await fetchChanges(version);
+    if (closed || !res) return;
+    if (res.reset) {
+      close();
+      onReset();
+      return;
+    }
+    version = res.version;
+    res.changes.forEach(onChange);
+  };
+
+  const poll = async () => {
+    await sync();
+    if (!closed) timer = setTimeout(poll, POLL_INTERVAL);
+  };
+
+  for (const type of CHANGE_TYPES) {
+    source.addEventListener(type, (event) => {
+      version = event.lastEventId;
+      onChange({ type, data: JSON.parse(event.data) } as Change);
+    });
+  }
+  source.addEventListener("reset", () => {
+    close();
+    onReset();
+  });
+  source.onerror = () => {
+    // EventSource retries by itself, unless the server refused the stream (e.g. 503)
+    if (source.readyState === EventSource.CLOSED && !closed && timer === undefined) poll();
+  };
+
+  return { sync, close };
 };
 
 export const deleteConfiguration = async (id: number) => {
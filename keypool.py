@@ -0,0 +1,91 @@
+from cryptography.hazmat.primitives.asymmetric import x25519
+from cryptography.hazmat.primitives import serialization
+from collections import deque
+import threading
+import os
+
+def generate_keys() -> tuple[bytes, bytes, bytes]:
+    """
+    Returns:
+        tuple[bytes, bytes, bytes]: raw private key, public key and preshared key
+    """
+    key = x25519.X25519PrivateKey.generate()
+    return (
+        key.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption()),
+        key.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw),
+        os.urandom(32),
+    )
+
+class KeyPool:
+    """
+    Ready-made WireGuard keys, filled by a background thread
+
+    The worker tops the pool up to `size` whenever it drops below
+    `low_watermark`. Keys only ever live in this process' memory: a key is
+    handed out exactly once and whatever is left at exit is simply lost.
+    When the pool runs dry callers generate inline instead of waiting.
+    """
+    size: int
+    low_watermark: int
+
+    def __init__(self, size: int = 64, low_watermark: int = 16):
+        self.size = size
+        self.low_watermark = low_watermark
+        self._keys: deque[tuple[bytes, bytes, bytes]] = deque()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="wg-keypool", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while len(self._keys) < self.size:
+                self._keys.append(generate_keys())
+
+    def refill(self):
+        """
+        Wake the worker if the pool is below its low watermark
+        """
+        if self.size <= 0:
+            return
+        self._ensure_worker()
+        if len(self._keys) < self.low_watermark:
+            self._wakeup.set()
+
+    def take(self) -> tuple[bytes, bytes, bytes]:
+        """
+        Returns:
+            tuple[bytes, bytes, bytes]: raw private key, public key and preshared key
+        """
+        try:
+            keys = self._keys.popleft()
+        except IndexError:
+            keys = generate_keys()
+        self.refill()
+        return keys
+
+    def take_many(self, count: int) -> list[tuple[bytes, bytes, bytes]]:
+        """
+        Take `count` key sets, drawing from the pool first and generating the rest inline
+        """
+        keys = []
+        while len(keys) < count:
+            try:
+                keys.append(self._keys.popleft())
+            except IndexError:
+                break
+        keys += [generate_keys() for _ in range(count - len(keys))]
+        self.refill()
+        return keys
@@ -0,0 +1,132 @@
+"""
+Google sign-in helpers
+
+The client config is validated once per GOOGLE_CLIENT_SECRET, every HTTP
+call (token exchange and certificate downloads) goes through one pooled
+HTTPAdapter, and Google's signing certificates are kept for as long as
+their Cache-Control header allows.
+"""
+import settings
+
+from google_auth_oauthlib.flow import Flow
+from google.oauth2 import id_token
+from google.auth import exceptions, transport
+import google.auth.transport.requests
+import requests_oauthlib
+import requests
+import threading
+import time
+
+SCOPES = ["https://www.googleapis.com/auth/userinfo.email", "https://www.googleapis.com/auth/userinfo.profile", "openid"]
+ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+# Shared by every session so TLS connections to Google are reused across logins
+_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+# (GOOGLE_CLIENT_SECRET it was validated for, client type)
+_client_type: tuple[dict, str] = None
+
+def _mount(session: requests.Session) -> requests.Session:
+    session.mount("https://", _adapter)
+    session.mount("http://", _adapter)
+    return session
+
+def _get_client_config() -> tuple[str, dict]:
+    """
+    Returns:
+        tuple[str, dict]: client type ("web" or "installed") and the full client config
+
+    Raises:
+        ValueError: GOOGLE_CLIENT_SECRET is not a web or installed app config
+    """
+    global _client_type
+
+    cached = _client_type
+    if cached is not None and cached[0] is settings.GOOGLE_CLIENT_SECRET:
+        return cached[1], cached[0]
+
+    client_config = settings.GOOGLE_CLIENT_SECRET
+    if "web" in client_config:
+        client_type = "web"
+    elif "installed" in client_config:
+        client_type = "installed"
+    else:
+        raise ValueError("Client secrets must be for a web or installed app.")
+    if not {"client_id", "client_secret", "auth_uri", "token_uri"}.issubset(client_config[client_type]):
+        raise ValueError("Client secrets is not in the correct format.")
+
+    _client_type = (client_config, client_type)
+    return client_type, client_config
+
+def get_flow() -> Flow:
+    """
+    Same as Flow.from_client_config(), without re-validating the config and with pooled connections
+    """
+    client_type, client_config = _get_client_config()
+    oauth2session = _mount(requests_oauthlib.OAuth2Session(client_id=client_config[client_type]["client_id"], scope=SCOPES))
+    return Flow(oauth2session, client_type, client_config, redirect_uri=f"{settings.BASE_URL}/auth/callback")
+
+def _max_age(headers) -> float:
+    """
+    Seconds a response may be reused for according to Cache-Control and Age
+    """
+    max_age = 0
+    for directive in headers.get("cache-control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name in ("no-store", "no-cache"):
+            return 0
+        if name == "max-age" and value.isdigit():
+            max_age = int(value)
+    age = headers.get("age", "0")
+    return max(max_age - (int(age) if age.isdigit() else 0), 0)
+
+class CachingRequest(transport.Request):
+    """
+    google.auth transport that keeps successful GET responses for their Cache-Control max-age
+    """
+    def __init__(self, request: transport.Request):
+        self.request = request
+        # url -> (expires, response)
+        self.cache: dict[str, tuple[float, transport.Response]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET" or body is not None:
+            return self.request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        cached = self.cache.get(url)
+        if cached is not None and cached[0] > time.monotonic():
+            self.hits += 1
+            return cached[1]
+
+        # Concurrent logins after expiry share a single download
+        with self._lock:
+            cached = self.cache.get(url)
+            if cached is not None and cached[0] > time.monotonic():
+                self.hits += 1
+                return cached[1]
+
+            self.misses += 1
+            response = self.request(url, method=method, headers=headers, timeout=timeout, **kwargs)
+            max_age = _max_age({key.lower(): value for key, value in response.headers.items()})
+            if response.status == 200 and max_age > 0:
+                self.cache[url] = (time.monotonic() + max_age, response)
+            else:
+                self.cache.pop(url, None)
+            return response
+
+certs_request = CachingRequest(google.auth.transport.requests.Request(_mount(requests.Session())))
+
+def verify_id_token(token: str, audience: str) -> dict:
+    """
+    Verify a Google ID token against the cached signing certificates
+
+    Raises:
+        ValueError: The token is invalid or expired
+        google.auth.exceptions.GoogleAuthError: The token was not issued by Google
+    """
+    idinfo = id_token.verify_token(token, certs_request, audience=audience, certs_url=settings.GOOGLE_CERTS_URL)
+    if idinfo["iss"] not in ISSUERS:
+        raise exceptions.GoogleAuthError(f"Wrong issuer. 'iss' should be one of the following: {ISSUERS}")
+    return idinfo
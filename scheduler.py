@@ -0,0 +1,168 @@
+from collections import deque
+import threading
+import atexit
+import time
+
+class ApplyError(RuntimeError):
+    pass
+
+class ApplyScheduler:
+    """
+    Coalesce bursts of mutations into a single apply
+
+    Every request() returns a ticket. A background thread waits until no new
+    request arrived for `delay` seconds (but never longer than `max_delay`
+    after the oldest pending one) and then runs `apply` once for all of
+    them. wait() blocks until a ticket has been applied.
+
+    With `delay` <= 0 the apply runs inline in the requesting thread.
+    """
+    delay: float
+    max_delay: float
+
+    def __init__(self, apply, delay: float = 0.05, max_delay: float = 1.0):
+        self.delay = delay
+        self.max_delay = max_delay
+        self._apply = apply
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._applied = 0
+        self._first = None
+        self._last = None
+        self._running = False
+        self._thread = None
+        # Failed batches (first ticket, last ticket, error), the oldest are forgotten
+        self._failures: deque[tuple[int, int, Exception]] = deque(maxlen=32)
+        # Tickets up to this one may have failed in a forgotten batch
+        self._forgotten = 0
+        atexit.register(self.flush)
+
+    @property
+    def pending(self) -> bool:
+        return self._requested != self._applied
+
+    @property
+    def requested(self) -> int:
+        return self._requested
+
+    @property
+    def applied(self) -> int:
+        return self._applied
+
+    def request(self, wait: bool = False, timeout: float = None) -> int:
+        """
+        Schedule an apply
+
+        Args:
+            wait (bool): block until it is applied
+
+        Returns:
+            int: ticket to pass to wait()
+
+        Raises:
+            ApplyError: `wait` is set and the apply failed
+        """
+        with self._cond:
+            self._requested += 1
+            ticket = self._requested
+            now = time.monotonic()
+            if self._first is None:
+                self._first = now
+            self._last = now
+
+            if self.delay > 0 and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name="wg-apply", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+        if self.delay <= 0:
+            self.flush()
+        if wait:
+            # Inline the ticket is applied by now, this only raises if it failed
+            self.wait(ticket, timeout)
+        return ticket
+
+    def wait(self, ticket: int, timeout: float = None) -> bool:
+        """
+        Block until `ticket` is applied
+
+        Returns:
+            bool: False on timeout
+
+        Raises:
+            ApplyError: The batch containing `ticket` failed
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._applied >= ticket, timeout):
+                return False
+            for first, last, error in self._failures:
+                if first <= ticket <= last:
+                    raise ApplyError(str(error)) from error
+        return True
+
+    def status(self, ticket: int) -> tuple[str, str]:
+        """
+        Returns:
+            tuple[str, str]: "pending", "done", "failed" or "unknown" (too
+                old, the outcome of its batch was forgotten), and the error if its batch failed
+        """
+        with self._cond:
+            if self._applied < ticket:
+                return "pending", None
+            for first, last, error in self._failures:
+                if first <= ticket <= last:
+                    return "failed", str(error)
+            if ticket <= self._forgotten:
+                return "unknown", None
+        return "done", None
+
+    def flush(self):
+        """
+        Apply everything pending right now, in the calling thread
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not self._running)
+            if not self.pending:
+                return
+            self._start_batch()
+        self._run_batch()
+
+    def _start_batch(self):
+        self._running = True
+        self._batch = (self._applied + 1, self._requested)
+        self._first = self._last = None
+
+    def _run_batch(self):
+        first, last = self._batch
+        error = None
+        try:
+            self._apply()
+        except Exception as e:
+            print(f"Applying WireGuard changes failed: {e}")
+            error = e
+
+        with self._cond:
+            if error is not None:
+                if len(self._failures) == self._failures.maxlen:
+                    self._forgotten = self._failures[0][1]
+                self._failures.append((first, last, error))
+            self._applied = max(self._applied, last)
+            self._running = False
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.pending and not self._running)
+                while True:
+                    if not self.pending or self._running:
+                        break
+                    now = time.monotonic()
+                    deadline = min(self._last + self.delay, self._first + self.max_delay)
+                    if now >= deadline:
+                        break
+                    self._cond.wait(deadline - now)
+                if not self.pending or self._running:
+                    continue
+                self._start_batch()
+            self._run_batch()
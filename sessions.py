@@ -0,0 +1,231 @@
+"""
+Server-side Flask sessions
+
+The session cookie only carries an opaque random ID, the session data stays
+on the server in one of these stores:
+
+    MemorySessionStore  LRU dict inside the process, for a single web process
+    SQLiteSessionStore  SQLite file shared by every process on the host
+
+A session expires `ttl` seconds after it was last written. Requests that
+don't change the session don't write it back, and keeping an unchanged
+session alive costs at most one store write per `touch_interval`. The
+cookie is only sent when a session is created or dropped.
+"""
+from flask.sessions import SessionInterface, SessionMixin, SecureCookieSessionInterface
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+from collections import OrderedDict
+from pathlib import Path
+import threading
+import secrets
+import sqlite3
+import time
+
+class SessionStore:
+    """
+    Serialized session data by session ID, with an absolute expiry time
+    """
+    def load(self, sid: str, now: float) -> tuple[str, float]:
+        """
+        Returns:
+            tuple[str, float]: data and expiry time, or None if missing or expired
+        """
+        raise NotImplementedError
+
+    def save(self, sid: str, data: str, expires: float):
+        raise NotImplementedError
+
+    def touch(self, sid: str, expires: float):
+        raise NotImplementedError
+
+    def delete(self, sid: str):
+        raise NotImplementedError
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions in a dict ordered by last use, the least recently used are dropped beyond `max_entries`
+    """
+    max_entries: int
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._sessions: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def load(self, sid: str, now: float) -> tuple[str, float]:
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self._sessions[sid]
+                return None
+            self._sessions.move_to_end(sid)
+            return entry
+
+    def save(self, sid: str, data: str, expires: float):
+        with self._lock:
+            self._sessions[sid] = (data, expires)
+            self._sessions.move_to_end(sid)
+            self._evict(time.time())
+
+    def touch(self, sid: str, expires: float):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is not None:
+                self._sessions[sid] = (entry[0], expires)
+
+    def delete(self, sid: str):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def _evict(self, now: float):
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+        # Idle sessions collect at the front, drop them until a live one is found
+        while self._sessions:
+            sid, (data, expires) = next(iter(self._sessions.items()))
+            if expires > now:
+                break
+            del self._sessions[sid]
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in an SQLite database, one connection per thread
+
+    Expired rows are ignored on load and deleted at most every `prune_interval` seconds.
+    """
+    dbPath: Path
+    prune_interval: float
+
+    def __init__(self, dbPath: Path, prune_interval: float = 60):
+        self.dbPath = Path(dbPath)
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbPath, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            # Losing the last few seconds of sessions on power loss only means logging in again
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+            self._local.conn = conn
+        return conn
+
+    def load(self, sid: str, now: float) -> tuple[str, float]:
+        return self._connection().execute("SELECT data, expires FROM sessions WHERE id = ? AND expires > ?", (sid, now)).fetchone()
+
+    def save(self, sid: str, data: str, expires: float):
+        conn = self._connection()
+        conn.execute(
+            "INSERT INTO sessions (id, data, expires) VALUES (?, ?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires = excluded.expires",
+            (sid, data, expires),
+        )
+        now = time.time()
+        if now - self._last_prune > self.prune_interval:
+            self._last_prune = now
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def touch(self, sid: str, expires: float):
+        self._connection().execute("UPDATE sessions SET expires = ? WHERE id = ?", (expires, sid))
+
+    def delete(self, sid: str):
+        self._connection().execute("DELETE FROM sessions WHERE id = ?", (sid,))
+
+class ServerSession(CallbackDict, SessionMixin):
+    sid: str
+    expires: float
+
+    def __init__(self, initial: dict = None, sid: str = None, expires: float = 0.0):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.modified = False
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface storing sessions in a SessionStore
+
+    Args:
+        ttl (float): seconds a session lives after its last write
+        touch_interval (float): minimum seconds between expiry updates of an unchanged session
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store: SessionStore, ttl: float, touch_interval: float = 60):
+        self.store = store
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+
+    def open_session(self, app, request) -> ServerSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            stored = self.store.load(sid, time.time())
+            if stored is not None:
+                return ServerSession(self.serializer.loads(stored[0]), sid, stored[1])
+        # Unknown IDs are never reused, a new one is issued when the session is first written
+        return ServerSession()
+
+    def regenerate(self, session: ServerSession):
+        """
+        Move `session` to a new ID when it is saved and drop the old entry, on login
+        """
+        if session.sid is not None:
+            self.store.delete(session.sid)
+            session.sid = None
+        session.modified = True
+
+    def save_session(self, app, session: ServerSession, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app), httponly=self.get_cookie_httponly(app))
+            return
+
+        now = time.time()
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), now + self.ttl)
+            response.set_cookie(
+                name, session.sid,
+                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                domain=domain, path=path, secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app),
+            )
+            response.vary.add("Cookie")
+        elif session.modified:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)), now + self.ttl)
+        elif now + self.ttl - session.expires >= self.touch_interval:
+            self.store.touch(session.sid, now + self.ttl)
+
+def open_session_interface(kind: str, ttl: float, touch_interval: float, path: Path, max_entries: int = 10000) -> SessionInterface:
+    """
+    Get the session interface configured by SESSION_STORE
+
+    Args:
+        kind (str): "cookie" (Flask's signed cookie sessions), "memory" or "sqlite"
+        path (Path): database file of the "sqlite" store
+
+    """
+    match kind:
+        case "cookie":
+            return SecureCookieSessionInterface()
+        case "memory":
+            return ServerSessionInterface(MemorySessionStore(max_entries), ttl, touch_interval)
+        case "sqlite":
+            return ServerSessionInterface(SQLiteSessionStore(path), ttl, touch_interval)
+    raise ValueError(f"Unknown SESSION_STORE: {kind}")
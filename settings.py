@@ -8,28 +8,70 @@ DEBUG = False
 SERVER_DOMAIN = "vpn.example.com"
 SECRET_KEY = "00000000000000000000000000000000"
 LOGIN_TIME = 3600
+SESSION_STORE = "cookie"
+SESSION_DB_PATH = "/app/data/sessions.db"
+SESSION_MAX_ENTRIES = 10000
+SESSION_ACTIVITY_INTERVAL = 60
 FLOW_TIME = 300
 BASE_URL = "/api"
 
 GOOGLE_CLIENT_SECRET = {}
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
 
 ALLOWED_EMAILS = []
 ALLOWED_DOMAINS = []
+ADMIN_EMAILS = []
 
 WG_ALLOWED_IPS = []
 WG_PERSISTENT_KEEPALIVE = 0
 WG_SERVER_PORT = 51820
 WG_ADDRESSES = "192.168.0.0/24"
+WG_INTERFACES = []
+WG_PLACEMENT = "affinity"
 WG_DNS = ""
+WG_RESERVED_ADDRESSES = []
+WG_ADDRESS_ALLOCATION = "random"
+WG_DRIFT_CHECK_INTERVAL = 300
+WG_APPLY_DELAY = 0.05
+WG_APPLY_MAX_DELAY = 1.0
+WG_APPLY_TIMEOUT = 30
+WG_ASYNC_MUTATIONS = False
+WG_STORAGE = "json"
+WG_JOURNAL_COMPACT = 1000
+WG_SHARED_STATE = False
+WG_KEY_POOL_SIZE = 64
+WG_KEY_POOL_LOW_WATERMARK = 16
+WG_BULK_LIMIT = 1000
+WG_CONFIG_CACHE_SIZE = 10000
+WG_TELEMETRY_COMMAND = ""
+WG_TELEMETRY_INTERVAL = 10
+WG_TELEMETRY_SAMPLES = 60
+METRICS_ENABLED = False
+WG_BACKEND = "helper"
+WG_HELPER_SOCKET = "/run/wg-manager/wg.sock"
+WG_WATCH = "auto"
+WG_WATCH_DEBOUNCE = 0.5
+WG_WATCH_POLL_INTERVAL = 2
+WG_CHANGE_LOG_SIZE = 10000
+WG_EVENTS_TIMEOUT = 300
+WG_EVENTS_MAX_STREAMS = 8
 
 
 
-def load_config():
+def load_config() -> set[str]:
+    """
+    Returns:
+        set[str]: names of the settings whose value changed
+    """
     global configPath
 
     if not configPath.exists():
         raise FileNotFoundError("Config file not found.\n> data/config.json")
 
     data = json.loads(configPath.read_text())
+    changed = set()
     for key, value in data.items():
+        if globals().get(key) != value:
+            changed.add(key)
         globals()[key] = value
+    return changed
@@ -0,0 +1,592 @@
+from contextlib import contextmanager
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+import threading
+import tempfile
+import sqlite3
+import fcntl
+import json
+import os
+import re
+
+def atomic_write(path: Path, data: str | Iterable[str]):
+    """
+    Replace `path` with `data` without ever leaving a partial file behind
+
+    Writes to a temp file in the same directory, fsyncs it, renames it over
+    the target and fsyncs the directory so the rename itself is durable.
+    `data` may also be an iterable of chunks, streamed in order.
+    """
+    # Unique per writer, processes sharing the state may write the same file at once
+    fd, tmpPath = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    tmpPath = Path(tmpPath)
+    try:
+        with os.fdopen(fd, "w") as f:
+            if isinstance(data, str):
+                f.write(data)
+            else:
+                f.writelines(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+    except BaseException:
+        tmpPath.unlink(missing_ok=True)
+        raise
+    _fsync_dir(path.parent)
+
+def durable_append(path: Path, lines: Iterable[str]):
+    """
+    Append `lines` to `path` and fsync it, creating it readable by the owner only
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+    with os.fdopen(fd, "a") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _file_signature(path: Path) -> tuple:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+def _fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters a number can go on with, "1." or "1.5e" decode as a shorter number
+_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+_decoder = json.JSONDecoder()
+
+class JsonStream:
+    """
+    Incremental reader of a JSON text, decoding one value at a time
+
+    Only the current chunk and the value being decoded are held in memory,
+    so arrays of any length can be walked element by element.
+    """
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        # Characters of the text before buf
+        self.offset = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _error(self, message: str, pos: int) -> ValueError:
+        return ValueError(f"Invalid JSON at character {self.offset + pos}: {message}")
+
+    def peek(self) -> str:
+        """
+        Next non-whitespace character, "" at the end of the text
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise self._error(f"Expecting {char!r}", self.pos)
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise self._error(e.msg, e.pos) from None
+            else:
+                # A number running to the end of the chunk may continue in the next one
+                if self.eof or not isinstance(value, (int, float)) or _NUMBER_TAIL.match(self.buf, end).end() < len(self.buf):
+                    self.pos = end
+                    return value
+            self._fill()
+
+    def items(self) -> Iterator[str]:
+        """
+        Keys of the object starting here, the caller reads each value before asking for the next key
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("}")
+            return
+
+    def elements(self) -> Iterator:
+        """
+        Values of the array starting here
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ",":
+                self.pos += 1
+                continue
+            self.expect("]")
+            return
+
+class Storage:
+    """
+    Persistence backend for the WireGuard peer state
+
+    load() and save() work on the wg.json document ({"server": ..., "clients": [...]}).
+    put() and delete() record single peer changes, commit() makes every
+    recorded change durable at once.
+    """
+    path: Path
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._pending: dict[int, dict] = {}
+        self._signature = None
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    @property
+    def pending_ids(self) -> set[int]:
+        """
+        Peers with recorded changes not committed yet
+        """
+        return set(self._pending)
+
+    def files(self) -> list[Path]:
+        """
+        Files holding the state
+        """
+        return [self.path]
+
+    def _mark(self):
+        # Called after every load and write, so only edits by others show up in modified()
+        self._signature = tuple(_file_signature(path) for path in self.files())
+
+    def modified(self) -> bool:
+        """
+        True if the files changed since this object last read or wrote them
+        """
+        return tuple(_file_signature(path) for path in self.files()) != self._signature
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def iter_load(self) -> tuple[dict, Iterator[dict]]:
+        """
+        Same as load(), with the peers read one at a time
+
+        Returns:
+            tuple[dict, Iterator[dict]]: server keys and the stored peers
+        """
+        data = self.load()
+        return data["server"], iter(data["clients"])
+
+    def save(self, data: dict):
+        """
+        Write a full snapshot and drop any recorded changes
+        """
+        raise NotImplementedError
+
+    def put(self, client: dict):
+        self._pending[client["id"]] = client
+
+    def delete(self, id: int):
+        self._pending[id] = None
+
+    def commit(self, snapshot):
+        """
+        Persist recorded changes
+
+        Args:
+            snapshot (callable): returns the full document, for backends that can only write snapshots
+        """
+        raise NotImplementedError
+
+class JsonStorage(Storage):
+    """
+    The whole state in one wg.json file, rewritten atomically on every commit
+    """
+    def load(self) -> dict:
+        data = json.loads(self.path.read_text())
+        self._mark()
+        return data
+
+    def iter_load(self) -> tuple[dict, Iterator[dict]]:
+        """
+        Stream wg.json: only the current peer is parsed at any time instead of the whole document
+        """
+        self._mark()
+        f = self.path.open()
+        try:
+            stream = JsonStream(f)
+            keys = stream.items()
+            server = None
+            clients = []
+            for key in keys:
+                if key == "clients" and server is not None:
+                    return server, self._iter_clients(f, stream, keys)
+                elif key == "clients":
+                    # Written by something else with the peers first, they have to wait for the keys
+                    clients = stream.value()
+                elif key == "server":
+                    server = stream.value()
+                else:
+                    stream.value()
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+        if server is None:
+            raise ValueError(f"No server keys in {self.path}")
+        return server, iter(clients)
+
+    def _iter_clients(self, f, stream: JsonStream, keys: Iterator[str]) -> Iterator[dict]:
+        with f:
+            yield from stream.elements()
+            # Check the rest of the document is well-formed too
+            for key in keys:
+                stream.value()
+
+    def save(self, data: dict):
+        atomic_write(self.path, json.dumps(data, indent=4))
+        self._pending.clear()
+        self._mark()
+
+    def commit(self, snapshot):
+        if self._pending:
+            self.save(snapshot())
+
+class JournalStorage(JsonStorage):
+    """
+    wg.json snapshot plus an append-only journal of peer changes
+
+    Each commit appends one JSON line per changed peer and fsyncs, so a
+    write costs O(changes) instead of O(peers). Once the journal holds
+    `compact_after` entries it is folded into a fresh snapshot.
+    """
+    journalPath: Path
+    compact_after: int
+
+    def __init__(self, path: Path, compact_after: int = 1000):
+        super().__init__(path)
+        self.journalPath = path.with_suffix(".journal")
+        self.compact_after = compact_after
+        self._entries = 0
+
+    def files(self) -> list[Path]:
+        return [self.path, self.journalPath]
+
+    def _read_journal(self) -> dict[int, dict]:
+        """
+        Peer changes recorded since the snapshot, by id (None for deleted peers)
+        """
+        changes = {}
+        self._entries = 0
+        if not self.journalPath.exists():
+            return changes
+        # Bytes up to the end of the last complete entry
+        good = 0
+        torn = False
+        with self.journalPath.open("rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Unterminated entry")
+                    entry = json.loads(line)
+                except ValueError:
+                    torn = True
+                    break
+                if entry["op"] == "put":
+                    changes[entry["client"]["id"]] = entry["client"]
+                elif entry["op"] == "delete":
+                    changes[entry["id"]] = None
+                self._entries += 1
+                good += len(line)
+        if torn:
+            # Torn write from a crash, cut it off or every entry appended after it would be lost on the next load
+            self._truncate(good)
+        return changes
+
+    def _truncate(self, size: int):
+        fd = os.open(self.journalPath, os.O_WRONLY | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            os.fchmod(fd, 0o600)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def load(self) -> dict:
+        data = super().load()
+        clients = {client["id"]: client for client in data["clients"]}
+        for id, client in self._read_journal().items():
+            if client is None:
+                clients.pop(id, None)
+            else:
+                clients[id] = client
+
+        data["clients"] = list(clients.values())
+        self._mark()
+        return data
+
+    def iter_load(self) -> tuple[dict, Iterator[dict]]:
+        changes = self._read_journal()
+        server, clients = super().iter_load()
+        return server, self._replay(clients, changes)
+
+    def _replay(self, clients: Iterator[dict], changes: dict[int, dict]) -> Iterator[dict]:
+        for client in clients:
+            if client["id"] in changes:
+                client = changes.pop(client["id"])
+                if client is None:
+                    continue
+            yield client
+        # Peers added after the snapshot
+        for client in changes.values():
+            if client is not None:
+                yield client
+
+    def save(self, data: dict):
+        super().save(data)
+        # A crash before this truncate only replays entries the snapshot already contains
+        self._truncate(0)
+        self._entries = 0
+        self._mark()
+
+    def commit(self, snapshot):
+        if not self._pending:
+            return
+        if self._entries + len(self._pending) >= self.compact_after:
+            self.save(snapshot())
+            return
+
+        lines = []
+        for id, client in self._pending.items():
+            if client is None:
+                lines.append(json.dumps({"op": "delete", "id": id}))
+            else:
+                lines.append(json.dumps({"op": "put", "client": client}))
+
+        fd = os.open(self.journalPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, ("\n".join(lines) + "\n").encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._entries += len(lines)
+        self._pending.clear()
+        self._mark()
+
+class SqliteStorage(Storage):
+    """
+    SQLite database next to wg.json, one row per peer
+
+    An existing wg.json is imported on first use and kept as wg.json.bak.
+    """
+    dbPath: Path
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.dbPath = path.with_suffix(".db")
+
+    def files(self) -> list[Path]:
+        return [self.dbPath, self.dbPath.with_name(f"{self.dbPath.name}-wal")]
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.dbPath)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = FULL")
+        conn.execute("CREATE TABLE IF NOT EXISTS server (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS clients (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER NOT NULL UNIQUE,
+            user TEXT NOT NULL,
+            name TEXT,
+            private_key TEXT NOT NULL,
+            public_key TEXT NOT NULL,
+            preshared_key TEXT NOT NULL
+        )""")
+        return conn
+
+    def exists(self) -> bool:
+        if not self.dbPath.exists() and self.path.exists():
+            self.save(json.loads(self.path.read_text()))
+            self.path.rename(self.path.with_suffix(".json.bak"))
+        return self.dbPath.exists()
+
+    def load(self) -> dict:
+        conn = self._connect()
+        try:
+            server = dict(conn.execute("SELECT key, value FROM server"))
+            rows = conn.execute("SELECT id, user, name, private_key, public_key, preshared_key FROM clients ORDER BY seq")
+            clients = [
+                {"id": row[0], "user": row[1], "name": row[2], "private_key": row[3], "public_key": row[4], "preshared_key": row[5]}
+                for row in rows
+            ]
+        finally:
+            conn.close()
+        self._mark()
+        return {"server": server, "clients": clients}
+
+    def iter_load(self) -> tuple[dict, Iterator[dict]]:
+        conn = self._connect()
+        try:
+            server = dict(conn.execute("SELECT key, value FROM server"))
+        except BaseException:
+            conn.close()
+            raise
+        return server, self._iter_clients(conn)
+
+    def _iter_clients(self, conn: sqlite3.Connection) -> Iterator[dict]:
+        try:
+            for row in conn.execute("SELECT id, user, name, private_key, public_key, preshared_key FROM clients ORDER BY seq"):
+                yield {"id": row[0], "user": row[1], "name": row[2], "private_key": row[3], "public_key": row[4], "preshared_key": row[5]}
+        finally:
+            conn.close()
+        self._mark()
+
+    def _upsert(self, conn: sqlite3.Connection, clients: list[dict]):
+        conn.executemany(
+            """INSERT INTO clients (id, user, name, private_key, public_key, preshared_key)
+            VALUES (:id, :user, :name, :private_key, :public_key, :preshared_key)
+            ON CONFLICT(id) DO UPDATE SET user = excluded.user, name = excluded.name, private_key = excluded.private_key,
+                public_key = excluded.public_key, preshared_key = excluded.preshared_key""",
+            clients,
+        )
+
+    def save(self, data: dict):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM server")
+                conn.executemany("INSERT INTO server (key, value) VALUES (?, ?)", data["server"].items())
+                conn.execute("DELETE FROM clients")
+                self._upsert(conn, data["clients"])
+        finally:
+            conn.close()
+        self._pending.clear()
+        self._mark()
+
+    def commit(self, snapshot):
+        if not self._pending:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                self._upsert(conn, [client for client in self._pending.values() if client is not None])
+                conn.executemany("DELETE FROM clients WHERE id = ?", [(id,) for id, client in self._pending.items() if client is None])
+        finally:
+            conn.close()
+        self._pending.clear()
+        self._mark()
+
+def open_storage(kind: str, path: Path, compact_after: int = 1000) -> Storage:
+    """
+    Get the storage backend configured by WG_STORAGE
+
+    Args:
+        kind (str): "json", "journal" or "sqlite"
+        path (Path): wg.json path, the other backends keep their files next to it
+    """
+    match kind:
+        case "json":
+            return JsonStorage(path)
+        case "journal":
+            return JournalStorage(path, compact_after)
+        case "sqlite":
+            return SqliteStorage(path)
+    raise ValueError(f"Unknown WG_STORAGE backend: {kind}")
+
+class SharedState:
+    """
+    Generation stamp and inter-process write lock for a store shared by several processes
+
+    Writers hold lock() while they mutate and bump() the generation before
+    releasing it. Readers call changed(), a single stat() of the stamp file,
+    and only re-read the store when it reports a new generation.
+    """
+    genPath: Path
+    lockPath: Path
+    generation: int
+
+    def __init__(self, path: Path):
+        self.genPath = path.with_suffix(".gen")
+        self.lockPath = path.with_suffix(".lock")
+        self.generation = 0
+        self._stat = None
+        self._fd = None
+        self._depth = 0
+        self._thread_lock = threading.RLock()
+
+    @contextmanager
+    def lock(self):
+        with self._thread_lock:
+            if self._depth == 0:
+                self._fd = os.open(self.lockPath, os.O_RDWR | os.O_CREAT, 0o600)
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                    os.close(self._fd)
+                    self._fd = None
+
+    def _signature(self):
+        return _file_signature(self.genPath)
+
+    def changed(self) -> bool:
+        return self._signature() != self._stat
+
+    def read(self) -> int:
+        self._stat = self._signature()
+        try:
+            return int(self.genPath.read_text() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self) -> int:
+        """
+        Publish a new generation, call while holding lock()
+        """
+        self.generation = self.read() + 1
+        atomic_write(self.genPath, str(self.generation))
+        self._stat = self._signature()
+        return self.generation
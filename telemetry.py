@@ -0,0 +1,175 @@
+from array import array
+import subprocess
+import threading
+import shlex
+import time
+
+class PeerSamples:
+    """
+    Fixed-size ring buffer of (time, rx, tx, handshake) samples for one peer
+    """
+    __slots__ = ("time", "rx", "tx", "handshake", "endpoint", "pos", "count")
+
+    def __init__(self, size: int):
+        self.time = array("d", bytes(8 * size))
+        self.rx = array("Q", bytes(8 * size))
+        self.tx = array("Q", bytes(8 * size))
+        self.handshake = array("q", bytes(8 * size))
+        self.endpoint = None
+        self.pos = 0
+        self.count = 0
+
+    def add(self, now: float, rx: int, tx: int, handshake: int, endpoint: str):
+        self.time[self.pos] = now
+        self.rx[self.pos] = rx
+        self.tx[self.pos] = tx
+        self.handshake[self.pos] = handshake
+        self.endpoint = endpoint
+        self.pos = (self.pos + 1) % len(self.time)
+        self.count = min(self.count + 1, len(self.time))
+
+    def _index(self, back: int) -> int:
+        return (self.pos - 1 - back) % len(self.time)
+
+    def rate(self, counter: array, window: int = 1) -> float:
+        """
+        Bytes per second over the last `window` sample intervals
+        """
+        window = min(window, self.count - 1)
+        if window <= 0:
+            return 0.0
+        last, first = self._index(0), self._index(window)
+        elapsed = self.time[last] - self.time[first]
+        delta = counter[last] - counter[first]
+        # Counters restart from zero when the interface is recreated
+        if elapsed <= 0 or delta < 0:
+            return 0.0
+        return delta / elapsed
+
+    def latest(self, window: int = 1) -> dict:
+        last = self._index(0)
+        return {
+            "endpoint": self.endpoint,
+            "latest_handshake": self.handshake[last],
+            "rx": self.rx[last],
+            "tx": self.tx[last],
+            "rx_rate": self.rate(self.rx, window),
+            "tx_rate": self.rate(self.tx, window),
+            "sampled_at": self.time[last],
+        }
+
+def parse_dump(output: str):
+    """
+    Parse `wg show <interface> dump`
+
+    Yields:
+        tuple[str, str, int, int, int]: public key, endpoint, latest handshake, rx bytes, tx bytes
+    """
+    lines = output.splitlines()
+    # The first line describes the interface itself
+    for line in lines[1:]:
+        fields = line.split("\t")
+        if len(fields) < 8:
+            continue
+        endpoint = fields[2] if fields[2] != "(none)" else None
+        yield fields[0], endpoint, int(fields[4]), int(fields[5]), int(fields[6])
+
+class TelemetryCollector:
+    """
+    Poll `wg show <interface> dump` and keep per-peer samples in ring buffers
+
+    Memory stays bounded: each peer gets one fixed-size buffer and peers that
+    disappear from the dump are dropped on the next poll.
+
+    With an empty `command` the dump comes from `source`, a callable
+    returning an object with code, stdout and stderr.
+    """
+    command: str
+    interval: float
+    samples: int
+    online_after: int
+
+    def __init__(self, command: str, interval: float = 10, samples: int = 60, online_after: int = 180):
+        self.command = command
+        self.interval = interval
+        self.samples = samples
+        self.online_after = online_after
+        self.source = None
+        self.peers: dict[str, PeerSamples] = {}
+        self.last_poll = 0.0
+        self.last_error = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="wg-telemetry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(self.interval)
+
+    def poll(self) -> bool:
+        if not self.command and self.source is not None:
+            result = self.source()
+            code, stdout, stderr = result.code, result.stdout, result.stderr
+        else:
+            try:
+                result = subprocess.run(shlex.split(self.command), capture_output=True, text=True, timeout=max(self.interval, 5))
+            except (OSError, subprocess.TimeoutExpired) as e:
+                self.last_error = str(e)
+                return False
+            code, stdout, stderr = result.returncode, result.stdout, result.stderr
+
+        if code != 0:
+            self.last_error = stderr.strip() or f"exit status {code}"
+            return False
+
+        self.record(stdout)
+        return True
+
+    def record(self, output: str, now: float = None):
+        now = time.time() if now is None else now
+        peers = {}
+        for public_key, endpoint, handshake, rx, tx in parse_dump(output):
+            samples = self.peers.get(public_key)
+            if samples is None or len(samples.time) != self.samples:
+                samples = PeerSamples(self.samples)
+            samples.add(now, rx, tx, handshake, endpoint)
+            peers[public_key] = samples
+
+        self.peers = peers
+        self.last_poll = now
+        self.last_error = None
+
+    def peer_stats(self, public_key: str, window: int = 1) -> dict:
+        samples = self.peers.get(public_key)
+        if samples is None:
+            return None
+        stats = samples.latest(window)
+        stats["online"] = stats["latest_handshake"] > 0 and self.last_poll - stats["latest_handshake"] < self.online_after
+        return stats
+
+    def summary(self, public_keys=None, window: int = 1) -> dict:
+        """
+        Totals over `public_keys` (every known peer by default)
+        """
+        data = {"peers": 0, "online": 0, "rx": 0, "tx": 0, "rx_rate": 0.0, "tx_rate": 0.0}
+        for public_key in self.peers if public_keys is None else public_keys:
+            stats = self.peer_stats(public_key, window)
+            if stats is None:
+                continue
+            data["peers"] += 1
+            data["online"] += stats["online"]
+            for key in ("rx", "tx", "rx_rate", "tx_rate"):
+                data[key] += stats[key]
+        data["sampled_at"] = self.last_poll
+        data["error"] = self.last_error
+        return data
@@ -0,0 +1,62 @@
+"""
+AddressPool allocation, release and reuse
+"""
+import ipaddress
+import unittest
+
+from allocator import AddressPool, PoolExhaustedError
+
+class AddressPoolTest(unittest.TestCase):
+    def test_exhaustion(self):
+        pool = AddressPool("10.0.0.0/29")
+        # Network, server and broadcast addresses are never handed out
+        ids = [pool.allocate() for _ in range(5)]
+        self.assertEqual([str(ipaddress.ip_address(id)) for id in ids], [f"10.0.0.{n}" for n in range(2, 7)])
+        self.assertEqual(pool.free, 0)
+        with self.assertRaises(PoolExhaustedError):
+            pool.allocate()
+
+    def test_release_and_reuse(self):
+        pool = AddressPool("10.0.0.0/29")
+        ids = [pool.allocate() for _ in range(5)]
+        self.assertTrue(pool.release(ids[1]))
+        self.assertFalse(pool.release(ids[1]))
+        self.assertNotIn(ids[1], pool)
+        self.assertEqual(pool.allocate(), ids[1])
+        self.assertIn(ids[1], pool)
+        self.assertFalse(pool.claim(ids[1]))
+
+    def test_reserved_addresses(self):
+        pool = AddressPool("10.0.0.0/28", ["10.0.0.2-10.0.0.4", "10.0.0.8/30"])
+        ids = {str(ipaddress.ip_address(pool.allocate())) for _ in range(pool.free)}
+        self.assertEqual(ids, {"10.0.0.5", "10.0.0.6", "10.0.0.7", "10.0.0.12", "10.0.0.13", "10.0.0.14"})
+        self.assertFalse(pool.release(int(ipaddress.ip_address("10.0.0.3"))))
+
+    def test_random_mode_never_hands_out_an_address_twice(self):
+        pool = AddressPool("10.0.0.0/27", randomize=True)
+        held = set()
+        for round in range(2000):
+            if pool.free and (round % 3 or not held):
+                id = pool.allocate()
+                self.assertNotIn(id, held)
+                held.add(id)
+            else:
+                self.assertTrue(pool.release(held.pop()))
+            self.assertEqual(len(pool), len(held))
+        self.assertLessEqual(len(pool._released), pool.size)
+
+    def test_ipv6(self):
+        pool = AddressPool("fd00::/125")
+        ids = [pool.allocate() for _ in range(6)]
+        self.assertEqual(str(ipaddress.IPv6Address(ids[0])), "fd00::2")
+        self.assertEqual(str(ipaddress.IPv6Address(ids[-1])), "fd00::7")
+        with self.assertRaises(PoolExhaustedError):
+            pool.allocate()
+
+        # Pools larger than MAX_SIZE only manage their first addresses
+        large = AddressPool("fd00::/64")
+        self.assertEqual(large.size, AddressPool.MAX_SIZE)
+        self.assertEqual(large.allocate(), int(ipaddress.IPv6Address("fd00::2")))
+
+if __name__ == "__main__":
+    unittest.main()
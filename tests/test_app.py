@@ -0,0 +1,91 @@
+"""
+HTTP API through Flask's test client, on the mock backend
+"""
+from contextlib import redirect_stdout
+from pathlib import Path
+import unittest
+import importlib
+import tempfile
+import time
+import io
+
+import settings
+import wg
+
+USER = "user@example.com"
+
+class AppTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        root = Path(cls.tmpdir.name)
+        settings.WG_ADDRESSES = "10.0.0.0/24"
+        settings.WG_INTERFACES = []
+        settings.WG_STORAGE = "json"
+        settings.WG_SHARED_STATE = False
+        settings.WG_BACKEND = "mock"
+        settings.WG_DRIFT_CHECK_INTERVAL = 0
+        settings.WG_APPLY_DELAY = 0
+        settings.METRICS_ENABLED = False
+        settings.ADMIN_EMAILS = []
+        wg.rootDataPath = root
+        wg.configPath = root / "wg.json"
+        wg.wgconfDir = root
+        # app reads config.json at import, like a web worker
+        settings.configPath = root / "config.json"
+        settings.configPath.write_text("{}")
+        cls.app = importlib.import_module("app").app
+        cls.app.testing = True
+
+    @classmethod
+    def tearDownClass(cls):
+        wg.scheduler.flush()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        wg.configPath.unlink(missing_ok=True)
+        self.output = io.StringIO()
+        with redirect_stdout(self.output):
+            wg.load_config()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            now = time.time()
+            session.update(email=USER, idinfo={}, login_time=now, act_time=now, picture=None)
+
+    def post(self, path: str, body):
+        with redirect_stdout(self.output):
+            return self.client.post(path, json=body)
+
+    def test_peer_ids_must_be_integers(self):
+        with redirect_stdout(self.output):
+            peer = wg.create_client(USER, "a")
+        for path in ("/wg/remove", "/wg/edit"):
+            for id in ([1], {"id": 1}, str(peer.id), 1.5, True):
+                response = self.post(path, {"id": id, "name": "b"})
+                self.assertEqual(response.status_code, 400, (path, id))
+            self.assertEqual(self.post(path, {"id": peer.id + 1, "name": "b"}).status_code, 404)
+
+        self.assertIn(self.post("/wg/edit", {"id": peer.id, "name": "b"}).status_code, (200, 202))
+        self.assertIn(self.post("/wg/remove", {"id": peer.id}).status_code, (200, 202))
+        self.assertNotIn(peer.id, wg.clients)
+
+    def test_lists_and_changes_leave_out_private_keys(self):
+        with redirect_stdout(self.output):
+            version = self.client.get("/wg/peers").json["version"]
+            peer = wg.create_client(USER, "a")
+            listed = self.client.get("/wg/list").json["data"]
+            page = self.client.get("/wg/peers").json
+            changes = self.client.get("/wg/changes", query_string={"since": version}).json["data"]
+
+        for data in (listed, page["data"], [change["data"] for change in changes if change["type"] == "added"]):
+            self.assertEqual([peer["id"] for peer in data], [peer.id])
+            self.assertNotIn("private_key", data[0])
+            self.assertNotIn("preshared_key", data[0])
+        self.assertEqual(page["data"][0]["public_key"], peer.public_key)
+
+        with redirect_stdout(self.output):
+            config = self.client.get("/wg/download", query_string={"id": peer.id})
+        self.assertIn(peer.private_key, config.get_data(as_text=True))
+
+if __name__ == "__main__":
+    unittest.main()
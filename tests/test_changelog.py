@@ -0,0 +1,98 @@
+"""
+ChangeLog cursors: incremental reads, resets and waiting for changes
+"""
+import unittest
+import threading
+import time
+
+from changelog import ChangeLog
+
+A = "a@example.com"
+B = "b@example.com"
+
+class ChangeLogTest(unittest.TestCase):
+    def test_changes_after_the_cursor(self):
+        log = ChangeLog()
+        start = log.cursor()
+        log.append(A, "added", {"id": 1})
+        log.append(B, "added", {"id": 2})
+        middle = log.cursor()
+        log.append(A, "renamed", {"id": 1, "name": "x"})
+
+        changes, cursor = log.since(start, A)
+        self.assertEqual([(change["type"], change["data"]["id"]) for change in changes], [("added", 1), ("renamed", 1)])
+        self.assertEqual(changes[-1]["version"], cursor)
+        self.assertEqual(log.since(start, B)[0], [{"version": log.cursor(2), "type": "added", "data": {"id": 2}}])
+        self.assertEqual(len(log.since(middle, A)[0]), 1)
+        self.assertEqual(log.since(middle, B), ([], cursor))
+        # Nothing new at the head
+        self.assertEqual(log.since(cursor, A), ([], cursor))
+
+    def test_cursors_that_need_a_full_fetch(self):
+        log = ChangeLog()
+        log.append(A, "added", {"id": 1})
+        head = log.cursor()
+        for cursor in (None, "", f"{ChangeLog().epoch}.1", log.cursor(5)):
+            self.assertEqual(log.since(cursor, A), (None, head), cursor)
+        for cursor in ("nonsense", f"{log.epoch}.-1", f"{log.epoch}.x"):
+            with self.assertRaises(ValueError, msg=cursor):
+                log.since(cursor, A)
+
+    def test_cursor_older_than_the_log(self):
+        log = ChangeLog(size=3)
+        start = log.cursor()
+        for id in range(5):
+            log.append(A, "added", {"id": id})
+        self.assertEqual(log.since(start, A), (None, log.cursor()))
+        self.assertIsNone(log.since(log.cursor(1), A)[0])
+        # The oldest change kept is version 3, a client at version 2 misses nothing
+        self.assertEqual([change["data"]["id"] for change in log.since(log.cursor(2), A)[0]], [2, 3, 4])
+
+    def test_reset_invalidates_older_cursors(self):
+        log = ChangeLog()
+        log.append(A, "added", {"id": 1})
+        before = log.cursor()
+        log.reset()
+        after = log.cursor()
+        log.append(A, "added", {"id": 2})
+
+        self.assertEqual(log.since(before, A), (None, log.cursor()))
+        self.assertEqual(log.since(before, B), (None, log.cursor()))
+        self.assertEqual([change["data"]["id"] for change in log.since(after, A)[0]], [2])
+
+    def test_wait(self):
+        log = ChangeLog()
+        cursor = log.cursor()
+        self.assertFalse(log.wait(cursor, 0.01))
+        self.assertTrue(log.wait(None, 0))
+        self.assertTrue(log.wait(f"{ChangeLog().epoch}.0", 0))
+
+        threading.Timer(0.05, log.append, (B, "added", {"id": 1})).start()
+        started = time.monotonic()
+        self.assertTrue(log.wait(cursor, 5))
+        self.assertLess(time.monotonic() - started, 4)
+
+    def test_mark_applied_notifies_each_owner_once(self):
+        log = ChangeLog()
+        start = log.cursor()
+        log.append(A, "added", {"id": 1})
+        log.append(A, "added", {"id": 2})
+        log.append(B, "removed", {"id": 3})
+        log.append(None, "server", {})
+        applied = log.version
+        log.append(B, "added", {"id": 4})
+
+        log.mark_applied(applied)
+        log.mark_applied(applied)
+        for user in (A, B):
+            events = [change for change in log.since(start, user)[0] if change["type"] == "applied"]
+            self.assertEqual([event["data"] for event in events], [{"version": log.cursor(applied)}], user)
+
+        # Only changes after the last applied version are announced next time
+        log.mark_applied(log.version)
+        events = [change for change in log.since(start, A)[0] if change["type"] == "applied"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(len([change for change in log.since(start, B)[0] if change["type"] == "applied"]), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Stress wg.py writers and readers from many threads
+
+Uses the in-memory mock backend and a temporary data directory, like bench.py.
+"""
+from contextlib import redirect_stdout
+from pathlib import Path
+import unittest
+import threading
+import tempfile
+import json
+import io
+
+import settings
+import wg
+
+THREADS = 16
+OPERATIONS = 40
+
+class ConcurrencyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        root = Path(cls.tmpdir.name)
+        settings.WG_ADDRESSES = "10.0.0.0/22"
+        settings.WG_INTERFACES = []
+        settings.WG_ADDRESS_ALLOCATION = "random"
+        settings.WG_STORAGE = "json"
+        settings.WG_SHARED_STATE = False
+        settings.WG_BACKEND = "mock"
+        settings.WG_DRIFT_CHECK_INTERVAL = 0
+        # Let the scheduler coalesce, as it would under real load
+        settings.WG_APPLY_DELAY = 0.01
+        settings.METRICS_ENABLED = False
+        wg.rootDataPath = root
+        wg.configPath = root / "wg.json"
+        wg.wgconfDir = root
+
+    @classmethod
+    def tearDownClass(cls):
+        wg.scheduler.flush()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        wg.configPath.unlink(missing_ok=True)
+        with redirect_stdout(io.StringIO()):
+            wg.load_config()
+
+    def _run(self, target, threads: int = THREADS) -> list[str]:
+        errors = []
+
+        def run(n: int):
+            try:
+                target(n)
+            except Exception as e:
+                errors.append(f"thread {n}: {e!r}")
+
+        workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        wg.scheduler.flush()
+        return errors
+
+    def assertConsistent(self):
+        ids = [client.id for client in wg.clients]
+        self.assertEqual(len(ids), len(set(ids)), "duplicate peer IDs")
+        self.assertEqual(len({client.public_key for client in wg.clients}), len(ids), "duplicate public keys")
+
+        # Every peer holds its address and no other address is taken
+        for client in wg.clients:
+            self.assertIn(client.id, wg.interface_of(client.id).pool)
+        self.assertEqual(sum(len(iface.pool) for iface in wg.interfaces), len(ids))
+
+        # The per-user index matches the peers
+        self.assertEqual(sum(len(bucket) for bucket in wg.clients.by_user.values()), len(ids))
+        for client in wg.clients:
+            self.assertIs(wg.clients.by_user[client.user][client.id], client)
+
+        # Everything was persisted
+        stored = json.loads(wg.configPath.read_text())["clients"]
+        self.assertEqual(sorted(client["id"] for client in stored), sorted(ids))
+
+    def test_add_remove_list(self):
+        stop = threading.Event()
+        kept = [[] for _ in range(THREADS)]
+
+        def writer(n: int):
+            user = f"stress{n}@example.com"
+            for op in range(OPERATIONS):
+                wgClient = wg.create_client(user, f"peer{op}", wait=False)
+                listed = wg.get_wireguard_list(user)
+                self.assertIn(wgClient.id, {peer["id"] for peer in listed})
+                self.assertTrue(all(peer["user"] == user for peer in listed))
+                if op % 4 == 0:
+                    kept[n].append(wgClient.id)
+                else:
+                    self.assertTrue(wg.remove_client(user, wgClient.id, wait=False))
+
+        reader_errors = []
+
+        def reader():
+            # Readers never take the writer lock, they must still see whole snapshots
+            try:
+                while not stop.is_set():
+                    for client in wg.clients:
+                        wg.get_wireguard_list(client.user)
+                        break
+                    wg.query_peers(limit=50)
+            except Exception as e:
+                reader_errors.append(repr(e))
+
+        readers = [threading.Thread(target=reader) for _ in range(4)]
+        for thread in readers:
+            thread.start()
+        try:
+            errors = self._run(writer)
+        finally:
+            stop.set()
+            for thread in readers:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(reader_errors, [])
+        self.assertConsistent()
+        self.assertEqual(sorted(client.id for client in wg.clients), sorted(id for ids in kept for id in ids))
+
+    def test_exhausting_the_pool(self):
+        created = [[] for _ in range(THREADS)]
+
+        def writer(n: int):
+            while True:
+                try:
+                    created[n] += wg.create_clients([(f"bulk{n}@example.com", "") for _ in range(7)], wait=False)
+                except wg.PoolExhaustedError:
+                    return
+
+        errors = self._run(writer)
+        self.assertEqual(errors, [])
+        self.assertConsistent()
+        self.assertEqual(len(wg.clients), sum(len(peers) for peers in created))
+        self.assertLess(wg.interfaces[0].pool.free, 7)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+"""
+oauth.py against a local stand-in for Google's token endpoint and signing certificates
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography import x509
+from google.auth import crypt, jwt, exceptions
+import unittest
+import datetime
+import threading
+import json
+import time
+import os
+
+import settings
+import oauth
+
+CLIENT_ID = "client.apps.example.com"
+
+def _signing_key() -> tuple[bytes, str]:
+    """
+    Returns:
+        tuple[bytes, str]: RSA private key (PEM) and a self-signed certificate for it (PEM)
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, "test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(1).not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    return pem, cert.public_bytes(serialization.Encoding.PEM).decode()
+
+class _StandIn(ThreadingHTTPServer):
+    """
+    Serves /certs with Cache-Control: max-age=`max_age` and /token, recording every request
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        key, self.cert = _signing_key()
+        self.signer = crypt.RSASigner.from_string(key, "key-1")
+        self.max_age = 300
+        # (path, client port) of every request
+        self.requests: list[tuple[str, int]] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def id_token(self, **claims) -> str:
+        now = int(time.time())
+        payload = {"iss": "https://accounts.google.com", "aud": CLIENT_ID, "iat": now, "exp": now + 600, "sub": "1", "email": "user@example.com"}
+        payload.update(claims)
+        return jwt.encode(self.signer, payload).decode()
+
+    def hits(self, path: str) -> int:
+        return sum(1 for requested, _ in self.requests if requested == path)
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection reuse shows in the client ports
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address[1]))
+        self._send({"key-1": self.server.cert}, {"Cache-Control": f"public, max-age={self.server.max_age}"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.path, self.client_address[1]))
+        self._send({"access_token": "access", "token_type": "Bearer", "expires_in": 3600, "id_token": self.server.id_token()})
+
+    def log_message(self, format, *args):
+        pass
+
+class OAuthTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = _StandIn()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        # oauthlib refuses plain HTTP token endpoints otherwise
+        os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.max_age = 300
+        oauth.certs_request.cache.clear()
+        oauth._client_type = None
+        settings.GOOGLE_CERTS_URL = f"{self.server.url}/certs"
+        settings.BASE_URL = "https://vpn.example.com/api"
+        settings.GOOGLE_CLIENT_SECRET = {"web": {
+            "client_id": CLIENT_ID,
+            "client_secret": "secret",
+            "auth_uri": f"{self.server.url}/auth",
+            "token_uri": f"{self.server.url}/token",
+        }}
+
+    def test_verify_id_token(self):
+        idinfo = oauth.verify_id_token(self.server.id_token(), CLIENT_ID)
+        self.assertEqual(idinfo["email"], "user@example.com")
+
+        with self.assertRaises(ValueError):
+            oauth.verify_id_token(self.server.id_token(aud="someone-else"), CLIENT_ID)
+        with self.assertRaises(exceptions.GoogleAuthError):
+            oauth.verify_id_token(self.server.id_token(iss="https://evil.example.com"), CLIENT_ID)
+
+    def test_certs_fetched_once_per_max_age(self):
+        self.server.max_age = 1
+        for _ in range(5):
+            oauth.verify_id_token(self.server.id_token(), CLIENT_ID)
+        self.assertEqual(self.server.hits("/certs"), 1)
+
+        time.sleep(1.1)
+        for _ in range(5):
+            oauth.verify_id_token(self.server.id_token(), CLIENT_ID)
+        self.assertEqual(self.server.hits("/certs"), 2)
+
+    def test_certs_not_cached_without_max_age(self):
+        self.server.max_age = 0
+        for _ in range(3):
+            oauth.verify_id_token(self.server.id_token(), CLIENT_ID)
+        self.assertEqual(self.server.hits("/certs"), 3)
+
+    def test_concurrent_logins_share_one_download(self):
+        errors = []
+
+        def login():
+            try:
+                oauth.verify_id_token(self.server.id_token(), CLIENT_ID)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=login) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(self.server.hits("/certs"), 1)
+
+    def test_token_exchange_through_pooled_adapter(self):
+        for _ in range(3):
+            flow = oauth.get_flow()
+            self.assertIs(flow.oauth2session.get_adapter(self.server.url), oauth._adapter)
+            flow.fetch_token(code="code")
+            idinfo = oauth.verify_id_token(flow.credentials.id_token, flow.client_config["client_id"])
+            self.assertEqual(idinfo["email"], "user@example.com")
+
+        self.assertEqual(self.server.hits("/token"), 3)
+        self.assertEqual(self.server.hits("/certs"), 1)
+        # Every flow and the cert downloads went over the same kept-alive connection
+        self.assertEqual(len({port for _, port in self.server.requests}), 1)
+
+    def test_changed_client_config_is_validated_again(self):
+        self.assertEqual(oauth._get_client_config()[0], "web")
+        self.assertIs(oauth._client_type[0], settings.GOOGLE_CLIENT_SECRET)
+
+        settings.GOOGLE_CLIENT_SECRET = {"other": {}}
+        with self.assertRaises(ValueError):
+            oauth._get_client_config()
+
+if __name__ == "__main__":
+    unittest.main()
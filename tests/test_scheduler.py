@@ -0,0 +1,57 @@
+"""
+ApplyScheduler coalescing and error reporting
+"""
+import unittest
+
+from scheduler import ApplyScheduler, ApplyError
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.runs = 0
+        self.fail = False
+
+    def _apply(self):
+        self.runs += 1
+        if self.fail:
+            raise RuntimeError("apply failed")
+
+    def test_inline_failure_raises_for_waiters(self):
+        scheduler = ApplyScheduler(self._apply, delay=0)
+        self.fail = True
+        with self.assertRaises(ApplyError):
+            scheduler.request(wait=True)
+
+        # Without waiting the failure is only recorded
+        ticket = scheduler.request(wait=False)
+        self.assertEqual(scheduler.status(ticket), ("failed", "apply failed"))
+
+        self.fail = False
+        scheduler.request(wait=True)
+        self.assertEqual(self.runs, 3)
+
+    def test_background_failure_raises_for_waiters(self):
+        scheduler = ApplyScheduler(self._apply, delay=0.01)
+        self.fail = True
+        with self.assertRaises(ApplyError):
+            scheduler.request(wait=True, timeout=5)
+
+    def test_burst_is_coalesced(self):
+        scheduler = ApplyScheduler(self._apply, delay=0.2, max_delay=5)
+        tickets = [scheduler.request() for _ in range(20)]
+        self.assertTrue(scheduler.wait(tickets[-1], timeout=5))
+        self.assertEqual(self.runs, 1)
+
+    def test_old_failures_are_not_reported_as_done(self):
+        scheduler = ApplyScheduler(self._apply, delay=0)
+        self.fail = True
+        tickets = [scheduler.request() for _ in range(40)]
+        self.fail = False
+        ok = scheduler.request()
+
+        self.assertEqual(scheduler.status(tickets[0]), ("unknown", None))
+        self.assertEqual(scheduler.status(tickets[-1]), ("failed", "apply failed"))
+        self.assertEqual(scheduler.status(ok), ("done", None))
+        self.assertEqual(scheduler.status(ok + 1), ("pending", None))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+"""
+Server-side sessions: expiry, touching idle sessions and revocation
+"""
+from unittest import mock
+from pathlib import Path
+import unittest
+import tempfile
+
+from flask import Flask, session
+
+import sessions
+
+TTL = 600
+TOUCH_INTERVAL = 60
+
+class _Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self) -> float:
+        return self.now
+
+def _app(interface: sessions.ServerSessionInterface) -> Flask:
+    app = Flask(__name__)
+    app.secret_key = "test"
+    app.session_interface = interface
+
+    @app.post("/login")
+    def login():
+        interface.regenerate(session)
+        session["email"] = "user@example.com"
+        return ""
+
+    @app.get("/whoami")
+    def whoami():
+        return session.get("email", "")
+
+    @app.post("/logout")
+    def logout():
+        session.clear()
+        return ""
+
+    return app
+
+class _SessionTests:
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        self.clock = _Clock()
+        patcher = mock.patch("sessions.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = self.open_store()
+        self.interface = sessions.ServerSessionInterface(self.store, TTL, TOUCH_INTERVAL)
+        self.app = _app(self.interface)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def open_store(self) -> sessions.SessionStore:
+        raise NotImplementedError
+
+    def sid(self, client=None) -> str:
+        cookie = (client or self.client).get_cookie("session")
+        return cookie.value if cookie else None
+
+    def whoami(self, client=None) -> str:
+        return (client or self.client).get("/whoami").get_data(as_text=True)
+
+    def test_cookie_carries_only_an_id(self):
+        self.assertIsNone(self.sid())
+        self.assertEqual(self.whoami(), "")
+        # Reading an empty session neither stores it nor sets a cookie
+        self.assertIsNone(self.sid())
+
+        self.client.post("/login")
+        self.assertNotIn("user@example.com", self.sid())
+        self.assertEqual(self.whoami(), "user@example.com")
+        self.assertEqual(self.store.load(self.sid(), self.clock.now)[1], self.clock.now + TTL)
+
+    def test_session_expires_after_ttl(self):
+        self.client.post("/login")
+        self.clock.now += TTL
+        self.assertEqual(self.whoami(), "")
+        self.assertIsNone(self.store.load(self.sid(), self.clock.now))
+
+    def test_use_keeps_the_session_alive(self):
+        self.client.post("/login")
+        sid = self.sid()
+        with mock.patch.object(self.store, "touch", wraps=self.store.touch) as touch:
+            # Within touch_interval an unchanged session isn't written back
+            self.clock.now += TOUCH_INTERVAL - 1
+            self.assertEqual(self.whoami(), "user@example.com")
+            touch.assert_not_called()
+
+            for _ in range(3):
+                self.clock.now = self.store.load(sid, self.clock.now)[1] - 1
+                self.assertEqual(self.whoami(), "user@example.com")
+            self.assertEqual(touch.call_count, 3)
+        self.assertEqual(self.sid(), sid)
+
+    def test_logout_revokes_the_session(self):
+        self.client.post("/login")
+        sid = self.sid()
+        stolen = self.app.test_client()
+        stolen.set_cookie("session", sid)
+        self.assertEqual(self.whoami(stolen), "user@example.com")
+
+        self.client.post("/logout")
+        self.assertIsNone(self.sid())
+        self.assertIsNone(self.store.load(sid, self.clock.now))
+        self.assertEqual(self.whoami(stolen), "")
+
+    def test_login_issues_a_new_id(self):
+        self.client.post("/login")
+        first = self.sid()
+        self.client.post("/login")
+        self.assertNotEqual(self.sid(), first)
+        self.assertIsNone(self.store.load(first, self.clock.now))
+
+        # An ID the server never issued is not adopted
+        planted = self.app.test_client()
+        planted.set_cookie("session", "planted")
+        planted.post("/login")
+        self.assertNotEqual(self.sid(planted), "planted")
+        self.assertIsNone(self.store.load("planted", self.clock.now))
+
+class MemorySessionTest(_SessionTests, unittest.TestCase):
+    def open_store(self) -> sessions.SessionStore:
+        return sessions.MemorySessionStore(max_entries=3)
+
+    def test_least_recently_used_are_evicted(self):
+        clients = [self.app.test_client() for _ in range(4)]
+        for client in clients:
+            client.post("/login")
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(self.whoami(clients[0]), "")
+        self.assertEqual([self.whoami(client) for client in clients[1:]], ["user@example.com"] * 3)
+
+class SQLiteSessionTest(_SessionTests, unittest.TestCase):
+    def open_store(self) -> sessions.SessionStore:
+        return sessions.SQLiteSessionStore(self.root / "sessions.db", prune_interval=0)
+
+    def test_sessions_are_shared_between_stores(self):
+        self.client.post("/login")
+        other = sessions.SQLiteSessionStore(self.root / "sessions.db")
+        self.assertIsNotNone(other.load(self.sid(), self.clock.now))
+
+        # Expired rows are pruned by the next write
+        self.clock.now += TTL
+        self.app.test_client().post("/login")
+        count = self.store._connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        self.assertEqual(count, 1)
+
+if __name__ == "__main__":
+    unittest.main()
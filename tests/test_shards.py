@@ -0,0 +1,127 @@
+"""
+Peers sharded across several interfaces: placement, ports and rebalancing
+"""
+from contextlib import redirect_stdout
+from pathlib import Path
+import unittest
+import tempfile
+import io
+
+from allocator import PoolExhaustedError
+import settings
+import wg
+
+INTERFACES = [
+    {"name": "wg0", "addresses": "10.0.0.0/29", "port": 51820},
+    {"name": "wg1", "addresses": "10.0.1.0/29", "port": 51821},
+]
+
+class ShardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        root = Path(cls.tmpdir.name)
+        settings.WG_INTERFACES = INTERFACES
+        settings.WG_STORAGE = "json"
+        settings.WG_SHARED_STATE = False
+        settings.WG_BACKEND = "mock"
+        settings.WG_DRIFT_CHECK_INTERVAL = 0
+        settings.WG_APPLY_DELAY = 0
+        settings.METRICS_ENABLED = False
+        wg.rootDataPath = root
+        wg.configPath = root / "wg.json"
+        wg.wgconfDir = root
+
+    @classmethod
+    def tearDownClass(cls):
+        wg.scheduler.flush()
+        settings.WG_INTERFACES = []
+        settings.WG_PLACEMENT = "affinity"
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        settings.WG_PLACEMENT = "affinity"
+        wg.configPath.unlink(missing_ok=True)
+        self.output = io.StringIO()
+        with redirect_stdout(self.output):
+            wg.load_config()
+
+    def create(self, user: str, count: int = 1) -> list[wg.WireguardPair]:
+        with redirect_stdout(self.output):
+            return [wg.create_client(user, f"{user}-{n}") for n in range(count)]
+
+    def names(self, peers) -> list[str]:
+        return [wg.interface_of(peer.id).name for peer in peers]
+
+    def counts(self) -> list[int]:
+        return [len(wg._interface_peers(iface)) for iface in wg.interfaces]
+
+    def test_least_loaded_spreads_peers(self):
+        settings.WG_PLACEMENT = "least-loaded"
+        self.create("a@example.com", 4)
+        self.assertEqual(self.counts(), [2, 2])
+
+    def test_affinity_keeps_a_user_together(self):
+        a = self.create("a@example.com", 3)
+        self.assertEqual(len(set(self.names(a))), 1)
+        b = self.create("b@example.com")
+        self.assertNotEqual(self.names(b), self.names(a[:1]))
+
+        # Once the user's interface is full their next peers go elsewhere
+        more = self.create("a@example.com", 3)
+        self.assertEqual(self.counts(), [5, 2] if self.names(a)[0] == "wg0" else [2, 5])
+        self.assertNotEqual(self.names(more)[-1], self.names(a)[0])
+
+    def test_hash_placement_is_stable(self):
+        settings.WG_PLACEMENT = "hash"
+        for user in ("a@example.com", "b@example.com", "c@example.com"):
+            peers = self.create(user, 2)
+            self.assertEqual(len(set(self.names(peers))), 1, user)
+            self.assertEqual(self.names(peers)[0], wg._place(user).name)
+
+    def test_every_pool_exhausted(self):
+        settings.WG_PLACEMENT = "least-loaded"
+        self.create("a@example.com", 10)
+        with self.assertRaises(PoolExhaustedError):
+            self.create("a@example.com")
+
+    def test_interfaces_have_their_own_port_and_keys(self):
+        settings.WG_PLACEMENT = "least-loaded"
+        peers = self.create("a@example.com", 2)
+        wg0, wg1 = wg.interfaces
+        self.assertNotEqual(wg0.server.public_key, wg1.server.public_key)
+        self.assertIn("ListenPort = 51820", wg0.confPath.read_text())
+        self.assertIn("ListenPort = 51821", wg1.confPath.read_text())
+
+        for peer in peers:
+            iface = wg.interface_of(peer.id)
+            config = wg.generate_wireguard_config("a@example.com", peer.id)
+            self.assertIn(f"Endpoint = {settings.SERVER_DOMAIN}:{iface.server.server_port}", config)
+            self.assertIn(f"PublicKey = {iface.server.public_key}", config)
+            self.assertEqual(set(wg.backend.interfaces[iface.name]), {peer.public_key})
+
+        # Keys of the second interface survive a reload
+        with redirect_stdout(self.output):
+            wg.load_config()
+        self.assertEqual(wg.interfaces[1].server.public_key, wg1.server.public_key)
+
+    def test_rebalance_evens_out_the_interfaces(self):
+        settings.WG_PLACEMENT = "least-loaded"
+        self.create("a@example.com", 4)
+        # Pile every peer onto wg0 as if it had been the only interface
+        with redirect_stdout(self.output), wg._writing():
+            for peer in [peer for peer in wg.clients if peer.id in wg.interfaces[1]]:
+                wg.move_client(peer, wg.interfaces[0])
+        self.assertEqual(self.counts(), [4, 0])
+
+        with redirect_stdout(self.output):
+            moved = wg.rebalance()
+        self.assertEqual(len(moved), 2)
+        self.assertEqual(self.counts(), [2, 2])
+        for before, after in moved:
+            self.assertEqual(after.public_key, before.public_key)
+            self.assertEqual(wg.interface_of(after.id).name, "wg1")
+        self.assertEqual(set(wg.backend.interfaces["wg1"]), {after.public_key for _, after in moved})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+Storage backends: snapshots, the journal and its crash recovery, and the streaming JSON reader
+"""
+from pathlib import Path
+import unittest
+import tempfile
+import json
+import io
+import stat
+
+from storage import JsonStorage, JournalStorage, SqliteStorage, JsonStream, atomic_write
+
+def _client(id: int, name: str = "") -> dict:
+    return {"id": id, "user": "user@example.com", "name": name, "private_key": f"priv{id}", "public_key": f"pub{id}", "preshared_key": f"psk{id}"}
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        self.path = self.root / "wg.json"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _journal(self, clients: list[dict]) -> JournalStorage:
+        storage = JournalStorage(self.path)
+        storage.save({"server": {"private_key": "spriv", "public_key": "spub"}, "clients": []})
+        for client in clients:
+            storage.put(client)
+        storage.commit(lambda: None)
+        return storage
+
+    def _ids(self, storage) -> list[int]:
+        return [client["id"] for client in storage.load()["clients"]]
+
+    def test_journal_replay(self):
+        storage = self._journal([_client(1), _client(2), _client(3)])
+        storage.delete(2)
+        storage.put(_client(3, "renamed"))
+        storage.commit(lambda: None)
+
+        data = JournalStorage(self.path).load()
+        self.assertEqual([client["id"] for client in data["clients"]], [1, 3])
+        self.assertEqual(data["clients"][1]["name"], "renamed")
+
+        server, clients = JournalStorage(self.path).iter_load()
+        self.assertEqual(server["public_key"], "spub")
+        self.assertEqual([client["id"] for client in clients], [1, 3])
+
+    def test_torn_tail_does_not_hide_later_writes(self):
+        self._journal([_client(1), _client(2)])
+        # Crash in the middle of appending the next entry
+        with self.path.with_suffix(".journal").open("ab") as f:
+            f.write(b'{"op": "put", "client": {"id": 3, "us')
+
+        storage = JournalStorage(self.path)
+        self.assertEqual(self._ids(storage), [1, 2])
+        storage.put(_client(4))
+        storage.commit(lambda: None)
+
+        self.assertEqual(self._ids(JournalStorage(self.path)), [1, 2, 4])
+        _, clients = JournalStorage(self.path).iter_load()
+        self.assertEqual([client["id"] for client in clients], [1, 2, 4])
+
+    def test_compaction_folds_the_journal(self):
+        storage = JournalStorage(self.path, compact_after=3)
+        storage.save({"server": {}, "clients": []})
+        clients = []
+        for id in range(1, 6):
+            clients.append(_client(id))
+            storage.put(clients[-1])
+            storage.commit(lambda: {"server": {}, "clients": clients})
+        self.assertEqual(self._ids(JournalStorage(self.path)), [1, 2, 3, 4, 5])
+        self.assertLess(len(storage.journalPath.read_text().splitlines()), 3)
+
+    def test_files_are_private(self):
+        storage = self._journal([_client(1)])
+        storage.save(storage.load())
+        for path in storage.files():
+            self.assertEqual(stat.S_IMODE(path.stat().st_mode), 0o600, path)
+
+    def test_atomic_write_leaves_no_temp_files(self):
+        atomic_write(self.path, ["a", "b"])
+        atomic_write(self.path, "c")
+        self.assertEqual(self.path.read_text(), "c")
+        self.assertEqual(list(self.root.iterdir()), [self.path])
+
+    def test_json_storage_commit(self):
+        storage = JsonStorage(self.path)
+        storage.save({"server": {}, "clients": [_client(1)]})
+        self.assertFalse(storage.modified())
+        storage.put(_client(2))
+        storage.commit(lambda: {"server": {}, "clients": [_client(1), _client(2)]})
+        self.assertEqual(self._ids(JsonStorage(self.path)), [1, 2])
+
+    def test_sqlite_round_trip(self):
+        storage = SqliteStorage(self.path)
+        self.assertFalse(storage.exists())
+        storage.save({"server": {"private_key": "spriv", "public_key": "spub"}, "clients": [_client(1), _client(2)]})
+        storage.put(_client(3))
+        storage.put(_client(1, "renamed"))
+        storage.delete(2)
+        storage.commit(lambda: None)
+        self.assertFalse(storage.dirty)
+
+        data = SqliteStorage(self.path).load()
+        self.assertEqual(data["server"], {"private_key": "spriv", "public_key": "spub"})
+        self.assertEqual(data["clients"], [_client(1, "renamed"), _client(3)])
+        server, clients = SqliteStorage(self.path).iter_load()
+        self.assertEqual(list(clients), data["clients"])
+
+    def test_sqlite_imports_wg_json(self):
+        self.path.write_text(json.dumps({"server": {"public_key": "spub"}, "clients": [_client(1)]}))
+        storage = SqliteStorage(self.path)
+        self.assertTrue(storage.exists())
+        self.assertEqual(storage.load()["clients"], [_client(1)])
+        self.assertFalse(self.path.exists())
+        self.assertTrue(self.path.with_suffix(".json.bak").exists())
+
+DOCUMENT = {
+    "server": {"private_key": "sp\u00e9c\"ial", "port": 51820, "ratio": -1.5e-3, "on": True, "off": None},
+    "clients": [_client(id, "n\u00e4me \\ \"quoted\"") for id in (1, 22, 333, 4444, 55555)] + [[], {}, [1, [2.25, [3e10]]], 0, -7, 12345678901234567890],
+}
+
+class JsonStreamTest(unittest.TestCase):
+    def _walk(self, stream: JsonStream):
+        # Rebuild the top level object and its "clients" array through the incremental readers
+        data = {}
+        for key in stream.items():
+            data[key] = list(stream.elements()) if key == "clients" else stream.value()
+        return data
+
+    def test_small_chunks(self):
+        for text in (json.dumps(DOCUMENT), json.dumps(DOCUMENT, indent=2), json.dumps(DOCUMENT, separators=(",", ":"))):
+            for chunk_size in range(1, 8):
+                stream = JsonStream(io.StringIO(text), chunk_size)
+                self.assertEqual(self._walk(stream), DOCUMENT, chunk_size)
+                self.assertEqual(stream.peek(), "")
+
+    def test_numbers_split_across_chunks(self):
+        text = "[12345, -6.75e+2, 0.5, 1E3, 999]"
+        for chunk_size in range(1, 8):
+            self.assertEqual(list(JsonStream(io.StringIO(text), chunk_size).elements()), [12345, -675.0, 0.5, 1000.0, 999], chunk_size)
+        self.assertEqual(JsonStream(io.StringIO("42"), 1).value(), 42)
+
+    def test_empty_containers(self):
+        for chunk_size in (1, 2):
+            stream = JsonStream(io.StringIO(' { "clients" : [ ] , "server" : { } } '), chunk_size)
+            self.assertEqual(self._walk(stream), {"clients": [], "server": {}})
+
+    def test_errors_point_at_the_offset(self):
+        for text, offset in [('{"clients": [1, 2,]}', 18), ('{"clients": [1 2]}', 15), ('{"a" 1}', 5), ('{"clients": [1, 2', 17), ('{"a": tru}', 6)]:
+            for chunk_size in (1, 3, 64):
+                with self.assertRaisesRegex(ValueError, f"at character {offset}:", msg=(text, chunk_size)):
+                    self._walk(JsonStream(io.StringIO(text), chunk_size))
+
+if __name__ == "__main__":
+    unittest.main()
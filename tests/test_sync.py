@@ -0,0 +1,157 @@
+"""
+Syncing the registry to the interface through the mock backend
+"""
+from contextlib import redirect_stdout
+from unittest import mock
+from pathlib import Path
+import unittest
+import threading
+import ipaddress
+import tempfile
+import base64
+import json
+import io
+
+from scheduler import ApplyError
+import settings
+import wg
+
+class SyncTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        root = Path(cls.tmpdir.name)
+        settings.WG_ADDRESSES = "10.0.0.0/24"
+        settings.WG_INTERFACES = []
+        settings.WG_STORAGE = "json"
+        settings.WG_SHARED_STATE = False
+        settings.WG_BACKEND = "mock"
+        settings.WG_DRIFT_CHECK_INTERVAL = 0
+        settings.WG_APPLY_DELAY = 0
+        settings.METRICS_ENABLED = False
+        wg.rootDataPath = root
+        wg.configPath = root / "wg.json"
+        wg.wgconfDir = root
+
+    @classmethod
+    def tearDownClass(cls):
+        wg.scheduler.flush()
+        cls.tmpdir.cleanup()
+
+    def setUp(self):
+        wg.configPath.unlink(missing_ok=True)
+        wg.configPath.with_name("wg.json.rejected").unlink(missing_ok=True)
+        self.output = io.StringIO()
+        with redirect_stdout(self.output):
+            wg.load_config()
+
+    def kernel(self) -> set[str]:
+        return set(wg.backend.interfaces.get("wg0", {}))
+
+    def registry(self) -> set[str]:
+        return {client.public_key for client in wg.clients}
+
+    def test_failed_config_write_keeps_the_changes_queued(self):
+        with redirect_stdout(self.output):
+            wg.create_client("user@example.com", "a")
+            wg.create_client("user@example.com", "b")
+            self.assertEqual(self.kernel(), self.registry())
+
+            with mock.patch("wg.atomic_write", side_effect=OSError("No space left on device")):
+                with self.assertRaises(ApplyError):
+                    wg.create_client("user@example.com", "c")
+            iface = wg.interfaces[0]
+            self.assertEqual(len(iface.pending), 1)
+            self.assertEqual(len(self.kernel()), 2)
+
+            self.assertTrue(wg.sync())
+        self.assertEqual(self.kernel(), self.registry())
+        self.assertEqual(len(self.registry()), 3)
+        self.assertEqual(iface.pending, {})
+
+    def test_ipv6_ids_in_the_ipv4_range(self):
+        # ::a00:0/120 holds the same integers as 10.0.0.0/24
+        settings.WG_ADDRESSES = "::a00:0/120"
+        try:
+            wg.configPath.unlink()
+            with redirect_stdout(self.output):
+                wg.load_config()
+                peer = wg.create_client("user@example.com", "a")
+            self.assertEqual(ipaddress.ip_address(peer.ip).version, 6)
+            self.assertIn(f"AllowedIPs = {peer.ip}/128", wg.interfaces[0].confPath.read_text())
+            self.assertEqual(wg.interfaces[0].confPath.read_text().count("Address = ::a00:1/120"), 1)
+        finally:
+            settings.WG_ADDRESSES = "10.0.0.0/24"
+
+    def _edit_stored(self, edit, server: dict = None):
+        data = json.loads(wg.configPath.read_text())
+        edit(data["clients"])
+        data["server"].update(server or {})
+        wg.configPath.write_text(json.dumps(data))
+
+    def _new_record(self, id: int, name: str) -> dict:
+        private_key, public_key, preshared_key = (base64.b64encode(key).decode() for key in wg._generate_keys())
+        return {"id": id, "user": "user@example.com", "name": name, "private_key": private_key, "public_key": public_key, "preshared_key": preshared_key}
+
+    def test_external_add_remove_rename(self):
+        with redirect_stdout(self.output):
+            a = wg.create_client("user@example.com", "a")
+            b = wg.create_client("user@example.com", "b")
+            added = self._new_record(b.id + 10, "d")
+
+            def edit(records):
+                records[:] = [record for record in records if record["id"] != b.id]
+                records[0]["name"] = "renamed"
+                self.assertEqual(records[0]["id"], a.id)
+                records.append(added)
+            self._edit_stored(edit)
+
+            self.assertEqual(wg.apply_external_changes(wait=True), (1, 1, 1))
+        self.assertEqual(sorted(client.id for client in wg.clients), sorted([a.id, added["id"]]))
+        self.assertEqual(wg.clients.get(a.id).name, "renamed")
+        self.assertEqual(self.kernel(), self.registry())
+        self.assertIn(added["id"], wg.interfaces[0].pool)
+        self.assertNotIn(b.id, wg.interfaces[0].pool)
+
+    def test_invalid_external_records_are_skipped(self):
+        with redirect_stdout(self.output):
+            a = wg.create_client("user@example.com", "a")
+            b = wg.create_client("user@example.com", "b")
+            new = self._new_record(b.id + 10, "new")
+            nameless = self._new_record(b.id + 11, "")
+            del nameless["name"]
+
+            def edit(records):
+                next(record for record in records if record["id"] == b.id)["public_key"] = "not a key"
+                records.append(dict(self._new_record(b.id + 12, ""), id=str(b.id + 12)))
+                records.append(nameless)
+                records.append(["not", "a", "record"])
+                records.append(new)
+            self._edit_stored(edit)
+
+            self.assertEqual(wg.apply_external_changes(wait=True), (1, 0, 0))
+        # The peer whose record broke is kept as it was
+        self.assertEqual(sorted(client.id for client in wg.clients), sorted([a.id, b.id, new["id"]]))
+        self.assertEqual(wg.clients.get(b.id).public_key, b.public_key)
+        self.assertEqual(self.kernel(), self.registry())
+        self.assertEqual(len(wg.rejected_path().read_text().splitlines()), 4)
+
+    def test_waiting_for_new_server_keys_with_a_delay(self):
+        with redirect_stdout(self.output):
+            wg.create_client("user@example.com", "a")
+        private_key, public_key, _ = (base64.b64encode(key).decode() for key in wg._generate_keys())
+        self._edit_stored(lambda records: None, {"private_key": private_key, "public_key": public_key})
+        wg.scheduler.delay = 0.05
+        try:
+            thread = threading.Thread(target=wg.apply_external_changes, kwargs={"wait": True}, daemon=True)
+            with redirect_stdout(self.output):
+                thread.start()
+                thread.join(5)
+            self.assertFalse(thread.is_alive(), "apply_external_changes(wait=True) deadlocked")
+        finally:
+            wg.scheduler.delay = 0
+        self.assertEqual(wg.interfaces[0].server.public_key, public_key)
+        self.assertEqual(self.kernel(), self.registry())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Privileged helper: request validation and the config files it renders
+"""
+from pathlib import Path
+import unittest
+import threading
+import tempfile
+import base64
+import socket
+import json
+
+from wgctl import ManagedBackend, MockBackend, HelperServer, HelperBackend, check_config
+
+KEY = base64.b64encode(bytes(range(32))).decode()
+
+def _peer(**fields) -> dict:
+    peer = {"public_key": KEY, "preshared_key": KEY, "allowed_ips": "10.0.0.2/32", "persistent_keepalive": 25}
+    peer.update(fields)
+    return peer
+
+def _config(**fields) -> dict:
+    config = {"private_key": KEY, "address": "10.0.0.1/24", "listen_port": 51820, "mtu": 1450, "peers": [_peer()]}
+    config.update(fields)
+    return config
+
+class _RecordingBackend(ManagedBackend):
+    def _run(self, args, input=None):
+        self.args = args
+        return super()._run(["true"])
+
+class WgctlTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_config_is_validated(self):
+        self.assertEqual(check_config(_config())["peers"], [_peer()])
+        for config in [
+            None,
+            _config(private_key="short"),
+            _config(private_key=KEY + "\nPostUp = touch /tmp/pwned"),
+            _config(address="10.0.0.1/24\nPostUp = id"),
+            _config(listen_port="51820"),
+            _config(peers={}),
+            _config(peers=[_peer(public_key=base64.b64encode(b"x" * 31).decode())]),
+            _config(peers=[_peer(allowed_ips="10.0.0.2/32\nPostUp = id")]),
+            _config(peers=[_peer(allowed_ips="not an address")]),
+            _config(peers=[_peer(persistent_keepalive=True)]),
+            _config(peers=["peer"]),
+        ]:
+            with self.assertRaises(ValueError, msg=config):
+                check_config(config)
+
+    def test_rendered_hooks_come_from_the_hooks_dir(self):
+        hooks = self.root / "hooks"
+        hooks.mkdir()
+        (hooks / "postup.sh").touch()
+        backend = _RecordingBackend(self.root / "conf", hooks)
+
+        result = backend.execute({"op": "up", "interface": "wg0", "config": _config()})
+        self.assertTrue(result.ok, result.stderr)
+        path = self.root / "conf" / "wg0.conf"
+        self.assertEqual(backend.args, ["wg-quick", "up", str(path)])
+        text = path.read_text()
+        self.assertIn(f"PostUp = {hooks / 'postup.sh'}", text)
+        self.assertNotIn("PreDown", text)
+        self.assertIn(f"[Peer]\nPublicKey = {KEY}\nPresharedKey = {KEY}\nAllowedIPs = 10.0.0.2/32\nPersistentKeepalive = 25\n", text)
+        self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+
+        # A caller can't smuggle keys of its own into the file
+        result = backend.execute({"op": "syncconf", "interface": "wg0", "config": _config(PostUp="id")})
+        self.assertTrue(result.ok, result.stderr)
+        self.assertEqual(path.read_text().count("PostUp"), 1)
+
+    def test_bad_requests_are_answered(self):
+        socketPath = str(self.root / "wg.sock")
+        server = HelperServer(socketPath, MockBackend())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with socket.socket(socket.AF_UNIX) as sock:
+                sock.connect(socketPath)
+                f = sock.makefile("rwb")
+                for line in [b"[1, 2]", b'"up"', b"not json", b'{"op": "batch", "commands": [3]}', b'{"op": "set_peers", "interface": "wg0", "peers": [{"public_key": "x"}]}']:
+                    f.write(line + b"\n")
+                    f.flush()
+                    response = json.loads(f.readline())
+                    self.assertEqual(response["code"], 2, line)
+
+            client = HelperBackend(socketPath)
+            self.assertTrue(client.up("wg0", _config()).ok)
+            self.assertEqual(client.show("wg0", "peers").stdout, f"{KEY}\n")
+            self.assertEqual(client.up("wg0", None).code, 2)
+            client._close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == "__main__":
+    unittest.main()
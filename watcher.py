@@ -0,0 +1,147 @@
+"""
+Watch a directory for changes to a set of files
+
+Uses inotify (through ctypes, Linux only) and falls back to polling stat()
+when inotify is unavailable. Events are debounced: the callback runs once
+the watched files have been quiet for `debounce` seconds, with the names of
+every file that changed in the meantime, so an editor's save or a burst of
+writes triggers a single reload.
+"""
+from pathlib import Path
+import ctypes.util
+import threading
+import ctypes
+import select
+import struct
+import time
+import os
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+# struct inotify_event without its trailing name: wd, mask, cookie, len
+_EVENT = struct.Struct("iIII")
+
+class Inotify:
+    """
+    inotify instance watching a single directory
+    """
+    def __init__(self, directory: Path, mask: int = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        # AttributeError here on libcs without inotify, callers treat it like OSError
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def read(self, timeout: float) -> set[str]:
+        """
+        Names of the files that had events, waiting up to `timeout` seconds for the first one
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        names = set()
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class FileWatcher:
+    """
+    Call `callback(names)` when files named in `names` inside `directory` change
+
+    Args:
+        mode (str): "auto" (inotify, polling if unavailable) or "poll"
+        debounce (float): seconds without further changes before the callback runs
+        poll_interval (float): seconds between stat() rounds when polling
+    """
+    directory: Path
+    names: set[str]
+    mode: str
+    debounce: float
+    poll_interval: float
+
+    def __init__(self, directory: Path, names: set[str], callback, mode: str = "auto", debounce: float = 0.5, poll_interval: float = 2.0):
+        self.directory = directory
+        self.names = set(names)
+        self.callback = callback
+        self.mode = mode
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        # "inotify" or "poll" once started
+        self.method = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="wg-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _stat(self) -> dict[str, tuple]:
+        signatures = {}
+        for name in self.names:
+            try:
+                st = os.stat(self.directory / name)
+            except FileNotFoundError:
+                continue
+            signatures[name] = (st.st_ino, st.st_mtime_ns, st.st_size)
+        return signatures
+
+    def _run(self):
+        inotify = None
+        if self.mode == "auto":
+            try:
+                inotify = Inotify(self.directory)
+            except (OSError, AttributeError) as e:
+                print(f"inotify unavailable ({e}), polling {self.directory} every {self.poll_interval}s")
+        self.method = "poll" if inotify is None else "inotify"
+
+        signatures = self._stat()
+        changed: set[str] = set()
+        deadline = None
+        try:
+            while not self._stop.is_set():
+                timeout = self.poll_interval if deadline is None else max(deadline - time.monotonic(), 0)
+                if inotify is not None:
+                    events = inotify.read(timeout) & self.names
+                else:
+                    self._stop.wait(min(timeout, self.poll_interval))
+                    current = self._stat()
+                    events = {name for name in self.names if current.get(name) != signatures.get(name)}
+                    signatures = current
+
+                if events:
+                    changed |= events
+                    deadline = time.monotonic() + self.debounce
+                elif deadline is not None and time.monotonic() >= deadline:
+                    names, changed, deadline = changed, set(), None
+                    try:
+                        self.callback(names)
+                    except Exception as e:
+                        print(f"Reloading {', '.join(sorted(names))} failed: {e!r}")
+        finally:
+            if inotify is not None:
+                inotify.close()
@@ -1,29 +1,95 @@
 import settings
 
+from allocator import AddressPool, PoolExhaustedError
+from scheduler import ApplyScheduler, ApplyError
+from storage import Storage, SharedState, open_storage, atomic_write, durable_append
+from keypool import KeyPool
+from wgctl import Backend, CommandResult, SudoBackend, HelperBackend, MockBackend
+from telemetry import TelemetryCollector
+from watcher import FileWatcher
+from changelog import ChangeLog
+import metrics
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
 from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives import serialization
 from pathlib import Path
 import ipaddress
-import random
+import binascii
 import base64
+import resource
+import bisect
+import threading
+import hashlib
+import secrets
 import json
-import os
+import time
+import sys
+
+def _raw_key(key: str | bytes) -> bytes:
+    """
+    Raises:
+        ValueError: `key` is not a 32 byte key, raw or base64
+    """
+    if isinstance(key, str):
+        key = binascii.a2b_base64(key, strict_mode=True)
+    if len(key) != 32:
+        raise ValueError(f"WireGuard keys are 32 bytes, got {len(key)}")
+    return key
+
+def _b64_key(key: bytes) -> str:
+    return binascii.b2a_base64(key, newline=False).decode()
 
 class WireguardPair:
+    """
+    A peer, kept compact for large deployments
+
+    Keys are stored raw (the public key on its own since it is also the
+    registry index key, private and preshared key together) and base64
+    encoded only when read. The address string is built on first use and
+    user names are interned, as most users own several peers.
+    """
+    __slots__ = ("id", "name", "user", "raw_public_key", "_secrets", "_ip")
+
     id: int
     name: str
     user: str
-    private_key: str
-    public_key: str
-    preshared_key: str
+    raw_public_key: bytes
 
-    def __init__(self, id: int, name: str, user: str, private_key: str, public_key: str, preshared_key: str):
+    def __init__(self, id: int, name: str, user: str, private_key: str | bytes, public_key: str | bytes, preshared_key: str | bytes):
         self.id = id
         self.name = name
-        self.user = user
-        self.private_key = private_key
-        self.public_key = public_key
-        self.preshared_key = preshared_key
+        self.user = sys.intern(user) if user else user
+        self.raw_public_key = _raw_key(public_key)
+        self._secrets = _raw_key(private_key) + _raw_key(preshared_key)
+        self._ip = None
+
+    @property
+    def private_key(self) -> str:
+        return _b64_key(self._secrets[:32])
+
+    @property
+    def public_key(self) -> str:
+        return _b64_key(self.raw_public_key)
+
+    @property
+    def preshared_key(self) -> str:
+        return _b64_key(self._secrets[32:])
+
+    @property
+    def ip(self) -> str:
+        if self._ip is None:
+            self._ip = convert_id_to_ip(self.id)
+        return self._ip
+
+    def renamed(self, name: str) -> "WireguardPair":
+        """
+        Copy of this peer under another name, sharing the key bytes
+        """
+        pair = WireguardPair.__new__(WireguardPair)
+        pair.id, pair.user, pair.raw_public_key, pair._secrets, pair._ip = self.id, self.user, self.raw_public_key, self._secrets, self._ip
+        pair.name = name
+        return pair
 
     def to_dict(self):
         return {
@@ -33,12 +99,161 @@ class WireguardPair:
             "private_key": self.private_key,
             "public_key": self.public_key,
             "preshared_key": self.preshared_key,
-            "ip": convert_id_to_ip(self.id)
+            "ip": self.ip
         }
     
+    def to_public_dict(self):
+        """
+        to_dict() without the private and preshared keys, for lists and change events
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "user": self.user,
+            "public_key": self.public_key,
+            "ip": self.ip
+        }
+
     def to_json(self):
         return json.dumps(self.to_dict(), indent=4)
 
+def _name_key(pair: WireguardPair) -> tuple[str, int]:
+    return (pair.name or "", pair.id)
+
+def _sorted_remove(keys: list, key):
+    n = bisect.bisect_left(keys, key)
+    if n < len(keys) and keys[n] == key:
+        del keys[n]
+
+class PeerRegistry:
+    """
+    WireGuard peer store
+
+    Keeps hash indexes by id, by (user, id), by user and by raw public key
+    so lookups don't have to scan every peer, plus ids and (name, id)
+    kept sorted for range queries and paging.
+
+    Writers must be serialized by the caller. Readers never lock: per-user
+    buckets are replaced instead of mutated, peers are swapped rather than
+    edited in place, and snapshot() hands out an immutable tuple of every
+    peer that is rebuilt at most once per change. The sorted indexes are
+    updated in place; readers only bisect and slice them.
+    """
+    by_id: dict[int, WireguardPair]
+    by_user: dict[str, dict[int, WireguardPair]]
+    by_public_key: dict[bytes, WireguardPair]
+    sorted_ids: list[int]
+    sorted_names: list[tuple[str, int]]
+    version: int
+
+    def __init__(self, pairs: list[WireguardPair] = None):
+        self.by_id = {}
+        self.by_user = {}
+        self.by_public_key = {}
+        self.sorted_ids = []
+        self.sorted_names = []
+        self.version = 0
+        self._snapshot = None
+        for pair in pairs or []:
+            self.add(pair)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __contains__(self, id: int) -> bool:
+        return id in self.by_id
+
+    def snapshot(self) -> tuple[WireguardPair, ...]:
+        version = self.version
+        cached = self._snapshot
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        peers = tuple(self.by_id.values())
+        self._snapshot = (version, peers)
+        return peers
+
+    def add(self, pair: WireguardPair, index: bool = True) -> bool:
+        """
+        Args:
+            index (bool): False leaves the sorted indexes to a reindex() once every peer is added
+        """
+        if pair.id in self.by_id or pair.raw_public_key in self.by_public_key:
+            return False
+
+        self.by_id[pair.id] = pair
+        self.by_user[pair.user] = {**self.by_user.get(pair.user, {}), pair.id: pair}
+        self.by_public_key[pair.raw_public_key] = pair
+        if index:
+            bisect.insort(self.sorted_ids, pair.id)
+            bisect.insort(self.sorted_names, _name_key(pair))
+        self.version += 1
+        return True
+
+    def reindex(self):
+        """
+        Rebuild the sorted indexes, one sort instead of an insort per peer when loading
+        """
+        self.sorted_ids = sorted(self.by_id)
+        self.sorted_names = sorted(_name_key(pair) for pair in self.by_id.values())
+
+    def replace(self, pair: WireguardPair) -> bool:
+        """
+        Swap in a new version of an existing peer (same id, user and public key)
+        """
+        current = self.by_id.get(pair.id)
+        if current is None or current.user != pair.user or current.raw_public_key != pair.raw_public_key:
+            return False
+
+        self.by_id[pair.id] = pair
+        self.by_user[pair.user] = {**self.by_user[pair.user], pair.id: pair}
+        self.by_public_key[pair.raw_public_key] = pair
+        if current.name != pair.name:
+            _sorted_remove(self.sorted_names, _name_key(current))
+            bisect.insort(self.sorted_names, _name_key(pair))
+        self.version += 1
+        return True
+
+    def remove(self, id: int) -> WireguardPair:
+        pair = self.by_id.pop(id, None)
+        if pair is None:
+            return None
+
+        peers = {peer_id: peer for peer_id, peer in self.by_user[pair.user].items() if peer_id != id}
+        if peers:
+            self.by_user[pair.user] = peers
+        else:
+            del self.by_user[pair.user]
+        del self.by_public_key[pair.raw_public_key]
+        _sorted_remove(self.sorted_ids, pair.id)
+        _sorted_remove(self.sorted_names, _name_key(pair))
+        self.version += 1
+        return pair
+
+    def get(self, id: int) -> WireguardPair:
+        return self.by_id.get(id)
+
+    def get_user_peer(self, user: str, id: int) -> WireguardPair:
+        return self.by_user.get(user, {}).get(id)
+
+    def get_by_public_key(self, public_key: str) -> WireguardPair:
+        try:
+            return self.by_public_key.get(_raw_key(public_key))
+        except ValueError:
+            return None
+
+    def user_peers(self, user: str) -> list[WireguardPair]:
+        return list(self.by_user.get(user, {}).values())
+
+    def user_count(self, user: str) -> int:
+        return len(self.by_user.get(user, {}))
+
+    def users(self) -> list[str]:
+        return list(self.by_user)
+
 class ServerWGConfig:
     private_key: str
     public_key: str
@@ -48,10 +263,88 @@ class ServerWGConfig:
     server_port: int
     persistent_keepalive: int
 
+class Interface:
+    """
+    One WireGuard interface: its subnet, port and server key, its address
+    pool and the state of its config file and kernel sync
+
+    A peer belongs to the interface whose subnet contains its address.
+    """
+    name: str
+    server: ServerWGConfig
+    pool: AddressPool
+    first: int
+    last: int
+
+    def __init__(self, name: str):
+        self.name = name
+        self.server = ServerWGConfig()
+        self.pool = None
+        self.first = self.last = 0
+        # public key -> peer to (re)configure, or None to remove it from the interface
+        self.pending: dict[str, WireguardPair] = {}
+        self.full_sync_required = True
+        self.last_drift_check = 0.0
+        # Peer sections of the config file by id: (peer, keepalive, rendered section)
+        self.sections: dict[int, tuple[WireguardPair, int, str]] = {}
+        # sha256 of the config file as last written, and of the config the interface last synced to
+        self.config_hash: str = None
+        self.synced_hash: str = None
+        # (registry, registry version, interface section, keepalive) the config file was last rendered from
+        self.config_key: tuple = None
+        self.config_lock = threading.Lock()
+
+    def configure(self, server: ServerWGConfig, pool: AddressPool):
+        self.server = server
+        self.pool = pool
+        self.first, self.last = int(pool.network.network_address), int(pool.network.broadcast_address)
+
+    def __contains__(self, id: int) -> bool:
+        return self.first <= id <= self.last
+
+    @property
+    def confPath(self) -> Path:
+        return wgconfDir / f"{self.name}.conf"
+
 rootDataPath = Path('/app/data')
 configPath = rootDataPath / 'wg.json'
-server = ServerWGConfig()
-clients: list[WireguardPair] = []
+wgconfDir = Path('/etc/wireguard')
+# Ordered as WG_INTERFACES, the first one is the primary interface
+interfaces: list[Interface] = []
+clients = PeerRegistry()
+storage: Storage = None
+shared: SharedState = None
+keypool = KeyPool(settings.WG_KEY_POOL_SIZE, settings.WG_KEY_POOL_LOW_WATERMARK)
+telemetry = TelemetryCollector(settings.WG_TELEMETRY_COMMAND, settings.WG_TELEMETRY_INTERVAL, settings.WG_TELEMETRY_SAMPLES)
+# Peer changes made by this process, for /wg/changes and /wg/events
+changes = ChangeLog(settings.WG_CHANGE_LOG_SIZE)
+backend: Backend = SudoBackend()
+# Serializes every writer of clients, pools, storage and the sync queues
+_lock = threading.RLock()
+# Server keys as stored, including those of interfaces no longer configured
+_server_keys: dict[str, str] = {}
+# Set once load_config() has run, see ensure_loaded()
+loaded = False
+# Last load of the stored state: peers, skipped, problems, seconds and peak_rss (bytes, whole process so far)
+load_stats: dict[str, float] = {}
+# Records skipped or flagged by the last load
+load_problems: list[str] = []
+_load_lock = threading.Lock()
+
+def _interface_settings() -> list[dict]:
+    """
+    WG_INTERFACES, or the single interface described by WG_ADDRESSES and WG_SERVER_PORT
+    """
+    if settings.WG_INTERFACES:
+        return settings.WG_INTERFACES
+    return [{"name": "wg0", "addresses": settings.WG_ADDRESSES, "port": settings.WG_SERVER_PORT}]
+
+def _new_server_keys() -> tuple[str, str]:
+    newkey = x25519.X25519PrivateKey.generate()
+    return (
+        base64.b64encode(newkey.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption())).decode(),
+        base64.b64encode(newkey.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)).decode(),
+    )
 
 def load_config():
     """
@@ -60,8 +353,10 @@ def load_config():
     config json structure
     {
         "server": {
-            "private_key": "base64",
+            "private_key": "base64", (first interface)
             "public_key": "base64",
+            "wg1.private_key": "base64", (every other interface)
+            "wg1.public_key": "base64",
         },
         "clients": [
             {
@@ -78,44 +373,52 @@ def load_config():
     }
     
     """
-    global rootPath, configPath, server, clients
+    global rootPath, configPath, storage, shared, backend, interfaces, loaded
 
-    if not configPath.exists():
-        newkey = x25519.X25519PrivateKey.generate()
-        data = {
-            "server": {
-                "private_key": base64.b64encode(newkey.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption())).decode(),
-                "public_key": base64.b64encode(newkey.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)).decode(),
-            },
-            "clients": []
-        }
-        configPath.write_text(json.dumps(data, indent=4))
-
-    data = json.loads(configPath.read_text())
-    server = ServerWGConfig()
-    server.private_key = data["server"]["private_key"]
-    server.public_key = data["server"]["public_key"]
-    server.addresses = settings.WG_ADDRESSES
-    server.allowed_ips = settings.WG_ALLOWED_IPS
-    server.server_dns = settings.SERVER_DOMAIN
-    server.server_port = settings.WG_SERVER_PORT
-    server.persistent_keepalive = settings.WG_PERSISTENT_KEEPALIVE
-    
-    clients = []
-    for client in data["clients"]:
-        # pair = WireguardPair()
-        # pair.user = client["user"]
-        # pair.private_key = client["private_key"]
-        # pair.public_key = client["public_key"]
-        # pair.preshared_key = client["preshared_key"]
-        clients.append(WireguardPair(
-            id=client["id"],
-            name=client["name"],
-            user=client["user"],
-            private_key=client["private_key"],
-            public_key=client["public_key"],
-            preshared_key=client["preshared_key"]
-        ))
+    scheduler.flush()
+    _apply_runtime_settings()
+    # Writers keep running while the settings change (watcher thread, /reload),
+    # they must not put into the storage or registry being replaced
+    with _lock:
+        # Mutations since the flush went to the current storage, persist them before it is dropped
+        if storage is not None and storage.dirty:
+            storage.commit(_config_data)
+        backend = _open_backend()
+        telemetry.source = _dump_interfaces
+
+        # Keep the sync state of interfaces that are still configured
+        current = {iface.name: iface for iface in interfaces}
+        interfaces = [current.get(spec["name"]) or Interface(spec["name"]) for spec in _interface_settings()]
+
+        storage = open_storage(settings.WG_STORAGE, configPath, settings.WG_JOURNAL_COMPACT)
+        if not storage.exists():
+            private_key, public_key = _new_server_keys()
+            storage.save({"server": {"private_key": private_key, "public_key": public_key}, "clients": []})
+
+        if settings.WG_SHARED_STATE:
+            shared = SharedState(configPath)
+            with shared.lock():
+                if _load_state():
+                    storage.save(_config_data())
+                    shared.bump()
+                shared.generation = shared.read()
+        else:
+            shared = None
+            if _load_state():
+                storage.save(_config_data())
+
+        print(f"Loaded {load_stats['peers']} peers from {storage.files()[0].name} in {load_stats['seconds'] * 1000:.0f} ms, peak RSS {load_stats['peak_rss'] / 2**20:.1f} MiB")
+        for problem in load_problems[:20]:
+            print(f"  {problem}")
+        if len(load_problems) > 20:
+            print(f"  ... and {len(load_problems) - 20} more")
+        if load_stats['skipped']:
+            print(f"  Skipped peers are kept in {rejected_path()} and dropped from {storage.files()[0].name} on the next save")
+
+        # The peer table was replaced wholesale, queued deltas no longer apply
+        for iface in interfaces:
+            iface.pending.clear()
+            iface.full_sync_required = True
 
     if not Path(f'{rootDataPath}/postup.sh').exists():
         Path(f'{rootDataPath}/postup.sh').touch()
@@ -126,30 +429,461 @@ def load_config():
     if not Path(f'{rootDataPath}/postdown.sh').exists():
         Path(f'{rootDataPath}/postdown.sh').touch()
         Path(f'{rootDataPath}/postdown.sh').chmod(0o755)
+    loaded = True
 
-def save_config():
+def _apply_runtime_settings():
+    """
+    Settings that only tune running components, applied without touching the peer state
+    """
+    scheduler.delay = settings.WG_APPLY_DELAY
+    scheduler.max_delay = settings.WG_APPLY_MAX_DELAY
+    keypool.size = settings.WG_KEY_POOL_SIZE
+    keypool.low_watermark = settings.WG_KEY_POOL_LOW_WATERMARK
+    keypool.refill()
+    metrics.enabled = settings.METRICS_ENABLED
+    telemetry.command = settings.WG_TELEMETRY_COMMAND
+    telemetry.interval = settings.WG_TELEMETRY_INTERVAL
+    telemetry.samples = settings.WG_TELEMETRY_SAMPLES
+    changes.size = settings.WG_CHANGE_LOG_SIZE
+
+def ensure_loaded() -> bool:
+    """
+    load_config() unless it already ran
+
+    Web workers call this on their first request instead of loading the peer
+    state, and bringing the interface up, at import. Concurrent first
+    requests wait for a single load.
+
+    Returns:
+        bool: True if this call loaded the state
+    """
+    if loaded:
+        return False
+    with _load_lock:
+        if loaded:
+            return False
+        load_config()
+        return True
+
+def _load_state() -> bool:
+    """
+    Read server and peer state from storage into the module globals
+
+    Returns:
+        bool: True if server keys were generated for new interfaces and need saving
+    """
+    global clients, _server_keys, load_problems
+
+    start = time.perf_counter()
+    _config_cache.clear()
+    _list_cache.clear()
+    changes.reset()
+    server_keys, stored_clients = storage.iter_load()
+    _server_keys = dict(server_keys)
+    keys_added = False
+    for n, (iface, spec) in enumerate(zip(interfaces, _interface_settings())):
+        prefix = "" if n == 0 else f"{iface.name}."
+        if f"{prefix}private_key" not in _server_keys:
+            _server_keys[f"{prefix}private_key"], _server_keys[f"{prefix}public_key"] = _new_server_keys()
+            keys_added = True
+
+        server = ServerWGConfig()
+        server.private_key = _server_keys[f"{prefix}private_key"]
+        server.public_key = _server_keys[f"{prefix}public_key"]
+        server.addresses = spec["addresses"]
+        server.allowed_ips = settings.WG_ALLOWED_IPS
+        server.server_dns = settings.SERVER_DOMAIN
+        server.server_port = spec.get("port", settings.WG_SERVER_PORT)
+        server.persistent_keepalive = settings.WG_PERSISTENT_KEEPALIVE
+        iface.configure(server, AddressPool(spec["addresses"], settings.WG_RESERVED_ADDRESSES, settings.WG_ADDRESS_ALLOCATION == "random"))
+    
+    # Peers are validated as they are read, so only one stored record is alive at a time
+    registry = PeerRegistry()
+    problems = []
+    # (reason, record) of every skipped peer
+    rejected = []
+    for n, client in enumerate(stored_clients):
+        # pair = WireguardPair()
+        # pair.user = client["user"]
+        # pair.private_key = client["private_key"]
+        # pair.public_key = client["public_key"]
+        # pair.preshared_key = client["preshared_key"]
+        try:
+            _check_record(client)
+            wgClient = WireguardPair(
+                id=client["id"],
+                name=client["name"],
+                user=client["user"],
+                private_key=client["private_key"],
+                public_key=client["public_key"],
+                preshared_key=client["preshared_key"]
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            reason = f"invalid record: {e!r}"
+        else:
+            if wgClient.id in registry:
+                reason = f"duplicate id {wgClient.id} ({wgClient.ip})"
+            elif not registry.add(wgClient, index=False):
+                reason = "public key already used by another peer"
+            else:
+                reason = None
+        if reason is not None:
+            problems.append(f"clients[{n}] skipped, {reason}")
+            rejected.append((reason, client))
+            continue
+
+        iface = interface_of(wgClient.id)
+        if wgClient.id not in iface:
+            problems.append(f"clients[{n}] {wgClient.ip} is outside every WireGuard subnet, kept on {iface.name}")
+        iface.pool.claim(wgClient.id)
+
+    registry.reindex()
+    clients = registry
+    load_problems = problems
+    if rejected:
+        _save_rejected(rejected)
+    load_stats.update(peers=len(registry), skipped=len(rejected), problems=len(problems), seconds=time.perf_counter() - start, peak_rss=_peak_rss())
+    return keys_added
+
+def _check_record(client: dict):
+    """
+    Raises:
+        TypeError: A field WireguardPair() would take as is has the wrong type
+    """
+    if not isinstance(client, dict):
+        raise TypeError(f"record is {type(client).__name__}, not an object")
+    if type(client.get("id")) is not int:
+        raise TypeError(f"id is {type(client.get('id')).__name__}, not an integer")
+    if not isinstance(client.get("user"), str) or not client["user"]:
+        raise TypeError("user is not a non-empty string")
+    if client.get("name") is not None and not isinstance(client["name"], str):
+        raise TypeError(f"name is {type(client['name']).__name__}, not a string")
+
+def rejected_path() -> Path:
+    """
+    File the peers skipped at load are kept in, next to the stored state
+    """
+    path = storage.files()[0]
+    return path.with_name(f"{path.name}.rejected")
+
+def _save_rejected(rejected: list[tuple[str, dict]]):
+    """
+    Append skipped peers to rejected_path() before the next save drops them from the state
+
+    One JSON object (reason and record) per line. Records already in the
+    file aren't added again, every load of the same state skips the same ones.
+    """
+    path = rejected_path()
+    lines = [json.dumps({"reason": reason, "record": client}, sort_keys=True) + "\n" for reason, client in rejected]
+    if path.exists():
+        known = set(path.read_text().splitlines(keepends=True))
+        lines = [line for line in lines if line not in known]
+    if lines:
+        durable_append(path, lines)
+
+def _peak_rss() -> int:
+    """
+    Peak resident set size of this process in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def interface_of(id: int) -> Interface:
+    """
+    Interface whose subnet contains the address `id`
+
+    Peers outside every subnet stay on the primary interface, as they did
+    when there was only one.
+    """
+    for iface in interfaces:
+        if id in iface:
+            return iface
+    return interfaces[0]
+
+def _interface_peers(iface: Interface, registry: PeerRegistry = None) -> list[WireguardPair]:
+    """
+    Peers of `iface` in address order, found by bisecting the registry's sorted ids
+    """
+    registry = registry or clients
+    ids = registry.sorted_ids
+    selected = ids[bisect.bisect_left(ids, iface.first):bisect.bisect_right(ids, iface.last)]
+    if iface is interfaces[0]:
+        start = 0
+        for first, last in sorted((other.first, other.last) for other in interfaces):
+            end = bisect.bisect_left(ids, first)
+            selected += ids[start:end] if end > start else []
+            start = max(start, bisect.bisect_right(ids, last))
+        selected += ids[start:]
+        selected.sort()
+    peers = []
+    for id in selected:
+        peer = registry.by_id.get(id)
+        if peer is not None:
+            peers.append(peer)
+    return peers
+
+def refresh() -> bool:
+    """
+    Reload the peer state if another process changed it (WG_SHARED_STATE)
+
+    Costs a single stat() when nothing changed.
+
+    Returns:
+        bool: True if the state was reloaded
+    """
+    if shared is None or not shared.changed():
+        return False
+
+    with _lock, shared.lock():
+        generation = shared.read()
+        if generation == shared.generation:
+            return False
+        _load_state()
+        shared.generation = generation
+        # Other processes write the same config files, what this one last wrote proves nothing
+        for iface in interfaces:
+            iface.config_hash = iface.config_key = iface.synced_hash = None
+    return True
+
+# Settings that shape the interfaces, address pools, storage or backend, only load_config() applies them
+_STRUCTURAL_SETTINGS = {
+    "WG_INTERFACES", "WG_ADDRESSES", "WG_SERVER_PORT", "WG_RESERVED_ADDRESSES", "WG_ADDRESS_ALLOCATION",
+    "WG_STORAGE", "WG_JOURNAL_COMPACT", "WG_SHARED_STATE", "WG_BACKEND", "WG_HELPER_SOCKET",
+}
+# Settings rendered into client configs
+_CLIENT_CONFIG_SETTINGS = {"WG_ALLOWED_IPS", "SERVER_DOMAIN", "WG_PERSISTENT_KEEPALIVE", "WG_DNS"}
+
+def apply_settings(changed: set[str]):
+    """
+    Apply settings changed by settings.load_config() to the running state
+
+    Structural changes reload everything. Otherwise only what depends on
+    the changed settings is refreshed: cached client configs for DNS,
+    endpoint and allowed IPs, the interface config files and a full sync
+    for the keepalive, which is part of every peer section. Settings read
+    on every use (ALLOWED_EMAILS, ADMIN_EMAILS, ...) need nothing. The
+    session settings are applied by app.py, see settings_listeners.
+    """
+    if not changed:
+        return
+    if changed & _STRUCTURAL_SETTINGS:
+        print(f"Reloading WireGuard state for {', '.join(sorted(changed & _STRUCTURAL_SETTINGS))}")
+        load_config()
+        reload()
+        if watchers:
+            start_watcher()
+        return
+
+    _apply_runtime_settings()
+    if changed & _CLIENT_CONFIG_SETTINGS:
+        with _lock:
+            for iface in interfaces:
+                iface.server.allowed_ips = settings.WG_ALLOWED_IPS
+                iface.server.server_dns = settings.SERVER_DOMAIN
+                iface.server.persistent_keepalive = settings.WG_PERSISTENT_KEEPALIVE
+            _config_cache.clear()
+    if "WG_PERSISTENT_KEEPALIVE" in changed:
+        with _lock:
+            for iface in interfaces:
+                iface.full_sync_required = True
+        _request_apply(wait=False)
+
+def _stored_peers(records: list, uncommitted: set[int]) -> tuple[dict[int, WireguardPair], set[int]]:
+    """
+    Validate the peers read back by apply_external_changes()
+
+    Invalid records are logged and kept in rejected_path(), like at load.
+
+    Returns:
+        tuple[dict[int, WireguardPair], set[int]]: valid peers by id, and the
+            ids of invalid records, those peers are left as they are
+    """
+    stored = {}
+    invalid = set()
+    rejected = []
+    for client in records:
+        try:
+            _check_record(client)
+            wgClient = WireguardPair(id=client["id"], name=client["name"], user=client["user"], private_key=client["private_key"], public_key=client["public_key"], preshared_key=client["preshared_key"])
+        except (KeyError, TypeError, ValueError) as e:
+            reason = f"invalid record: {e!r}"
+        else:
+            reason = f"duplicate id {wgClient.id} ({wgClient.ip})" if wgClient.id in stored else None
+        if reason is not None:
+            print(f"Ignoring peer in {storage.path.name}, {reason}")
+            rejected.append((reason, client))
+            if isinstance(client, dict) and type(client.get("id")) is int:
+                invalid.add(client["id"])
+            continue
+        if wgClient.id not in uncommitted:
+            stored[wgClient.id] = wgClient
+    if rejected:
+        _save_rejected(rejected)
+    return stored, invalid
+
+def apply_external_changes(wait: bool = False) -> tuple[int, int, int]:
+    """
+    Pick up out-of-band edits of the stored peer state (wg.json edited by hand)
+
+    The stored peers are diffed against the registry and only the added,
+    removed and changed ones are applied and synced to the interfaces. Does
+    nothing if the files are as this process last read or wrote them.
+    Invalid records are skipped, the peer they would replace is kept.
+
+    Returns:
+        tuple[int, int, int]: peers added, removed and changed
+    """
+    added = removed = changed = 0
+    with _writing():
+        if not storage.modified():
+            return added, removed, changed
+
+        data = storage.load()
+        if data["server"] != _server_keys:
+            # New server keys change every interface and client config
+            print("WireGuard server keys changed on disk, reloading every interface")
+            _load_state()
+            for iface in interfaces:
+                iface.pending.clear()
+                iface.full_sync_required = True
+            added = len(clients)
+        else:
+            # Changes made here and not committed yet win over the files
+            uncommitted = storage.pending_ids
+            stored, invalid = _stored_peers(data["clients"], uncommitted)
+            for wgClient in list(clients):
+                if wgClient.id in uncommitted or wgClient.id in invalid:
+                    continue
+                updated = stored.pop(wgClient.id, None)
+                if updated is None:
+                    clients.remove(wgClient.id)
+                    _config_cache.pop(wgClient.id, None)
+                    interface_of(wgClient.id).pool.release(wgClient.id)
+                    _queue_peer_sync(wgClient, removed=True)
+                    changes.append(wgClient.user, "removed", {"id": wgClient.id})
+                    removed += 1
+                    continue
+
+                if (updated.user, updated.private_key, updated.public_key, updated.preshared_key) == (wgClient.user, wgClient.private_key, wgClient.public_key, wgClient.preshared_key):
+                    if updated.name != wgClient.name:
+                        # Names only live in wg.json, the interface doesn't need to know
+                        clients.replace(wgClient.renamed(updated.name))
+                        changes.append(wgClient.user, "renamed", {"id": wgClient.id, "name": updated.name})
+                        changed += 1
+                    continue
+
+                clients.remove(wgClient.id)
+                _config_cache.pop(wgClient.id, None)
+                _queue_peer_sync(wgClient, removed=True)
+                changes.append(wgClient.user, "removed", {"id": wgClient.id})
+                if not clients.add(updated):
+                    print(f"Ignoring peer {updated.id} in {storage.path}: duplicate public key")
+                    interface_of(wgClient.id).pool.release(wgClient.id)
+                    removed += 1
+                    continue
+                _queue_peer_sync(updated)
+                changes.append(updated.user, "added", updated.to_public_dict())
+                changed += 1
+
+            for wgClient in stored.values():
+                if wgClient.id in clients:
+                    # Kept because its stored record was invalid, or not committed yet
+                    continue
+                if not clients.add(wgClient):
+                    print(f"Ignoring peer {wgClient.id} in {storage.path}: duplicate public key")
+                    continue
+                interface_of(wgClient.id).pool.claim(wgClient.id)
+                _queue_peer_sync(wgClient)
+                changes.append(wgClient.user, "added", wgClient.to_public_dict())
+                added += 1
+            if added or removed or changed:
+                print(f"Applied edits of {storage.path.name}: {added} added, {removed} removed, {changed} changed")
+
+    # Outside the writer section, the apply takes it too
+    if added or removed or changed:
+        _request_apply(wait)
+    return added, removed, changed
+
+# Called with the names of the changed settings after apply_settings(), for settings used outside this module
+settings_listeners: list = []
+
+def _on_files_changed(names: set[str]):
+    if settings.configPath.name in names:
+        changed = settings.load_config()
+        apply_settings(changed)
+        for listener in settings_listeners:
+            listener(changed)
+    if names & {path.name for path in storage.files()}:
+        apply_external_changes()
+
+watchers: list[FileWatcher] = []
+
+def start_watcher():
+    """
+    Watch config.json and the stored peer state for out-of-band edits (WG_WATCH)
+
+    One watcher per directory, restarted when called again so it follows a
+    changed WG_STORAGE.
+    """
+    for watcher in watchers:
+        watcher.stop()
+    watchers.clear()
+    if settings.WG_WATCH == "off":
+        return
+
+    directories: dict[Path, set[str]] = {}
+    for path in [settings.configPath, *storage.files()]:
+        directories.setdefault(path.resolve().parent, set()).add(path.name)
+    for directory, names in directories.items():
+        watcher = FileWatcher(directory, names, _on_files_changed, settings.WG_WATCH, settings.WG_WATCH_DEBOUNCE, settings.WG_WATCH_POLL_INTERVAL)
+        watcher.start()
+        watchers.append(watcher)
+
+@contextmanager
+def _writing():
+    """
+    Wrap a mutation of the peer state
+
+    Writers are serialized by a single lock, readers don't take it. With
+    WG_SHARED_STATE the inter-process lock is held for the whole
+    mutation, the state is refreshed first and the change is committed and
+    published under a new generation before the lock is released.
+    """
+    with _lock:
+        if shared is None:
+            yield
+            return
+
+        with shared.lock():
+            refresh()
+            yield
+            if storage.dirty:
+                storage.commit(_config_data)
+                shared.bump()
+
+def _config_data() -> dict:
     data = {
-        "server": {
-            "private_key": server.private_key,
-            "public_key": server.public_key,
-        },
+        "server": dict(_server_keys),
         "clients": []
     }
 
     for client in clients:
         data["clients"].append(client.to_dict())
 
-    configPath.write_text(json.dumps(data, indent=4))
+    return data
 
-def _save_wg_config():
-    global server, clients
+@metrics.timed("wg_save_config_seconds", "Time spent writing a full snapshot of the peer state")
+def save_config():
+    """
+    Write a full snapshot of the peer state
+    """
+    storage.save(_config_data())
 
-    wgconfPath = Path('/etc/wireguard/wg0.conf')
-    
-    data = f"""[Interface]
-PrivateKey = {server.private_key}
-Address = {_get_host_ip(settings.WG_ADDRESSES)}
-ListenPort = 51820
+def _render_interface_section(iface: Interface) -> str:
+    return f"""[Interface]
+PrivateKey = {iface.server.private_key}
+Address = {_get_host_ip(iface.server.addresses)}
+ListenPort = {iface.server.server_port}
 MTU = 1450
 PostUp = /app/data/postup.sh
 PreDown = /app/data/predown.sh
@@ -158,51 +892,136 @@ Table = auto
 
 
 """
-    for client in clients:
-        data += f"""[Peer]
+
+def _interface_config(iface: Interface) -> dict:
+    """
+    `iface` as the backends take it with up and syncconf, the helper renders its own config file from it
+    """
+    keepalive = iface.server.persistent_keepalive
+    return {
+        "private_key": iface.server.private_key,
+        "address": _get_host_ip(iface.server.addresses),
+        "listen_port": iface.server.server_port,
+        "mtu": 1450,
+        "peers": [
+            {
+                "public_key": client.public_key,
+                "preshared_key": client.preshared_key,
+                "allowed_ips": f"{client.ip}/{_host_prefixlen(client.id)}",
+                "persistent_keepalive": keepalive,
+            }
+            for client in _interface_peers(iface)
+        ],
+    }
+
+def _render_peer_section(client: WireguardPair, keepalive: int) -> str:
+    return f"""[Peer]
 PublicKey = {client.public_key}
 PresharedKey = {client.preshared_key}
-AllowedIPs = {convert_id_to_ip(client.id)}/32
-PersistentKeepalive = {server.persistent_keepalive}
+AllowedIPs = {client.ip}/{_host_prefixlen(client.id)}
+PersistentKeepalive = {keepalive}
 
 
 """
-    
-    wgconfPath.write_text(data)
 
-def remove_client(user: str, ipid: str) -> bool:
+@metrics.timed("wg_render_interface_config_seconds", "Time spent writing the interface config file")
+def _save_wg_config(iface: Interface) -> bool:
+    """
+    Write the config file of `iface` if its content changed
+
+    Peer sections are cached between renders, so only new or changed peers
+    are formatted. The file is streamed into a temp file and renamed into
+    place, and left alone when its hash matches what is already there.
+
+    Returns:
+        bool: True if the file was rewritten
+    """
+    # Processes sharing the state write the same file, one at a time
+    with iface.config_lock, shared.lock() if shared is not None else nullcontext():
+        registry = clients
+        header = _render_interface_section(iface)
+        key = (registry, registry.version, header, iface.server.persistent_keepalive)
+        if key == iface.config_key and iface.config_hash is not None and iface.confPath.exists():
+            return False
+
+        keepalive = iface.server.persistent_keepalive
+        sections = {}
+        chunks = [header]
+        digest = hashlib.sha256(header.encode())
+        for client in _interface_peers(iface, registry):
+            cached = iface.sections.get(client.id)
+            if cached is None or cached[0] is not client or cached[1] != keepalive:
+                cached = (client, keepalive, _render_peer_section(client, keepalive))
+            sections[client.id] = cached
+            chunks.append(cached[2])
+            digest.update(cached[2].encode())
+        iface.sections = sections
+        iface.config_key = key
+
+        if iface.config_hash is None and iface.confPath.exists():
+            iface.config_hash = hashlib.sha256(iface.confPath.read_bytes()).hexdigest()
+        if digest.hexdigest() == iface.config_hash:
+            return False
+
+        atomic_write(iface.confPath, chunks)
+        iface.config_hash = digest.hexdigest()
+        return True
+
+def remove_client(user: str, ipid: str, wait: bool = True) -> bool:
     global clients
 
-    if not _is_id_user_exists(user, ipid):
-        return False
-    
-    clients = [client for client in clients if not (client.user == user and client.id == ipid)]
-    save_config()
-    reload()
+    with _writing():
+        if not _is_id_user_exists(user, ipid):
+            return False
+        
+        wgClient = clients.remove(ipid)
+        _config_cache.pop(ipid, None)
+        interface_of(ipid).pool.release(ipid)
+        storage.delete(ipid)
+        _queue_peer_sync(wgClient, removed=True)
+        changes.append(user, "removed", {"id": wgClient.id})
+    _request_apply(wait)
     return True
 
-def add_client(wgClient: WireguardPair) -> bool:
+def add_client(wgClient: WireguardPair, wait: bool = True) -> bool:
     global clients
     
-    if _is_id_exists(wgClient.id):
-        return False
-    if _is_id_user_exists(wgClient.user, wgClient.id):
-        return False
-    
-    clients.append(wgClient)
-    save_config()
-    reload()
+    with _writing():
+        if _is_id_exists(wgClient.id):
+            return False
+        if _is_id_user_exists(wgClient.user, wgClient.id):
+            return False
+        if not clients.add(wgClient):
+            return False
+        interface_of(wgClient.id).pool.claim(wgClient.id)
+        storage.put(wgClient.to_dict())
+        _queue_peer_sync(wgClient)
+        changes.append(wgClient.user, "added", wgClient.to_public_dict())
+    _request_apply(wait)
     return True
 
 def user_config_count(user: str) -> int:
     global clients
-    return len([client for client in clients if client.user == user])
+    return clients.user_count(user)
+
+def _is_ipv6(id: int) -> bool:
+    # Small ids are valid IPv4 and IPv6 addresses, the interface holding the id tells which it is
+    if id > 0xFFFFFFFF:
+        return True
+    for iface in interfaces:
+        if id in iface:
+            return iface.pool.network.version == 6
+    return False
 
 def convert_id_to_ip(id: int) -> str:
-    return str(ipaddress.IPv4Address(id))
+    return str(ipaddress.IPv6Address(id) if _is_ipv6(id) else ipaddress.IPv4Address(id))
 
 def convert_ip_to_id(ip: str) -> int:
-    return int(ipaddress.IPv4Address(ip))
+    return int(ipaddress.ip_address(ip))
+
+def _host_prefixlen(id: int) -> int:
+    # max_prefixlen of the address, without building it
+    return 128 if _is_ipv6(id) else 32
 
 # def _is_ip_user_exists(user: str, ip: str) -> bool:
 #     global clients
@@ -214,62 +1033,154 @@ def convert_ip_to_id(ip: str) -> int:
 
 def _is_id_user_exists(user: str, id: int) -> bool:
     global clients
-    return any(client.user == user and client.id == id for client in clients)
+    return clients.get_user_peer(user, id) is not None
 
 def _is_id_exists(id: int) -> bool:
     global clients
-    return any(client.id == id for client in clients)
+    return id in clients
+
+def _place(user: str) -> Interface:
+    """
+    Pick the interface for a new peer of `user` according to WG_PLACEMENT
 
-def _get_random_id(cidr: str) -> int:
-    while True:
-        ipid = random.randint(int(ipaddress.IPv4Network(cidr).network_address) + 2, int(ipaddress.IPv4Network(cidr).broadcast_address) - 1)
-        if not _is_id_exists(ipid):
-            return ipid
+    "affinity" keeps a user's peers on the interface of their oldest peer
+    that still has room, "hash" derives the interface from the user name, both
+    falling back to "least-loaded", the interface with the fewest peers.
+
+    Raises:
+        PoolExhaustedError: No free address left on any interface
+    """
+    candidates = [iface for iface in interfaces if iface.pool.free > 0]
+    if not candidates:
+        raise PoolExhaustedError(f"Every address pool is exhausted ({', '.join(str(iface.pool.network) for iface in interfaces)})")
+
+    match settings.WG_PLACEMENT:
+        case "affinity":
+            for id in clients.by_user.get(user, {}):
+                iface = interface_of(id)
+                if iface.pool.free > 0:
+                    return iface
+        case "hash":
+            n = int.from_bytes(hashlib.sha256(user.encode()).digest()[:8], "big") % len(interfaces)
+            for iface in interfaces[n:] + interfaces[:n]:
+                if iface.pool.free > 0:
+                    return iface
+    return min(candidates, key=lambda iface: len(iface.pool))
+
+def _allocate_id(user: str) -> int:
+    """
+    Take a free address from the pool of the interface chosen for `user`
+
+    Raises:
+        PoolExhaustedError: No free address left on any interface
+    """
+    return _place(user).pool.allocate()
+
+def _pool_free() -> int:
+    return sum(iface.pool.free for iface in interfaces)
 
 def _get_host_ip(cidr) -> str:
     """
     Get wireguard server ip address
     """
-    ipaddr = ipaddress.IPv4Network(cidr)
+    ipaddr = ipaddress.ip_network(cidr)
     return f"{ipaddr.network_address + 1}/{ipaddr.prefixlen}"
 
-def generate_wireguard_pair(user: str, wgname: str = None) -> WireguardPair:
-    key = x25519.X25519PrivateKey.generate()
-    preshared_key = x25519.X25519PrivateKey.generate()
-    ipid = _get_random_id(settings.WG_ADDRESSES)
-    return WireguardPair(
-        id=ipid,
-        name=wgname,
-        user=user,
-        private_key=base64.b64encode(key.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption())).decode(),
-        public_key=base64.b64encode(key.public_key().public_bytes(encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)).decode(),
-        preshared_key=base64.b64encode(preshared_key.private_bytes(encoding=serialization.Encoding.Raw, format=serialization.PrivateFormat.Raw, encryption_algorithm=serialization.NoEncryption())).decode()
-    )
+def _generate_keys() -> tuple[bytes, bytes, bytes]:
+    """
+    Returns:
+        tuple[bytes, bytes, bytes]: raw private key, public key and preshared key
+    """
+    return keypool.take()
+
+def generate_keys(count: int) -> list[tuple[bytes, bytes, bytes]]:
+    """
+    Batch version of _generate_keys for bulk provisioning
+    """
+    return keypool.take_many(count)
+
+def create_client(user: str, wgname: str = None, wait: bool = True) -> WireguardPair:
+    """
+    Generate a peer and add it, with the address allocated and the peer
+    inserted under the same writer lock
+
+    Raises:
+        PoolExhaustedError: No free address left in WG_ADDRESSES
+    """
+    return create_clients([(user, wgname)], wait)[0]
+
+def create_clients(peers: list[tuple[str, str]], wait: bool = True) -> list[WireguardPair]:
+    """
+    Create several peers in one transaction
+
+    Addresses and keys are allocated in batch and the whole set is
+    persisted and applied to the interface once. Either every peer is
+    created or none is.
+
+    Args:
+        peers (list[tuple[str, str]]): (user, name) of each peer to create
+
+    Raises:
+        PoolExhaustedError: Not enough free addresses left for every peer
+    """
+    keys = generate_keys(len(peers))
+    created = []
+    with _writing():
+        if _pool_free() < len(peers):
+            raise PoolExhaustedError(f"Address pools have {_pool_free()} free addresses, {len(peers)} requested")
+
+        for (user, wgname), (private_key, public_key, preshared_key) in zip(peers, keys):
+            wgClient = WireguardPair(
+                id=_allocate_id(user),
+                name=wgname,
+                user=user,
+                private_key=private_key,
+                public_key=public_key,
+                preshared_key=preshared_key
+            )
+            clients.add(wgClient)
+            storage.put(wgClient.to_dict())
+            _queue_peer_sync(wgClient)
+            changes.append(user, "added", wgClient.to_public_dict())
+            created.append(wgClient)
+    _request_apply(wait)
+    return created
 
-def fix_wireguard_pair(user: str, ipid: str, wgname: str = None) -> bool:
+def fix_wireguard_pair(user: str, ipid: str, wgname: str = None, wait: bool = True) -> bool:
     global clients
 
-    if not _is_id_user_exists(user, ipid):
-        return False
+    with _writing():
+        wgClient = clients.get_user_peer(user, ipid)
+        if wgClient is None:
+            return False
+        
+        wgClient = wgClient.renamed(wgname)
+        clients.replace(wgClient)
+        storage.put(wgClient.to_dict())
+        changes.append(user, "renamed", {"id": wgClient.id, "name": wgClient.name})
     
-    wgClient = next(client for client in clients if client.user == user and client.id == ipid)
-    wgClient.name = wgname
-    
-    save_config()
-    reload()
+    # Names only live in wg.json, the interface doesn't need to know
+    _request_apply(wait)
     return True
 
-def generate_wireguard_config(user: str, ipid: int) -> str:
-    global server
+# id -> (peer, server settings, rendered config, etag)
+_config_cache: dict[int, tuple[WireguardPair, tuple, str, str]] = {}
+# user -> (peer bucket, list payload, etag)
+_list_cache: dict[str, tuple[dict, list[dict], str]] = {}
 
-    if not _is_id_user_exists(user, ipid):
-        return None
-    
-    wgClient = next(client for client in clients if client.user == user and client.id == ipid)
+def _etag(data: str) -> str:
+    return hashlib.sha256(data.encode()).hexdigest()[:32]
+
+def _server_settings(server: ServerWGConfig) -> tuple:
+    """
+    Everything besides the peer itself that ends up in a client config
+    """
+    return (server.public_key, server.addresses, tuple(server.allowed_ips), server.server_dns, server.server_port, server.persistent_keepalive, settings.WG_DNS)
 
+def _render_wireguard_config(wgClient: WireguardPair, server: ServerWGConfig) -> str:
     return f"""[Interface]
 PrivateKey = {wgClient.private_key}
-Address = {convert_id_to_ip(wgClient.id)}/32
+Address = {wgClient.ip}/{_host_prefixlen(wgClient.id)}
 {f'DNS = {settings.WG_DNS}\n' if settings.WG_DNS else ''}
 [Peer]
 PublicKey = {server.public_key}
@@ -279,27 +1190,110 @@ Endpoint = {server.server_dns}:{server.server_port}
 PersistentKeepalive = {server.persistent_keepalive}
 """
 
+def _cached_wireguard_config(user: str, ipid: int) -> tuple[str, str]:
+    """
+    Rendered client config and its etag, or (None, None) if the peer doesn't exist
+
+    Entries are keyed by the peer object, which is replaced on every change,
+    and by the server settings, so stale renders are never served.
+    """
+    wgClient = clients.get_user_peer(user, ipid)
+    if wgClient is None:
+        return None, None
+
+    # The peer's interface decides the server key, subnet and endpoint port
+    server = interface_of(wgClient.id).server
+    serverSettings = _server_settings(server)
+    cached = _config_cache.get(ipid)
+    if cached is not None and cached[0] is wgClient and cached[1] == serverSettings:
+        return cached[2], cached[3]
+
+    config = _render_wireguard_config(wgClient, server)
+    # The name is part of the download (file name), so a rename changes the etag too
+    etag = _etag(f"{wgClient.name}\n{config}")
+    while len(_config_cache) >= settings.WG_CONFIG_CACHE_SIZE > 0:
+        _config_cache.pop(next(iter(_config_cache)), None)
+    if settings.WG_CONFIG_CACHE_SIZE > 0:
+        _config_cache[ipid] = (wgClient, serverSettings, config, etag)
+    return config, etag
+
+def generate_wireguard_config(user: str, ipid: int) -> str:
+    return _cached_wireguard_config(user, ipid)[0]
+
+def render_client_config(wgClient: WireguardPair) -> str:
+    """
+    Client config of `wgClient` itself, whether or not it is still registered
+    """
+    return _render_wireguard_config(wgClient, interface_of(wgClient.id).server)
+
+def get_wireguard_config_etag(user: str, ipid: int) -> str:
+    return _cached_wireguard_config(user, ipid)[1]
+
 def get_wireguard_name(user: str, ipid: int) -> str:
     global clients
 
-    if not _is_id_user_exists(user, ipid):
+    wgClient = clients.get_user_peer(user, ipid)
+    if wgClient is None:
         raise ValueError("User and IP ID not found")
     
-    name = next(client.name for client in clients if client.user == user and client.id == ipid)
-    if not name:
-        return f"{user.split("@")[0]}_{ipid}"
+    return client_name(wgClient)
 
-    return name
+def client_name(wgClient: WireguardPair) -> str:
+    """
+    Name of `wgClient`, "<user>_<id>" for unnamed peers
+    """
+    if not wgClient.name:
+        return f"{wgClient.user.split("@")[0]}_{wgClient.id}"
+
+    return wgClient.name
+
+def _cached_wireguard_list(user: str) -> tuple[list[dict], str]:
+    # Per-user buckets are copy-on-write, so the bucket object identifies the list contents
+    bucket = clients.by_user.get(user, {})
+    cached = _list_cache.get(user)
+    if cached is not None and cached[0] is bucket:
+        return cached[1], cached[2]
+
+    data = [client.to_public_dict() for client in bucket.values()]
+    etag = _etag(json.dumps(data, sort_keys=True))
+    if bucket:
+        _list_cache[user] = (bucket, data, etag)
+    else:
+        _list_cache.pop(user, None)
+    return data, etag
 
 def get_wireguard_list(user: str) -> list[dict]:
     """
     Get WireGuard list
 
+    The list is cached and shared between callers, don't modify it.
+
     Returns:
-        list[dict]: List of WireGuard clients
+        list[dict]: List of WireGuard clients, without their private and preshared keys
     """
-    global clients
-    return [client.to_dict() for client in clients if client.user == user]
+    return _cached_wireguard_list(user)[0]
+
+def get_wireguard_list_etag(user: str) -> str:
+    return _cached_wireguard_list(user)[1]
+
+def get_wireguard_stats(user: str, window: int = 1) -> list[dict]:
+    """
+    Latest traffic and handshake figures of every peer of `user`
+
+    Args:
+        window (int): number of sample intervals the rates are averaged over
+    """
+    data = []
+    for client in clients.user_peers(user):
+        stats = telemetry.peer_stats(client.public_key, window) or {}
+        data.append({"id": client.id, "name": client.name, "ip": client.ip, **stats})
+    return data
+
+def get_global_stats(window: int = 1) -> dict:
+    data = telemetry.summary(window=window)
+    data["registered"] = len(clients)
+    data["users"] = len(clients.by_user)
+    return data
 
 def fix_name(name: str) -> str:
     name = name.replace(' ', '_')
@@ -308,18 +1302,452 @@ def fix_name(name: str) -> str:
 
 def list_users():
     global clients
-    return list(set(client.user for client in clients))
+    return clients.users()
+
+PEER_FIELDS = ("id", "name", "user", "ip", "public_key", "private_key", "preshared_key")
+SECRET_FIELDS = ("private_key", "preshared_key")
 
-def start():
-    _save_wg_config()
-    print("Starting WireGuard")
-    os.system("sudo bash -c 'wg-quick up wg0'")
+def _encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def _decode_cursor(cursor: str, sort: str):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if sort == "id" and isinstance(key, int):
+        return key
+    if sort == "name" and isinstance(key, list) and len(key) == 2 and isinstance(key[0], str) and isinstance(key[1], int):
+        return tuple(key)
+    raise ValueError("Invalid cursor")
+
+def query_peers(user: str = None, name: str = None, network: str = None, public_key: str = None,
+                sort: str = "id", descending: bool = False, limit: int = 100, cursor: str = None) -> tuple[list[WireguardPair], str]:
+    """
+    Filter, sort and page through peers using the registry indexes
 
-def stop():
-    os.system("sudo bash -c 'wg-quick down wg0'")
+    The most selective filter picks the index walked (public key, then
+    user bucket, then the sorted ids for an address range or the sorted
+    names for a name prefix), the others are checked per peer.
+
+    Args:
+        user (str): only peers of this user
+        name (str): only peers whose name starts with this
+        network (str): only peers inside this CIDR
+        public_key (str): only the peer with this public key
+        sort (str): "id" (address order) or "name"
+        descending (bool): reverse the order
+        limit (int): page size
+        cursor (str): `next` of the previous page
+
+    Returns:
+        tuple[list[WireguardPair], str]: the page, and the cursor of the next page or None
+
+    Raises:
+        ValueError: Unknown sort, malformed network or cursor
+    """
+    if sort not in ("id", "name"):
+        raise ValueError(f"Unknown sort: {sort}")
+    sort_key = (lambda pair: pair.id) if sort == "id" else _name_key
+    after = _decode_cursor(cursor, sort) if cursor else None
+    first = last = None
+    if network:
+        network = ipaddress.ip_network(network, strict=False)
+        first, last = int(network.network_address), int(network.broadcast_address)
 
-def reload():
-    _save_wg_config()
+    registry = clients
+    lookup = registry.get
+    if public_key or user is not None:
+        if public_key:
+            peer = registry.get_by_public_key(public_key)
+            peers = [peer] if peer is not None else []
+        else:
+            peers = registry.user_peers(user)
+        peers.sort(key=sort_key)
+        keys = [sort_key(peer) for peer in peers]
+        lookup = dict(zip(keys, peers)).get
+    elif sort == "id":
+        keys = registry.sorted_ids
+    else:
+        keys = registry.sorted_names
+        lookup = lambda key: registry.get(key[1])
+
+    lo, hi = 0, len(keys)
+    if sort == "id" and first is not None:
+        lo, hi = bisect.bisect_left(keys, first), bisect.bisect_right(keys, last)
+    elif sort == "name" and name:
+        lo, hi = bisect.bisect_left(keys, (name,)), bisect.bisect_left(keys, (name + chr(0x10FFFF),))
+    if after is not None and not descending:
+        lo = max(lo, bisect.bisect_right(keys, after))
+    elif after is not None:
+        hi = min(hi, bisect.bisect_left(keys, after))
+
+    page = []
+    window = keys[lo:hi]
+    for key in reversed(window) if descending else window:
+        peer = lookup(key)
+        # Removed since the index was read
+        if peer is None or sort_key(peer) != key:
+            continue
+        if user is not None and peer.user != user:
+            continue
+        if name and not (peer.name or "").startswith(name):
+            continue
+        if first is not None and not first <= peer.id <= last:
+            continue
+        if len(page) == limit:
+            return page, _encode_cursor(sort_key(page[-1]))
+        page.append(peer)
+    return page, None
+
+_command_seconds = metrics.histogram("wg_command_seconds", "Run time of wg and wg-quick commands by exit status")
+
+def _open_backend() -> Backend:
+    match settings.WG_BACKEND:
+        case "sudo":
+            return SudoBackend()
+        case "helper":
+            return HelperBackend(settings.WG_HELPER_SOCKET)
+        case "mock":
+            return MockBackend(wgconfDir)
+    raise ValueError(f"Unknown WG_BACKEND: {settings.WG_BACKEND}")
+
+def _command(op: str, iface: Interface, *args) -> CommandResult:
+    """
+    Run a backend operation on an interface, recording run time and exit code
+    """
+    start = time.perf_counter()
+    result = getattr(backend, op)(iface.name, *args)
+    _command_seconds.observe(time.perf_counter() - start, command=op, interface=iface.name, status=result.code)
+    if not result.ok:
+        print(f"WireGuard {op} on {iface.name} failed ({result.code}): {result.stderr.strip()}")
+    return result
+
+def _dump_interfaces() -> CommandResult:
+    """
+    `wg show <interface> dump` of every interface, for telemetry
+    """
+    results = [_command("show", iface, "dump") for iface in interfaces]
+    for result in results:
+        if not result.ok:
+            return result
+    # parse_dump() skips the interface lines, they have fewer fields than peers
+    return CommandResult(0, "".join(result.stdout for result in results))
+
+metrics.gauge("wg_peers", "Number of peers per user", lambda: {(("user", user),): len(peers) for user, peers in list(clients.by_user.items())})
+metrics.gauge("wg_address_pool_free", "Free addresses left per interface", lambda: {(("interface", iface.name),): iface.pool.free for iface in interfaces})
+metrics.counter("wg_address_probe_misses_total", "Random address probes that hit a used address", lambda: {(("interface", iface.name),): iface.pool.misses for iface in interfaces})
+metrics.gauge("wg_load_seconds", "Time the last load of the stored peer state took", lambda: {(): load_stats["seconds"]} if load_stats else {})
+metrics.gauge("wg_load_peak_rss_bytes", "Peak resident memory of the process as of the last state load", lambda: {(): load_stats["peak_rss"]} if load_stats else {})
+metrics.gauge("wg_key_pool_size", "Pre-generated keys ready in the key pool", lambda: {(): len(keypool)})
+metrics.gauge("wg_pending_peer_changes", "Peer changes queued for the next interface sync", lambda: {(("interface", iface.name),): len(iface.pending) for iface in interfaces})
+
+def start() -> bool:
+    """
+    Bring every interface up
+
+    Returns:
+        bool: False if any of them failed
+    """
+    ok = True
+    for iface in interfaces:
+        with _lock:
+            _save_wg_config(iface)
+            iface.pending.clear()
+            iface.full_sync_required = False
+            config = _interface_config(iface)
+        print(f"Starting WireGuard {iface.name}")
+        if _command("up", iface, config).ok:
+            iface.synced_hash = iface.config_hash
+        else:
+            ok = False
+    return ok
+
+def stop() -> bool:
+    ok = True
+    for iface in interfaces:
+        iface.synced_hash = None
+        ok = _command("down", iface).ok and ok
+    return ok
+
+@metrics.timed("wg_full_sync_seconds", "Time spent on full wg syncconf runs")
+def reload_interface(iface: Interface, force: bool = False) -> bool:
+    """
+    Write the config file of `iface` and make the interface match it
+
+    Args:
+        force (bool): run `wg syncconf` even if the interface was already synced to this exact config
+    """
+    # Everything queued so far is part of the config written below, later
+    # changes stay queued for the next sync. Nothing is dropped if the write fails
+    with _lock:
+        force = force or bool(iface.pending)
+        _save_wg_config(iface)
+        iface.pending.clear()
+        iface.full_sync_required = False
+        if not force and iface.synced_hash is not None and iface.synced_hash == iface.config_hash:
+            return True
+        config = _interface_config(iface)
     # os.system("wg syncconf wg0 <(wg-quick strip wg0)")
-    print("Reloading WireGuard configuration")
-    os.system("sudo bash -c 'wg syncconf wg0 <(wg-quick strip wg0)'")
+    print(f"Reloading WireGuard configuration of {iface.name}")
+    if not _command("syncconf", iface, config).ok:
+        iface.full_sync_required = True
+        iface.synced_hash = None
+        return False
+    iface.synced_hash = iface.config_hash
+    iface.last_drift_check = time.monotonic()
+    return True
+
+def reload(force: bool = False) -> bool:
+    """
+    reload_interface() every interface
+
+    Returns:
+        bool: False if any of them failed
+    """
+    ok = True
+    for iface in interfaces:
+        ok = reload_interface(iface, force) and ok
+    return ok
+
+@metrics.timed("wg_apply_seconds", "Time spent per coalesced persist+apply cycle")
+def _apply_changes():
+    """
+    Persist and apply everything mutated since the last run, called by the scheduler
+    """
+    with _writing():
+        storage.commit(_config_data)
+        version = changes.version
+    if not sync():
+        raise ApplyError(f"Could not apply the changes to {', '.join(iface.name for iface in interfaces if iface.full_sync_required)}")
+    changes.mark_applied(version)
+
+scheduler = ApplyScheduler(_apply_changes, settings.WG_APPLY_DELAY, settings.WG_APPLY_MAX_DELAY)
+# Ticket of the last mutation made by each thread
+_jobs = threading.local()
+# Job IDs are "<process>.<ticket>", the random prefix tells apart the jobs of
+# other processes (WG_SHARED_STATE workers) and of earlier runs of this one
+_job_prefix = secrets.token_hex(4)
+# ticket -> user who may query it, the oldest are forgotten
+_job_owners: OrderedDict[int, str] = OrderedDict()
+_JOB_OWNERS_SIZE = 10000
+
+def _request_apply(wait: bool):
+    _jobs.last = scheduler.request(wait)
+
+def last_job(owner: str) -> str:
+    """
+    Job ID of the last mutation made by the calling thread, to pass to job_status()
+
+    Args:
+        owner (str): the only user job_status() reports it to
+    """
+    ticket = getattr(_jobs, "last", 0)
+    with _lock:
+        _job_owners[ticket] = owner
+        while len(_job_owners) > _JOB_OWNERS_SIZE:
+            _job_owners.popitem(last=False)
+    return f"{_job_prefix}.{ticket}"
+
+def job_status(job: str, owner: str, timeout: float = 0) -> dict:
+    """
+    Report whether a mutation is live on the interface
+
+    Args:
+        job (str): ID returned by last_job()
+        owner (str): user asking
+        timeout (float): seconds to wait for it to be applied
+
+    Returns:
+        dict: id, state ("pending", "done", "failed" or "unknown") and error
+
+    Raises:
+        KeyError: Not a job of `owner` made by this process
+    """
+    prefix, _, ticket = job.partition(".")
+    if prefix != _job_prefix or not ticket.isdigit() or _job_owners.get(int(ticket)) != owner:
+        raise KeyError(job)
+    ticket = int(ticket)
+
+    if timeout > 0:
+        try:
+            scheduler.wait(ticket, timeout)
+        except ApplyError:
+            pass
+    state, error = scheduler.status(ticket)
+    return {"id": job, "state": state, "error": error}
+
+def _queue_peer_sync(wgClient: WireguardPair, removed: bool = False):
+    interface_of(wgClient.id).pending[wgClient.public_key] = None if removed else wgClient
+
+def _wg_set_peers(iface: Interface, changes: dict[str, WireguardPair]) -> bool:
+    """
+    Apply peer changes to `iface` with a single backend call
+
+    Returns:
+        bool: True if wg accepted every change
+    """
+    peers = []
+    for public_key, wgClient in changes.items():
+        if wgClient is None:
+            peers.append({"public_key": public_key, "remove": True})
+        else:
+            peers.append({
+                "public_key": public_key,
+                "preshared_key": wgClient.preshared_key,
+                "allowed_ips": f"{wgClient.ip}/{_host_prefixlen(wgClient.id)}",
+                "persistent_keepalive": iface.server.persistent_keepalive,
+            })
+    return _command("set_peers", iface, peers).ok
+
+def _kernel_peers(iface: Interface) -> set[str]:
+    """
+    Public keys currently configured on `iface`, or None if wg couldn't be queried
+    """
+    result = _command("show", iface, "peers")
+    if not result.ok:
+        return None
+    return set(result.stdout.split())
+
+def check_drift(iface: Interface) -> bool:
+    """
+    Compare the peer list of `iface` with the registry
+
+    Returns:
+        bool: True if they differ (or the interface can't be queried)
+    """
+    iface.last_drift_check = time.monotonic()
+    peers = _kernel_peers(iface)
+    if peers is None:
+        return True
+    pending = set(iface.pending)
+    expected = {peer.public_key for peer in _interface_peers(iface)} - pending
+    return (peers - pending) != expected
+
+@metrics.timed("wg_sync_seconds", "Time spent applying queued peer changes to the interface")
+def sync_interface(iface: Interface) -> bool:
+    """
+    Apply queued peer changes to one running interface
+
+    Only the peers that changed since the last sync are sent to `wg set`.
+    Falls back to a full `wg syncconf` when the previous state is unknown,
+    when `wg set` fails or when the periodic drift check finds the interface
+    out of step with the registry.
+
+    Returns:
+        bool: False if the interface could not be brought in line
+    """
+    if iface.full_sync_required:
+        return reload_interface(iface)
+
+    if settings.WG_DRIFT_CHECK_INTERVAL and time.monotonic() - iface.last_drift_check > settings.WG_DRIFT_CHECK_INTERVAL and check_drift(iface):
+        print(f"WireGuard interface {iface.name} drifted from configuration, running full sync")
+        return reload_interface(iface, force=True)
+
+    # The config file still has to follow so that `wg-quick up` restores the
+    # same peers, rendered under the lock so it matches exactly the changes taken
+    with _lock:
+        changes = dict(iface.pending)
+        in_sync = iface.synced_hash == iface.config_hash
+        # The changes stay queued if the write fails
+        _save_wg_config(iface)
+        iface.pending.clear()
+    if not changes:
+        return True
+
+    if not _wg_set_peers(iface, changes):
+        print(f"Incremental WireGuard sync of {iface.name} failed, running full sync")
+        return reload_interface(iface, force=True)
+    if in_sync:
+        iface.synced_hash = iface.config_hash
+    return True
+
+def sync() -> bool:
+    """
+    sync_interface() every interface with queued changes
+
+    Returns:
+        bool: False if any of them could not be brought in line
+    """
+    ok = True
+    for iface in interfaces:
+        if iface.pending or iface.full_sync_required:
+            ok = sync_interface(iface) and ok
+    return ok
+
+def move_client(wgClient: WireguardPair, target: Interface) -> WireguardPair:
+    """
+    Move a peer to another interface, call under _writing()
+
+    The peer keeps its keys and name but gets an address in the subnet of
+    `target`, so its owner has to download the new config.
+
+    Raises:
+        PoolExhaustedError: `target` has no free address left
+    """
+    moved = WireguardPair(
+        id=target.pool.allocate(),
+        name=wgClient.name,
+        user=wgClient.user,
+        private_key=wgClient._secrets[:32],
+        public_key=wgClient.raw_public_key,
+        preshared_key=wgClient._secrets[32:]
+    )
+    clients.remove(wgClient.id)
+    _config_cache.pop(wgClient.id, None)
+    interface_of(wgClient.id).pool.release(wgClient.id)
+    storage.delete(wgClient.id)
+    _queue_peer_sync(wgClient, removed=True)
+    changes.append(wgClient.user, "removed", {"id": wgClient.id})
+
+    clients.add(moved)
+    storage.put(moved.to_dict())
+    _queue_peer_sync(moved)
+    changes.append(moved.user, "added", moved.to_public_dict())
+    return moved
+
+def rebalance(wait: bool = True) -> list[tuple[WireguardPair, WireguardPair]]:
+    """
+    Move peers so the interfaces match WG_PLACEMENT again
+
+    With "hash" every peer goes to the interface its user hashes to. With
+    "affinity" whole users are moved from the busiest interface to the
+    least busy one, with "least-loaded" single peers, until the peer counts
+    are as even as that allows.
+
+    Returns:
+        list[tuple[WireguardPair, WireguardPair]]: every moved peer, before and after
+    """
+    moved = []
+    with _writing():
+        if settings.WG_PLACEMENT == "hash":
+            for wgClient in list(clients):
+                target = _place(wgClient.user)
+                if wgClient.id not in target:
+                    moved.append((wgClient, move_client(wgClient, target)))
+        else:
+            while len(interfaces) > 1:
+                peers = {iface: _interface_peers(iface) for iface in interfaces}
+                source = max(interfaces, key=lambda iface: len(peers[iface]))
+                target = min((iface for iface in interfaces if iface.pool.free > 0), key=lambda iface: len(peers[iface]), default=None)
+                if target is None:
+                    break
+                room = min((len(peers[source]) - len(peers[target])) // 2, target.pool.free)
+
+                batch = []
+                if settings.WG_PLACEMENT == "affinity":
+                    users = {}
+                    for wgClient in peers[source]:
+                        users.setdefault(wgClient.user, []).append(wgClient)
+                    fitting = [user_peers for user_peers in users.values() if len(user_peers) <= room]
+                    if fitting:
+                        batch = max(fitting, key=len)
+                else:
+                    batch = peers[source][-room:] if room > 0 else []
+                if not batch:
+                    break
+                for wgClient in batch:
+                    moved.append((wgClient, move_client(wgClient, target)))
+    if moved:
+        _request_apply(wait)
+    return moved
@@ -0,0 +1,493 @@
+"""
+Interface control for the WireGuard Manager
+
+Backends:
+    SudoBackend    runs wg/wg-quick through sudo from the web process
+    HelperBackend  talks to a long-lived privileged helper over a Unix socket
+    MockBackend    keeps an in-memory peer table, for benchmarks and tests
+
+The helper is this module run as root:
+
+    python3 wgctl.py --socket /run/wg-manager/wg.sock --group wgvpn
+
+It accepts one JSON request per line and answers one JSON line with the
+real exit code, so callers see failures instead of a discarded os.system()
+status. Only the operations below are accepted, and wg/wg-quick are run
+without a shell.
+
+Callers can't hand the helper a config file: up and syncconf carry the
+interface key, address and port and the peer list, every field is
+validated and the helper writes the file wg-quick reads into its own
+directory. The PostUp/PreDown/PostDown hooks are scripts in the helper's
+hooks directory, nothing the caller sends ends up in a command.
+"""
+from pathlib import Path
+import socketserver
+import ipaddress
+import binascii
+import subprocess
+import threading
+import tempfile
+import argparse
+import socket
+import json
+import grp
+import os
+import re
+
+INTERFACE_NAME = re.compile(r"^[A-Za-z0-9_=+.-]{1,15}$")
+HOOKS = (("PostUp", "postup.sh"), ("PreDown", "predown.sh"), ("PostDown", "postdown.sh"))
+
+def _check_key(value) -> str:
+    """
+    Raises:
+        ValueError: Not a base64 encoded 32-byte key
+    """
+    try:
+        if isinstance(value, str) and len(binascii.a2b_base64(value, strict_mode=True)) == 32:
+            return value
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid key: {value!r}")
+
+def _check_int(value, low: int, high: int) -> int:
+    if type(value) is not int or not low <= value <= high:
+        raise ValueError(f"Invalid number: {value!r}")
+    return value
+
+def _check_peer(peer) -> dict:
+    """
+    Returns:
+        dict: `peer` with only the fields wg gets
+
+    Raises:
+        ValueError: A field is missing or malformed
+    """
+    if not isinstance(peer, dict):
+        raise ValueError(f"Invalid peer: {peer!r}")
+    if peer.get("remove"):
+        return {"public_key": _check_key(peer.get("public_key")), "remove": True}
+
+    allowed_ips = peer.get("allowed_ips")
+    if not isinstance(allowed_ips, str):
+        raise ValueError(f"Invalid allowed IPs: {allowed_ips!r}")
+    try:
+        networks = [ipaddress.ip_network(network.strip()) for network in allowed_ips.split(",")]
+    except ValueError:
+        raise ValueError(f"Invalid allowed IPs: {allowed_ips!r}") from None
+    keepalive = peer.get("persistent_keepalive")
+    return {
+        "public_key": _check_key(peer.get("public_key")),
+        "preshared_key": _check_key(peer.get("preshared_key")),
+        "allowed_ips": ",".join(str(network) for network in networks),
+        "persistent_keepalive": None if keepalive is None else _check_int(keepalive, 0, 65535),
+    }
+
+def check_config(config) -> dict:
+    """
+    Validate the interface description sent with up and syncconf
+
+    Args:
+        config (dict): "private_key", "address" (the interface's address with
+            its prefix), "listen_port", "mtu" and "peers"
+
+    Raises:
+        ValueError: A field is missing or malformed
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Missing interface config")
+    try:
+        address = ipaddress.ip_interface(config.get("address"))
+    except ValueError:
+        raise ValueError(f"Invalid address: {config.get('address')!r}") from None
+    peers = config.get("peers")
+    if not isinstance(peers, list):
+        raise ValueError("Invalid peer list")
+    return {
+        "private_key": _check_key(config.get("private_key")),
+        "address": str(address),
+        "listen_port": _check_int(config.get("listen_port"), 1, 65535),
+        "mtu": _check_int(config.get("mtu"), 576, 65535),
+        "peers": [_check_peer(peer) for peer in peers],
+    }
+
+class CommandResult:
+    code: int
+    stdout: str
+    stderr: str
+
+    def __init__(self, code: int, stdout: str = "", stderr: str = ""):
+        self.code = code
+        self.stdout = stdout
+        self.stderr = stderr
+
+    @property
+    def ok(self) -> bool:
+        return self.code == 0
+
+    def to_dict(self) -> dict:
+        return {"code": self.code, "stdout": self.stdout, "stderr": self.stderr}
+
+class Backend:
+    """
+    Operations the manager needs on a WireGuard interface
+
+    Peers passed to set_peers() are dicts with "public_key" and either
+    "remove": True or "preshared_key", "allowed_ips" and "persistent_keepalive".
+    up() and syncconf() also get the interface as described in check_config(),
+    for backends that write the config file themselves.
+    """
+    def up(self, interface: str, config: dict = None) -> CommandResult:
+        raise NotImplementedError
+
+    def down(self, interface: str) -> CommandResult:
+        raise NotImplementedError
+
+    def syncconf(self, interface: str, config: dict = None) -> CommandResult:
+        """
+        Make the running interface match its config file
+        """
+        raise NotImplementedError
+
+    def set_peers(self, interface: str, peers: list[dict]) -> CommandResult:
+        raise NotImplementedError
+
+    def show(self, interface: str, what: str) -> CommandResult:
+        """
+        Args:
+            what (str): "peers" or "dump"
+        """
+        raise NotImplementedError
+
+    def batch(self, commands: list[dict]) -> list[CommandResult]:
+        """
+        Run several {"op": ..., "interface": ..., ...} commands in order
+        """
+        return [self.execute(command) for command in commands]
+
+    def execute(self, command: dict) -> CommandResult:
+        """
+        Run one request from a client, validating everything in it
+        """
+        if not isinstance(command, dict):
+            return CommandResult(2, stderr="Invalid request")
+        op = command.get("op")
+        interface = command.get("interface")
+        if not isinstance(interface, str) or not INTERFACE_NAME.match(interface):
+            return CommandResult(2, stderr=f"Invalid interface name: {interface!r}")
+
+        try:
+            match op:
+                case "up":
+                    return self.up(interface, check_config(command.get("config")))
+                case "down":
+                    return self.down(interface)
+                case "syncconf":
+                    return self.syncconf(interface, check_config(command.get("config")))
+                case "set_peers":
+                    peers = command.get("peers", [])
+                    if not isinstance(peers, list):
+                        raise ValueError("Invalid peer list")
+                    return self.set_peers(interface, [_check_peer(peer) for peer in peers])
+                case "show" if command.get("what") in ("peers", "dump"):
+                    return self.show(interface, command["what"])
+        except ValueError as e:
+            return CommandResult(2, stderr=str(e))
+        return CommandResult(2, stderr=f"Unknown operation: {op!r}")
+
+class SudoBackend(Backend):
+    """
+    Run wg and wg-quick directly, through sudo unless already root
+    """
+    def __init__(self, sudo: bool = True):
+        self.prefix = ["sudo"] if sudo else []
+
+    def _run(self, args: list[str], input: str = None) -> CommandResult:
+        try:
+            result = subprocess.run(self.prefix + args, input=input, capture_output=True, text=True)
+        except OSError as e:
+            return CommandResult(127, stderr=str(e))
+        return CommandResult(result.returncode, result.stdout, result.stderr)
+
+    def up(self, interface: str, config: dict = None) -> CommandResult:
+        return self._run(["wg-quick", "up", interface])
+
+    def down(self, interface: str) -> CommandResult:
+        return self._run(["wg-quick", "down", interface])
+
+    def syncconf(self, interface: str, config: dict = None) -> CommandResult:
+        stripped = self._run(["wg-quick", "strip", interface])
+        if not stripped.ok:
+            return stripped
+        return self._run(["wg", "syncconf", interface, "/dev/stdin"], input=stripped.stdout)
+
+    def set_peers(self, interface: str, peers: list[dict]) -> CommandResult:
+        if not peers:
+            return CommandResult(0)
+
+        args = ["wg", "set", interface]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for n, peer in enumerate(peers):
+                if peer.get("remove"):
+                    args += ["peer", peer["public_key"], "remove"]
+                    continue
+
+                # wg only reads preshared keys from files
+                pskPath = Path(tmpdir) / f"{n}.psk"
+                pskPath.touch(0o600)
+                pskPath.write_text(peer["preshared_key"])
+                args += [
+                    "peer", peer["public_key"],
+                    "preshared-key", str(pskPath),
+                    "allowed-ips", peer["allowed_ips"],
+                    "persistent-keepalive", str(peer.get("persistent_keepalive") or "off"),
+                ]
+            return self._run(args)
+
+    def show(self, interface: str, what: str) -> CommandResult:
+        return self._run(["wg", "show", interface, what])
+
+class ManagedBackend(SudoBackend):
+    """
+    What the helper runs: wg-quick on config files it renders itself
+
+    Args:
+        configDir (Path): where the config files are written, only root should have access
+        hooksDir (Path): postup.sh, predown.sh and postdown.sh, used if they exist
+    """
+    configDir: Path
+    hooksDir: Path
+
+    def __init__(self, configDir: Path, hooksDir: Path, sudo: bool = False):
+        super().__init__(sudo)
+        self.configDir = configDir
+        self.hooksDir = hooksDir
+
+    def _path(self, interface: str) -> Path:
+        return self.configDir / f"{interface}.conf"
+
+    def _render(self, config: dict) -> str:
+        lines = [
+            "[Interface]",
+            f"PrivateKey = {config['private_key']}",
+            f"Address = {config['address']}",
+            f"ListenPort = {config['listen_port']}",
+            f"MTU = {config['mtu']}",
+        ]
+        lines += [f"{key} = {self.hooksDir / name}" for key, name in HOOKS if (self.hooksDir / name).is_file()]
+        lines += ["Table = auto", ""]
+        for peer in config["peers"]:
+            lines += [
+                "[Peer]",
+                f"PublicKey = {peer['public_key']}",
+                f"PresharedKey = {peer['preshared_key']}",
+                f"AllowedIPs = {peer['allowed_ips']}",
+            ]
+            if peer["persistent_keepalive"]:
+                lines.append(f"PersistentKeepalive = {peer['persistent_keepalive']}")
+            lines.append("")
+        return "\n".join(lines)
+
+    def _write(self, interface: str, config: dict) -> Path:
+        self.configDir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        path = self._path(interface)
+        fd, tmpPath = tempfile.mkstemp(dir=self.configDir, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self._render(config))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpPath, path)
+        except BaseException:
+            Path(tmpPath).unlink(missing_ok=True)
+            raise
+        return path
+
+    def up(self, interface: str, config: dict = None) -> CommandResult:
+        return self._run(["wg-quick", "up", str(self._write(interface, config))])
+
+    def down(self, interface: str) -> CommandResult:
+        path = self._path(interface)
+        return self._run(["wg-quick", "down", str(path) if path.exists() else interface])
+
+    def syncconf(self, interface: str, config: dict = None) -> CommandResult:
+        stripped = self._run(["wg-quick", "strip", str(self._write(interface, config))])
+        if not stripped.ok:
+            return stripped
+        return self._run(["wg", "syncconf", interface, "/dev/stdin"], input=stripped.stdout)
+
+class HelperBackend(Backend):
+    """
+    Client of the privileged helper daemon
+    """
+    socketPath: str
+    timeout: float
+
+    def __init__(self, socketPath: str, timeout: float = 30):
+        self.socketPath = socketPath
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socketPath)
+            conn = self._local.conn = (sock, sock.makefile("rwb"))
+        return conn
+
+    def _request(self, request: dict) -> dict:
+        # One persistent connection per thread, reopened once if the helper restarted
+        for attempt in range(2):
+            try:
+                sock, f = self._connection()
+                f.write(json.dumps(request).encode() + b"\n")
+                f.flush()
+                line = f.readline()
+                if not line:
+                    raise ConnectionError("Helper closed the connection")
+                return json.loads(line)
+            except OSError as e:
+                self._close()
+                if attempt:
+                    return {"code": 111, "stdout": "", "stderr": f"WireGuard helper unavailable: {e}"}
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def execute(self, command: dict) -> CommandResult:
+        response = self._request(command)
+        return CommandResult(response["code"], response.get("stdout", ""), response.get("stderr", ""))
+
+    def up(self, interface: str, config: dict = None) -> CommandResult:
+        return self.execute({"op": "up", "interface": interface, "config": config})
+
+    def down(self, interface: str) -> CommandResult:
+        return self.execute({"op": "down", "interface": interface})
+
+    def syncconf(self, interface: str, config: dict = None) -> CommandResult:
+        return self.execute({"op": "syncconf", "interface": interface, "config": config})
+
+    def set_peers(self, interface: str, peers: list[dict]) -> CommandResult:
+        return self.execute({"op": "set_peers", "interface": interface, "peers": peers})
+
+    def show(self, interface: str, what: str) -> CommandResult:
+        return self.execute({"op": "show", "interface": interface, "what": what})
+
+    def batch(self, commands: list[dict]) -> list[CommandResult]:
+        response = self._request({"op": "batch", "commands": commands})
+        if "results" not in response:
+            return [CommandResult(response["code"], stderr=response.get("stderr", ""))] * len(commands)
+        return [CommandResult(result["code"], result.get("stdout", ""), result.get("stderr", "")) for result in response["results"]]
+
+class MockBackend(Backend):
+    """
+    In-memory stand-in for an interface, records every call
+    """
+    def __init__(self, configDir: Path = None):
+        self.configDir = configDir
+        self.calls: list[tuple] = []
+        self.interfaces: dict[str, dict[str, dict]] = {}
+        self.fail: set[str] = set()
+
+    def _result(self, op: str) -> CommandResult:
+        return CommandResult(1, stderr=f"{op} failed (mock)") if op in self.fail else CommandResult(0)
+
+    def up(self, interface: str, config: dict = None) -> CommandResult:
+        self.calls.append(("up", interface))
+        if "up" not in self.fail:
+            self.interfaces[interface] = self._read_config(interface, config)
+        return self._result("up")
+
+    def down(self, interface: str) -> CommandResult:
+        self.calls.append(("down", interface))
+        self.interfaces.pop(interface, None)
+        return self._result("down")
+
+    def syncconf(self, interface: str, config: dict = None) -> CommandResult:
+        self.calls.append(("syncconf", interface))
+        if "syncconf" not in self.fail:
+            self.interfaces[interface] = self._read_config(interface, config)
+        return self._result("syncconf")
+
+    def set_peers(self, interface: str, peers: list[dict]) -> CommandResult:
+        self.calls.append(("set_peers", interface, len(peers)))
+        if "set_peers" in self.fail:
+            return self._result("set_peers")
+        table = self.interfaces.setdefault(interface, {})
+        for peer in peers:
+            if peer.get("remove"):
+                table.pop(peer["public_key"], None)
+            else:
+                table[peer["public_key"]] = peer
+        return CommandResult(0)
+
+    def show(self, interface: str, what: str) -> CommandResult:
+        self.calls.append(("show", interface, what))
+        table = self.interfaces.get(interface, {})
+        if what == "peers":
+            return CommandResult(0, "".join(f"{key}\n" for key in table))
+        lines = ["(hidden)\t(hidden)\t51820\toff"]
+        lines += [f"{key}\t(hidden)\t(none)\t{peer.get('allowed_ips', '')}\t0\t0\t0\toff" for key, peer in table.items()]
+        return CommandResult(0, "\n".join(lines) + "\n")
+
+    def _read_config(self, interface: str, config: dict = None) -> dict[str, dict]:
+        if config is not None:
+            return {peer["public_key"]: peer for peer in config["peers"]}
+        if self.configDir is None or not (self.configDir / f"{interface}.conf").exists():
+            return {}
+        peers = {}
+        for line in (self.configDir / f"{interface}.conf").read_text().splitlines():
+            if line.startswith("PublicKey = "):
+                peers[line.split(" = ", 1)[1]] = {"public_key": line.split(" = ", 1)[1]}
+        return peers
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                response = {"code": 2, "stdout": "", "stderr": "Invalid JSON"}
+            else:
+                # One command at a time, the interface has a single owner
+                with self.server.lock:
+                    if isinstance(request, dict) and request.get("op") == "batch" and isinstance(request.get("commands", []), list):
+                        results = [result.to_dict() for result in self.server.backend.batch(request.get("commands", []))]
+                        response = {"code": max((result["code"] for result in results), default=0), "results": results}
+                    else:
+                        response = self.server.backend.execute(request).to_dict()
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+class HelperServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath: str, backend: Backend, group: str = None):
+        Path(socketPath).parent.mkdir(parents=True, exist_ok=True)
+        Path(socketPath).unlink(missing_ok=True)
+        super().__init__(socketPath, _Handler)
+        self.backend = backend
+        self.lock = threading.Lock()
+        if group:
+            os.chown(socketPath, -1, grp.getgrnam(group).gr_gid)
+        os.chmod(socketPath, 0o660)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="WireGuard Manager privileged helper")
+    parser.add_argument('--socket', default="/run/wg-manager/wg.sock", help="Unix socket to listen on")
+    parser.add_argument('--group', help="Group allowed to connect to the socket")
+    parser.add_argument('--config-dir', type=Path, default=Path("/etc/wg-manager"), help="Where the interface config files are written")
+    parser.add_argument('--hooks-dir', type=Path, default=Path("/etc/wg-manager/hooks"), help="Directory of postup.sh, predown.sh and postdown.sh")
+    parser.add_argument('--mock', action='store_true', help="Serve the in-memory mock backend instead of running wg")
+
+    args = parser.parse_args()
+    backend = MockBackend() if args.mock else ManagedBackend(args.config_dir, args.hooks_dir, sudo=os.geteuid() != 0)
+    with HelperServer(args.socket, backend, args.group) as server:
+        print(f"WireGuard helper listening on {args.socket}")
+        server.serve_forever()